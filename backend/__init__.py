@@ -1,46 +1,101 @@
-from flask import Blueprint, Flask, send_from_directory
+from backend.startup_clock import IMPORTS_START_TIME
+import time
+from contextlib import contextmanager
+from typing import Iterator
+from flask import Flask
 from dotenv import load_dotenv
 import os
+import resource
 from flask_session import Session
-from flask import session as flask_session
-from sqlalchemy import inspect
-from backend.admin import export_users_results_and_upload_to_google_drive
+from backend.logs import logger
 from backend.rest_api import main_blueprint
 from backend.models import db
+from backend.answer_log import init_answer_log
+from backend.batch_pool import init_batch_pool
+from backend.http_middleware import init_http_middleware
+from backend.json_provider import init_json_provider
+from backend.metrics import init_metrics
+from backend.profiling import init_profiling
+from backend.query_stats import init_query_stats
+from backend.question_bank import init_question_bank
+from backend.sharding import create_shard_tables, get_shard_binds, get_shard_uris, init_sharding
+from backend.sqlite import init_sqlite
+from backend.traffic_capture import init_traffic_capture
 
 from flask_cors import CORS
 
 load_dotenv()
 
+IMPORT_DURATION = time.perf_counter() - IMPORTS_START_TIME
+
+
+@contextmanager
+def startup_phase(app: Flask, phase: str) -> Iterator[None]:
+    """Records the duration of a startup phase in the startup report of the app."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        app.config['STARTUP_REPORT'][phase] = time.perf_counter() - start_time
+
+
+def log_startup_report(app: Flask) -> None:
+    phases = ', '.join(f'{phase} {duration * 1000:.0f} ms' for phase, duration in app.config['STARTUP_REPORT'].items())
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Kilobytes on Linux
+    logger.info(f'Worker {os.getpid()} started: {phases}. Max RSS {max_rss_mb:.0f} MB')
+
 
 def create_basic_app() -> Flask:
+    frontend_build_dir = os.environ.get('FRONTEND_BUILD_DIR', '../frontend/build')  # Relative to `backend`
     app = Flask(
         __name__,
-        static_folder='../frontend/build/static',
+        static_folder=os.path.join(frontend_build_dir, 'static'),
         static_url_path='/static',
     )
-    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["DATABASE_URI"]
-    app.config["SESSION_TYPE"] = "sqlalchemy"
-    app.config['SESSION_SQLALCHEMY'] = db
-    db.init_app(app)
+    app.config['STARTUP_REPORT'] = {'imports': IMPORT_DURATION}
+    app.config['FRONTEND_BUILD_DIR'] = frontend_build_dir
+    with startup_phase(app, 'app creation'):
+        app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["DATABASE_URI"]
+        app.config['DATABASE_SHARD_URIS'] = get_shard_uris()
+        app.config['SQLALCHEMY_BINDS'] = get_shard_binds(app.config['DATABASE_SHARD_URIS'])
+        app.config["SESSION_TYPE"] = "sqlalchemy"
+        app.config['SESSION_SQLALCHEMY'] = db
+        app.config['ADAPTIVE_TESTING'] = os.environ.get('ADAPTIVE_TESTING') == '1'
+        app.config['ARCHIVE_FINISHED_TESTS'] = os.environ.get('ARCHIVE_FINISHED_TESTS', '1') == '1'
+        # Creating the missing tables inspects every table. Can be turned off when the schema is managed separately.
+        app.config['CREATE_TABLES'] = os.environ.get('CREATE_TABLES', '1') == '1'
+        init_json_provider(app)
+        init_sqlite()
+        db.init_app(app)
     return app
 
 
 def initialize_app_modules(app: Flask):
-    app.register_blueprint(main_blueprint)
-    CORS(app, supports_credentials=True)
-    app.secret_key = os.environ["SECRET_KEY"]
-    app.config['SESSION_PERMANENT'] = True
-    app.config['SESSION_COOKIE_HTTPONLY'] = False
-    with app.app_context():
-        Session(app)
-        # if inspect(db.engine).has_table('sessions') is False:
-        #     db.create_all()  # Make sure that `sessions` table is created.
-        db.create_all()  # Make sure that all tables are created    
+    with startup_phase(app, 'modules'):
+        app.register_blueprint(main_blueprint)
+        init_sharding(app)
+        init_query_stats(app)
+        init_metrics(app)
+        init_profiling(app)
+        init_traffic_capture(app)
+        init_http_middleware(app)
+        init_question_bank(app)
+        CORS(app, supports_credentials=True)
+        app.secret_key = os.environ["SECRET_KEY"]
+        app.config['SESSION_PERMANENT'] = True
+        app.config['SESSION_COOKIE_HTTPONLY'] = False
+        with app.app_context():
+            Session(app)
+    if app.config['CREATE_TABLES'] is True:
+        with startup_phase(app, 'create tables'), app.app_context():
+            db.create_all()  # Make sure that all tables are created, including `sessions`
+            create_shard_tables()
+    init_batch_pool(app)
+    init_answer_log(app)
     return app
 
 def create_app() -> Flask:
     app = create_basic_app()
     initialize_app_modules(app)
+    log_startup_report(app)
     return app
-
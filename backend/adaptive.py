@@ -0,0 +1,240 @@
+"""
+Computerized adaptive testing (CAT) based on the Rasch model.
+
+Abilities and question difficulties are measured on a scale where a question of level L has a difficulty around
+`L.value`. Difficulties are precomputed into an in-memory item table, sorted by difficulty: the level gives the prior
+difficulty, and the share of correct answers in the history moves the question within its level. After every answer
+the ability is re-estimated (expected a posteriori), and the next question is one of the most informative ones, i.e.
+with the difficulty closest to the estimated ability. The test stops when the ability is known precisely enough.
+"""
+import math
+import random
+import threading
+import time
+from bisect import bisect_left
+from typing import NamedTuple, Optional
+from flask import Flask, current_app
+from sqlalchemy import Integer, func
+
+from backend.archive import iter_compacted_answers
+from backend.logs import logger
+from backend.models import ProgressStep, Question, db_session
+from backend.sharding import current_shard, using_shard
+from backend.types import MAX_LANGUAGE_LEVEL, MIN_LANGUAGE_LEVEL, REQUIRED_SUCCESS_PERCENTAGE, LanguageLevel
+
+
+ABILITY_GRID = [step / 10 for step in range(0, 121)]
+PRIOR_STANDARD_DEVIATION = 2.0
+TARGET_STANDARD_ERROR = 0.5
+MIN_QUESTIONS = 6
+MAX_QUESTIONS = 30
+RANDOMESQUE_CANDIDATES = 3  # The next question is chosen randomly among the most informative ones, to limit exposure
+EMPIRICAL_DIFFICULTY_WEIGHT = 20  # Number of answers after which the history weighs as much as the level prior
+ITEM_TABLE_TTL_SECONDS = 3600
+
+
+class ItemTable(NamedTuple):
+    sorted_difficulties: list[float]
+    sorted_question_ids: list[int]
+    difficulty_by_question_id: dict[int, float]
+    level_difficulties: dict[LanguageLevel, float]  # Mean difficulty of the questions of each level
+
+
+class AdaptiveDecision(NamedTuple):
+    finished_with_level: Optional[LanguageLevel]
+    next_question_id: Optional[int]
+
+
+def build_item_table() -> ItemTable:
+    # With sharding, the answers of the request's shard are used. Users are spread over the shards by a hash, so every
+    # shard is a random sample of them, and the request doesn't have to wait for all the shards.
+    answers_stats = {
+        question_id: (int(answers_count), int(correct_answers_count or 0))
+        for question_id, answers_count, correct_answers_count in db_session.query(
+            ProgressStep.question_id,
+            func.count(ProgressStep.question_id),
+            func.sum(func.cast(ProgressStep.is_correct, Integer)),
+        ).filter(
+            ProgressStep.answer.isnot(None),
+        ).group_by(ProgressStep.question_id)
+    }
+    for _, _, question_id, _, is_correct, _ in iter_compacted_answers():  # Steps only stored in the archive
+        answers_count, correct_answers_count = answers_stats.get(question_id, (0, 0))
+        answers_stats[question_id] = (answers_count + 1, correct_answers_count + is_correct)
+    questions = db_session.query(Question.id, Question.level).all()
+
+    # Logit of the share of wrong answers, relative to the other questions of the same level
+    empirical_difficulties: dict[int, float] = {}
+    level_empirical_difficulties: dict[LanguageLevel, list[float]] = {}
+    for question_id, level in questions:
+        if question_id in answers_stats:
+            answers_count, correct_answers_count = answers_stats[question_id]
+            correct_share = (correct_answers_count + 0.5) / (answers_count + 1)
+            empirical_difficulties[question_id] = math.log((1 - correct_share) / correct_share)
+            level_empirical_difficulties.setdefault(level, []).append(empirical_difficulties[question_id])
+    level_means = {level: sum(values) / len(values) for level, values in level_empirical_difficulties.items()}
+
+    difficulty_by_question_id = {}
+    level_difficulty_sums: dict[LanguageLevel, list[float]] = {}
+    for question_id, level in questions:
+        difficulty = float(level.value)
+        if question_id in empirical_difficulties:
+            answers_count = answers_stats[question_id][0]
+            shift = empirical_difficulties[question_id] - level_means[level]
+            difficulty += shift * answers_count / (answers_count + EMPIRICAL_DIFFICULTY_WEIGHT)
+        difficulty_by_question_id[question_id] = difficulty
+        level_difficulty_sums.setdefault(level, []).append(difficulty)
+
+    sorted_items = sorted((difficulty, question_id) for question_id, difficulty in difficulty_by_question_id.items())
+    return ItemTable(
+        sorted_difficulties=[difficulty for difficulty, _ in sorted_items],
+        sorted_question_ids=[question_id for _, question_id in sorted_items],
+        difficulty_by_question_id=difficulty_by_question_id,
+        level_difficulties={level: sum(values) / len(values) for level, values in level_difficulty_sums.items()},
+    )
+
+
+_item_table_lock = threading.Lock()  # Only held to read or swap the table, never while building it
+_item_table: Optional[ItemTable] = None
+_item_table_built_at = 0.0
+_item_table_generation = 0  # Incremented by `invalidate_item_table`, so that an older build is not swapped in
+_item_table_rebuilding = False
+
+
+def _set_item_table(item_table: ItemTable, generation: int) -> None:
+    global _item_table, _item_table_built_at
+    with _item_table_lock:
+        if generation == _item_table_generation:
+            _item_table = item_table
+            _item_table_built_at = time.monotonic()
+
+
+def _rebuild_item_table(app: Flask, shard_index: Optional[int], generation: int) -> None:
+    global _item_table_rebuilding
+    try:
+        with app.app_context(), using_shard(shard_index):
+            _set_item_table(build_item_table(), generation)
+    except Exception as e:
+        logger.exception(e)  # The stale table is kept until the next attempt
+    finally:
+        with _item_table_lock:
+            _item_table_rebuilding = False
+
+
+def get_item_table() -> ItemTable:
+    """
+    Returns the item table, built on the first call. Once it's older than `ITEM_TABLE_TTL_SECONDS`, the stale table
+    is still returned while a new one is built in the background.
+    """
+    global _item_table_rebuilding
+    with _item_table_lock:
+        item_table, generation = _item_table, _item_table_generation
+        start_rebuild = (
+            item_table is not None
+            and not _item_table_rebuilding
+            and time.monotonic() - _item_table_built_at > ITEM_TABLE_TTL_SECONDS
+        )
+        if start_rebuild:
+            _item_table_rebuilding = True
+    if start_rebuild:
+        threading.Thread(
+            target=_rebuild_item_table,
+            args=(current_app._get_current_object(), current_shard.get(), generation),
+            name='item-table',
+            daemon=True,
+        ).start()
+    if item_table is None:
+        # Concurrent first requests may each build it, all of them get an up-to-date table
+        item_table = build_item_table()
+        _set_item_table(item_table, generation)
+    return item_table
+
+
+def invalidate_item_table() -> None:
+    global _item_table, _item_table_generation
+    with _item_table_lock:
+        _item_table = None
+        _item_table_generation += 1
+
+
+def correct_answer_probability(ability: float, difficulty: float) -> float:
+    return 1 / (1 + math.exp(difficulty - ability))
+
+
+def estimate_ability(responses: list[tuple[float, bool]], prior_mean: float) -> tuple[float, float]:
+    """Returns the expected a posteriori ability and its standard error, given (difficulty, is_correct) responses."""
+    log_weights = []
+    for ability in ABILITY_GRID:
+        log_weight = -((ability - prior_mean) ** 2) / (2 * PRIOR_STANDARD_DEVIATION ** 2)
+        for difficulty, is_correct in responses:
+            probability = correct_answer_probability(ability, difficulty)
+            log_weight += math.log(probability if is_correct else 1 - probability)
+        log_weights.append(log_weight)
+    max_log_weight = max(log_weights)
+    weights = [math.exp(log_weight - max_log_weight) for log_weight in log_weights]
+    total_weight = sum(weights)
+    mean = sum(ability * weight for ability, weight in zip(ABILITY_GRID, weights)) / total_weight
+    variance = sum((ability - mean) ** 2 * weight for ability, weight in zip(ABILITY_GRID, weights)) / total_weight
+    return mean, math.sqrt(variance)
+
+
+def place_ability(ability: float, item_table: ItemTable) -> LanguageLevel:
+    """Returns the highest level, whose questions would be answered with the required success rate."""
+    required_share = REQUIRED_SUCCESS_PERCENTAGE / 100
+    finished_with_level = LanguageLevel.A0
+    for level, level_difficulty in sorted(item_table.level_difficulties.items(), key=lambda entry: entry[0].value):
+        if not (MIN_LANGUAGE_LEVEL.value <= level.value <= MAX_LANGUAGE_LEVEL.value):
+            continue
+        if correct_answer_probability(ability, level_difficulty) >= required_share:
+            finished_with_level = level
+    return finished_with_level
+
+
+def choose_most_informative_question(
+        ability: float,
+        answered_question_ids: set[int],
+        item_table: ItemTable,
+) -> Optional[int]:
+    """Picks randomly among the unanswered questions with the difficulty closest to the ability."""
+    difficulties = item_table.sorted_difficulties
+    question_ids = item_table.sorted_question_ids
+    candidates: list[int] = []
+    right = bisect_left(difficulties, ability)
+    left = right - 1
+    while len(candidates) < RANDOMESQUE_CANDIDATES and (left >= 0 or right < len(difficulties)):
+        if right >= len(difficulties) or (left >= 0 and ability - difficulties[left] <= difficulties[right] - ability):
+            index, left = left, left - 1
+        else:
+            index, right = right, right + 1
+        if question_ids[index] not in answered_question_ids:
+            candidates.append(question_ids[index])
+    return random.choice(candidates) if candidates else None
+
+
+def process_adaptive_responses(
+        responses: list[tuple[int, bool]],
+        start_level: LanguageLevel,
+        item_table: Optional[ItemTable] = None,
+) -> AdaptiveDecision:
+    """
+    Adaptive counterpart of `process_stats`: given the (question_id, is_correct) responses so far, either finishes
+    the test with the detected level or chooses the next question.
+    """
+    if item_table is None:
+        item_table = get_item_table()
+    known_responses = [
+        (item_table.difficulty_by_question_id[question_id], is_correct)
+        for question_id, is_correct in responses
+        if question_id in item_table.difficulty_by_question_id
+    ]
+    prior_mean = item_table.level_difficulties.get(start_level, float(start_level.value))
+    ability, standard_error = estimate_ability(known_responses, prior_mean)
+
+    precise_enough = len(responses) >= MIN_QUESTIONS and standard_error <= TARGET_STANDARD_ERROR
+    next_question_id = None
+    if not precise_enough and len(responses) < MAX_QUESTIONS:
+        answered_question_ids = {question_id for question_id, _ in responses}
+        next_question_id = choose_most_informative_question(ability, answered_question_ids, item_table)
+    if next_question_id is None:
+        return AdaptiveDecision(finished_with_level=place_ability(ability, item_table), next_question_id=None)
+    return AdaptiveDecision(finished_with_level=None, next_question_id=next_question_id)
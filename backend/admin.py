@@ -1,20 +1,46 @@
 from datetime import datetime
 from pathlib import Path
 from typing import Iterator
-from backend.flow_logic import get_passed_levels_stats, process_stats
-from backend.types import MAX_LANGUAGE_LEVEL, AllAnalytics, LanguageLevel, StagesAnalytics, TopicSuccessData
-from backend.models import ProgressStep, Question, User, UserAnalytics, db_session
-import openpyxl
-from openpyxl.utils import get_column_letter
-from pydrive2.auth import GoogleAuth
-from pydrive2.drive import GoogleDrive
-from sqlalchemy import Integer, case, func
+from backend.flow_logic import get_passed_levels_stats, get_passed_levels_stats_for_users, process_stats
+from backend.types import (
+    MAX_LANGUAGE_LEVEL,
+    NEXT_LANGUAGE_LEVEL,
+    AllAnalytics,
+    LanguageLevel,
+    StagesAnalytics,
+    TopicSuccessData,
+)
+from backend.models import (
+    ANALYTICS_WATERMARK_ID,
+    AnalyticsWatermark,
+    FinishedUserAnalyticsAggregate,
+    ProgressStep,
+    Question,
+    StartLevelAnalyticsAggregate,
+    TopicAnalyticsAggregate,
+    User,
+    UserAnalytics,
+    db_session,
+)
+from backend.sharding import iter_shards
+from sqlalchemy import insert, tuple_, update
+from sqlalchemy.exc import IntegrityError
+
+
+USERS_CHUNK_SIZE = 500
+STEPS_CHUNK_SIZE = 5000
 
 
 def generate_users_results_export_data() -> Iterator[tuple]:
+    for _ in iter_shards():
+        yield from _generate_shard_users_results_export_data()
+
+
+def _generate_shard_users_results_export_data() -> Iterator[tuple]:
     for user in db_session.query(User):
-        stats = get_passed_levels_stats(user.id)
-        finished_level, _ = process_stats(stats)
+        finished_level = user.detected_level
+        if finished_level is None:  # Finished before the detected level was stored, or still in progress
+            finished_level, _ = process_stats(get_passed_levels_stats(user.id))
         if finished_level is None:
             continue  # Export only users that have finished
 
@@ -22,7 +48,7 @@ def generate_users_results_export_data() -> Iterator[tuple]:
         if finished_level > LanguageLevel.A0:
             finished_level_str = str(finished_level)
         if finished_level < MAX_LANGUAGE_LEVEL:
-            recommended_group_str = str(finished_level + 1)
+            recommended_group_str = str(NEXT_LANGUAGE_LEVEL[finished_level])
         yield (
             user.id,
             user.full_name,
@@ -34,6 +60,10 @@ def generate_users_results_export_data() -> Iterator[tuple]:
 
 
 def export_users_results_to_file(filepath: Path):
+    # Imported on the first export, so that web workers don't load openpyxl unless it's needed
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+
     workbook = openpyxl.Workbook()
     worksheet = workbook.active
     worksheet.title = 'Результаты прохождения теста'
@@ -67,6 +97,10 @@ def export_users_results_to_file(filepath: Path):
 
 
 def upload_file_to_google_drive(filepath: Path):
+    # The Google API client stack is heavy, it's imported on the first upload
+    from pydrive2.auth import GoogleAuth
+    from pydrive2.drive import GoogleDrive
+
     settings = {
         'client_config_backend': 'service',
         'service_config': {
@@ -94,50 +128,169 @@ def export_users_results_and_upload_to_google_drive():
     upload_file_to_google_drive(filepath)
 
 
+def _fold_page_openings(watermark: AnalyticsWatermark) -> None:
+    result = db_session.execute(update(UserAnalytics).where(
+        UserAnalytics.analytics_folded.is_(False),
+    ).values(analytics_folded=True))
+    watermark.page_opened_count += result.rowcount
+
+
+def _fold_started_tests(watermark: AnalyticsWatermark) -> None:
+    while True:
+        new_users = db_session.query(
+            User.id,
+            User.start_level,
+            User.choosed_dont_know_level,
+        ).filter(
+            User.analytics_folded.is_(False),
+        ).order_by(User.id).limit(USERS_CHUNK_SIZE).all()
+        if not new_users:
+            return
+        users_counts: dict[tuple, int] = {}
+        for _, start_level, choosed_dont_know_level in new_users:
+            key = (start_level, choosed_dont_know_level)
+            users_counts[key] = users_counts.get(key, 0) + 1
+        for (start_level, choosed_dont_know_level), users_count in users_counts.items():
+            aggregate = db_session.get(StartLevelAnalyticsAggregate, (start_level, choosed_dont_know_level))
+            if aggregate is None:
+                aggregate = StartLevelAnalyticsAggregate(
+                    start_level=start_level,
+                    choosed_dont_know_level=choosed_dont_know_level,
+                    users_count=0,
+                )
+                db_session.add(aggregate)
+            aggregate.users_count += users_count
+        watermark.started_the_test_count += len(new_users)
+        db_session.execute(update(User).where(
+            User.id.in_([user_id for user_id, _, _ in new_users]),
+        ).values(analytics_folded=True))
+
+
+def _fold_answers() -> None:
+    """Folds the answers that haven't been folded yet into the per-topic aggregates and detects the finished users."""
+    while True:
+        new_answers = db_session.query(
+            ProgressStep.user_id,
+            ProgressStep.step_number,
+            Question.category,
+            Question.topic_title,
+            ProgressStep.is_correct,
+        ).join(ProgressStep.question).filter(
+            ProgressStep.answer.isnot(None),
+            ProgressStep.analytics_folded.is_(False),
+        ).order_by(ProgressStep.user_id, ProgressStep.step_number).limit(STEPS_CHUNK_SIZE).all()
+        if not new_answers:
+            return
+
+        topic_counts: dict[tuple, list[int]] = {}
+        for _, _, category, topic_title, is_correct in new_answers:
+            counts = topic_counts.setdefault((category, topic_title), [0, 0])
+            counts[0] += 1
+            counts[1] += bool(is_correct)
+        for (category, topic_title), (questions_count, correct_answers_count) in topic_counts.items():
+            aggregate = db_session.get(TopicAnalyticsAggregate, (category, topic_title))
+            if aggregate is None:
+                aggregate = TopicAnalyticsAggregate(
+                    category=category,
+                    topic_title=topic_title,
+                    questions_count=0,
+                    correct_answers_count=0,
+                )
+                db_session.add(aggregate)
+            aggregate.questions_count += questions_count
+            aggregate.correct_answers_count += correct_answers_count
+
+        # Only the users that have answered something can become finished
+        active_user_ids = sorted({user_id for user_id, *_ in new_answers})
+        finished_user_ids = {user_id for user_id, in db_session.query(User.id).filter(
+            User.id.in_(active_user_ids),
+            User.detected_level.isnot(None),
+        )}
+        unknown_user_ids = [user_id for user_id in active_user_ids if user_id not in finished_user_ids]
+        for user_id, stats in get_passed_levels_stats_for_users(unknown_user_ids).items():
+            finished_level, _ = process_stats(stats)
+            if finished_level is not None:
+                finished_user_ids.add(user_id)
+        for user_id in finished_user_ids:
+            if db_session.get(FinishedUserAnalyticsAggregate, user_id) is None:
+                db_session.add(FinishedUserAnalyticsAggregate(user_id=user_id))
+
+        db_session.execute(update(ProgressStep).where(
+            tuple_(ProgressStep.user_id, ProgressStep.step_number).in_(
+                [(user_id, step_number) for user_id, step_number, *_ in new_answers],
+            ),
+        ).values(
+            analytics_folded=True,
+            timestamp=ProgressStep.timestamp,  # Not the time of the answer anymore otherwise
+        ))
+
+
+def _lock_analytics_watermark() -> AnalyticsWatermark:
+    """The watermark row, locked until the end of the transaction."""
+    watermark_query = db_session.query(AnalyticsWatermark).filter(
+        AnalyticsWatermark.id == ANALYTICS_WATERMARK_ID,
+    ).with_for_update()
+    watermark = watermark_query.one_or_none()
+    if watermark is not None:
+        return watermark
+    # The row is inserted with the table, unless the table was created before that
+    try:
+        db_session.execute(insert(AnalyticsWatermark).values(
+            id=ANALYTICS_WATERMARK_ID,
+            page_opened_count=0,
+            started_the_test_count=0,
+        ))
+        db_session.commit()
+    except IntegrityError:
+        db_session.rollback()  # Inserted by a concurrent refresh
+    return watermark_query.one()
+
+
+def refresh_analytics_aggregates() -> AnalyticsWatermark:
+    """
+    Folds the rows added or answered since the last refresh into the persisted analytics aggregates, and flags them
+    as folded in the same transaction.
+    """
+    watermark = _lock_analytics_watermark()
+    _fold_page_openings(watermark)
+    _fold_started_tests(watermark)
+    _fold_answers()
+    db_session.commit()
+    return watermark
+
+
 def calculate_all_analytics() -> AllAnalytics:
-    page_opened_count = db_session.query(UserAnalytics).count()
-    started_the_test_count = db_session.query(User).count()
-    finishsed_users_count = 0
-    for user in db_session.query(User):
-        finished_level, _ = process_stats(get_passed_levels_stats(user.id))
-        if finished_level is not None:
-            finishsed_users_count += 1
-
-    level_determination_func = case((User.choosed_dont_know_level, LanguageLevel.A0), else_=User.start_level)
-    start_level_distribution_query = db_session.query(
-        level_determination_func,
-        func.count(User.id),
-    ).group_by(
-        User.start_level,
-    ).group_by(
-        User.choosed_dont_know_level,
-    ).order_by(
-        level_determination_func
-    )
+    """Refreshes the aggregates of every shard and merges them."""
+    page_opened_count, started_the_test_count, finishsed_users_count = 0, 0, 0
+    start_level_counts: dict[LanguageLevel, int] = {}
+    topic_counts: dict[tuple, list[int]] = {}
+    for _ in iter_shards():
+        watermark = refresh_analytics_aggregates()
+        page_opened_count += watermark.page_opened_count
+        started_the_test_count += watermark.started_the_test_count
+        finishsed_users_count += db_session.query(FinishedUserAnalyticsAggregate).count()
 
-    per_topic_query = db_session.query(
-        Question.category,
-        Question.topic_title,
-        func.count(ProgressStep.question_id),
-        func.sum(func.cast(ProgressStep.is_correct, Integer)),
-    ).join(ProgressStep).filter(
-        ProgressStep.answer.isnot(None),
-    ).group_by(
-        Question.category,
-        Question.topic_title,
-    ).order_by(
-        Question.category,
-        Question.topic_title,
-    )
+        for aggregate in db_session.query(StartLevelAnalyticsAggregate):
+            level = LanguageLevel.A0 if aggregate.choosed_dont_know_level else aggregate.start_level
+            start_level_counts[level] = start_level_counts.get(level, 0) + aggregate.users_count
+
+        for aggregate in db_session.query(TopicAnalyticsAggregate):
+            counts = topic_counts.setdefault((aggregate.category, aggregate.topic_title), [0, 0])
+            counts[0] += aggregate.questions_count
+            counts[1] += aggregate.correct_answers_count
 
-    topics_success = []
-    for category, topic_title, questions_count, correct_answers_count in per_topic_query:
-        topics_success.append(TopicSuccessData(
+    topics_success = [
+        TopicSuccessData(
             category=category,
             topic_title=topic_title,
-            questions_count=int(questions_count),
-            correct_answers_count=int(correct_answers_count),
-        ))
+            questions_count=questions_count,
+            correct_answers_count=correct_answers_count,
+        )
+        for (category, topic_title), (questions_count, correct_answers_count) in sorted(
+            topic_counts.items(),
+            key=lambda item: (item[0][0].name, item[0][1]),  # As ordered by the DB
+        )
+    ]
 
     all_analytics = AllAnalytics(
         stages_analytics=StagesAnalytics(
@@ -145,7 +298,10 @@ def calculate_all_analytics() -> AllAnalytics:
             started_the_test_percentage=int((started_the_test_count - finishsed_users_count) / page_opened_count * 100),
             finished_the_test_percentage=int(finishsed_users_count / page_opened_count * 100),
         ),
-        start_level_selection_distribution=[(level, int(count / started_the_test_count * 100)) for level, count in start_level_distribution_query],
+        start_level_selection_distribution=[
+            (level.name, int(count / started_the_test_count * 100))
+            for level, count in sorted(start_level_counts.items(), key=lambda entry: entry[0].value)
+        ],
         topics_success=topics_success
     )
     return all_analytics
@@ -0,0 +1,279 @@
+"""
+Write-behind storage of the answers given with `/api/next-step`.
+
+With `ANSWER_LOG_DIR` set, a request doesn't commit the answer to the DB. The graded answer is appended to a log file
+in that directory, and the request returns once the log is fsynced; requests that arrive during an fsync share the
+next one. The answer is also kept in the user's session, so that the next requests of the user see it whichever
+worker handles them. The DB-backed session row is written by every `/api/next-step` anyway, as the current step
+changes, so the log saves the UPDATE of the progress step and its commit: one write transaction per answer instead
+of two. A background thread applies the logged answers to the progress steps every
+`ANSWER_LOG_FLUSH_INTERVAL_SECONDS` with a single UPDATE per batch, the steps get the time of the answers. The
+buffered answers of a user are applied by the request that finishes a level, before the level is graded (see
+`apply_buffered_answers`), so most answers are applied twice. An answer is only saved to a step that has no answer
+yet, the second time changes nothing (not even the timestamp of the step).
+
+Every worker appends to its own segment files, which are locked while the worker is alive and deleted once applied.
+The segments left by a crashed worker are replayed by the flusher of any other worker. A logged answer records the
+shard of its user, and is applied there. The adaptive test chooses a new question (and commits it) after every
+answer anyway, so its answers are not buffered.
+"""
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import IO, NamedTuple, Optional
+from flask import Flask, session as flask_session
+from sqlalchemy import and_, case, or_, update
+
+from backend.logs import logger
+from backend.models import ProgressStep, db_session
+from backend.sharding import current_shard, using_shard
+
+
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+SEGMENT_SUFFIX = '.log'
+APPLY_BATCH_SIZE = 500
+
+
+class LoggedAnswer(NamedTuple):
+    user_id: int
+    step_number: int
+    answer: str
+    is_correct: bool
+    shard: Optional[int] = None  # Shard of the user, the user ids are only unique within a shard
+    answered_at: Optional[float] = None  # Unix time, the time of applying is used if missing
+
+
+def apply_answers(answers: list[LoggedAnswer]) -> None:
+    """
+    Saves the answers to the unanswered progress steps, with one UPDATE per `APPLY_BATCH_SIZE` answers, and commits.
+    The steps get the time of their answers rather than the time of applying them.
+    """
+    applied_at = datetime.datetime.utcnow()
+    for batch_start in range(0, len(answers), APPLY_BATCH_SIZE):
+        batch = answers[batch_start:batch_start + APPLY_BATCH_SIZE]
+        step_conditions = [
+            and_(ProgressStep.user_id == answer.user_id, ProgressStep.step_number == answer.step_number)
+            for answer in batch
+        ]
+        answered_at_whens = [
+            (condition, datetime.datetime.utcfromtimestamp(answer.answered_at))
+            for condition, answer in zip(step_conditions, batch)
+            if answer.answered_at is not None
+        ]
+        db_session.execute(
+            update(ProgressStep).where(or_(*step_conditions), ProgressStep.answer.is_(None)).values(
+                answer=case(*((condition, answer.answer) for condition, answer in zip(step_conditions, batch))),
+                is_correct=case(*(
+                    (condition, answer.is_correct) for condition, answer in zip(step_conditions, batch)
+                )),
+                timestamp=case(*answered_at_whens, else_=applied_at) if answered_at_whens else applied_at,
+            ).execution_options(synchronize_session=False)
+        )
+    db_session.commit()
+
+
+def apply_logged_answers(answers: list[LoggedAnswer]) -> None:
+    """Applies the answers in the shards of their users."""
+    shard_answers: dict[Optional[int], list[LoggedAnswer]] = {}
+    for answer in answers:
+        shard_answers.setdefault(answer.shard, []).append(answer)
+    for shard_index, answers_of_shard in shard_answers.items():
+        with using_shard(shard_index):
+            apply_answers(answers_of_shard)
+
+
+def _read_segment(file: IO[bytes]) -> list[LoggedAnswer]:
+    answers = []
+    file.seek(0)
+    for line in file:
+        if not line.endswith(b'\n'):
+            break  # Torn write of a crashed worker, never acknowledged
+        answers.append(LoggedAnswer(*json.loads(line)))
+    return answers
+
+
+class _Segment:
+    __slots__ = ('path', 'file', 'answers')
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = open(path, 'ab+')
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # Held while the segment is not applied
+        self.answers: list[LoggedAnswer] = []
+
+    def delete(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.file.close()
+
+
+class AnswerLog:
+    def __init__(self) -> None:
+        self.directory: Optional[Path] = None
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL_SECONDS
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._segment: Optional[_Segment] = None
+        self._sealed_segments: list[_Segment] = []  # Waiting to be applied
+        self._unwritten: list[bytes] = []
+        self._appended_count = 0
+        self._synced_count = 0
+        self._is_syncing = False
+        self._failed_batch: tuple[int, int, Optional[OSError]] = (0, 0, None)  # Sequence numbers of the lines
+        self._flush_lock = threading.Lock()
+        self._thread_pid: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def configure(self, directory: Optional[Path], flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS) -> None:
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if directory is not None:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def _new_segment(self) -> _Segment:
+        assert self.directory is not None
+        return _Segment(self.directory / f'answers-{uuid.uuid4().hex}{SEGMENT_SUFFIX}')
+
+    def append(self, answer: LoggedAnswer) -> None:
+        """Returns once the answer is durably logged."""
+        line = json.dumps(answer, ensure_ascii=False).encode() + b'\n'
+        with self._lock:
+            if self._segment is None:
+                self._segment = self._new_segment()
+            self._segment.answers.append(answer)
+            self._unwritten.append(line)
+            self._appended_count += 1
+            sequence_number = self._appended_count
+            # Group commit: whoever finds no fsync in progress writes and syncs the lines of everybody waiting
+            while self._synced_count < sequence_number:
+                if self._is_syncing:
+                    self._synced.wait()
+                    continue
+                self._is_syncing = True
+                segment, data, synced_count = self._segment, b''.join(self._unwritten), self._appended_count
+                previous_synced_count = self._synced_count
+                self._unwritten = []
+                self._lock.release()
+                error: Optional[OSError] = None
+                try:
+                    segment.file.write(data)
+                    segment.file.flush()
+                    os.fsync(segment.file.fileno())
+                except OSError as e:
+                    error = e
+                finally:
+                    self._lock.acquire()
+                    self._is_syncing = False
+                    self._synced_count = synced_count
+                    self._synced.notify_all()
+                if error is not None:
+                    self._failed_batch = (previous_synced_count, synced_count, error)
+            failed_after, failed_up_to, error = self._failed_batch
+            if failed_after < sequence_number <= failed_up_to:
+                raise error
+
+    def _seal_segment(self) -> None:
+        with self._lock:
+            while self._is_syncing or self._synced_count < self._appended_count:  # Lines of the segment are unwritten
+                self._synced.wait()
+            if self._segment is not None and self._segment.answers:
+                self._sealed_segments.append(self._segment)
+                self._segment = None
+
+    def flush(self) -> int:
+        """Applies the logged answers to the DB. Must be called within an app context. Returns the applied count."""
+        with self._flush_lock:
+            self._seal_segment()
+            applied_count = 0
+            while self._sealed_segments:
+                segment = self._sealed_segments[0]
+                apply_logged_answers(segment.answers)  # Kept for the next flush if it fails
+                applied_count += len(segment.answers)
+                self._sealed_segments.pop(0)
+                segment.delete()
+            return applied_count + self.replay_orphaned_segments()
+
+    def replay_orphaned_segments(self) -> int:
+        """Applies the segments of the workers that have crashed, which are not locked by anyone."""
+        if self.directory is None:
+            return 0
+        replayed_count = 0
+        for path in sorted(self.directory.glob(f'*{SEGMENT_SUFFIX}')):
+            try:
+                file = open(path, 'rb+')
+            except FileNotFoundError:
+                continue  # Applied in the meantime
+            with file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # Owned by a live worker, or being replayed by another one
+                if not path.exists():
+                    continue
+                answers = _read_segment(file)
+                if answers:
+                    apply_logged_answers(answers)
+                    logger.warning(f'Replayed {len(answers)} answers of {path.name}')
+                path.unlink()
+                replayed_count += len(answers)
+        return replayed_count
+
+    def start(self, app: Flask) -> None:
+        """Starts the flusher thread, once per process: a worker forked after `create_app` starts its own."""
+        if not self.enabled or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, args=(app,), name='answer-log', daemon=True).start()
+
+    def _run(self, app: Flask) -> None:
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+
+answer_log = AnswerLog()
+
+
+def init_answer_log(app: Flask) -> None:
+    directory = os.environ.get('ANSWER_LOG_DIR')
+    answer_log.configure(
+        Path(directory) if directory else None,
+        flush_interval=float(os.environ.get('ANSWER_LOG_FLUSH_INTERVAL_SECONDS', DEFAULT_FLUSH_INTERVAL_SECONDS)),
+    )
+    if not answer_log.enabled:
+        return
+
+    # The first request of every worker starts its flusher, the forked workers don't inherit the threads of the master
+    @app.before_request
+    def start_answer_log():
+        answer_log.start(app)
+
+
+def buffer_answer(user_id: int, step_number: int, answer: str, is_correct: bool) -> None:
+    """Logs the answer instead of committing it, and keeps it in the session until the level is finished."""
+    answered_at = time.time()
+    answer_log.append(LoggedAnswer(user_id, step_number, answer, is_correct, current_shard.get(), answered_at))
+    buffered_answers = flask_session.setdefault('buffered_answers', {})
+    buffered_answers[str(step_number)] = [answer, is_correct, answered_at]
+    flask_session.modified = True
+
+
+def apply_buffered_answers(user_id: int) -> None:
+    """Saves the answers of the user that the flusher may not have applied yet."""
+    buffered_answers = flask_session.pop('buffered_answers', None)
+    if buffered_answers:
+        apply_answers([
+            LoggedAnswer(user_id, int(step_number), answer, is_correct, answered_at=answered_at)
+            for step_number, (answer, is_correct, answered_at) in buffered_answers.items()
+        ])
@@ -0,0 +1,245 @@
+"""
+Compact archive of the finished tests.
+
+A finished test never changes, so its progress steps are packed into a single `FinishedTest` row: arrays of the
+question ids, timestamps and correctness bits, and the answers. The results of the archived tests are computed from
+that row and the question bank, without joining `progress_step`.
+
+Tests are archived when they are finished (unless `ARCHIVE_FINISHED_TESTS=0`). `compact_history.py` archives the
+tests finished before, and deletes the progress steps of the archived tests once the analytics have folded them.
+The item statistics read the answers of those tests from the archive.
+"""
+import array
+import datetime
+import json
+from typing import Iterator, NamedTuple, Optional
+from sqlalchemy import delete
+
+from backend.flow_logic import get_passed_levels_stats_for_users, process_stats
+from backend.logs import logger
+from backend.models import FinishedTest, ProgressStep, User, db_session
+from backend.question_bank import _to_little_endian, get_questions
+from backend.types import LanguageLevel, SummarizedStats, TopicSuccessData
+
+
+USERS_CHUNK_SIZE = 500
+# The offsets were stored as uint32 before, which overflows for a test longer than 49 days
+LEGACY_TIMESTAMP_OFFSETS_TYPECODE = 'I'
+TIMESTAMP_OFFSETS_TYPECODE = 'q'
+
+
+class InvalidTestSteps(ValueError):
+    """The steps of a test can't be archived, the test is left unarchived."""
+
+
+class ArchivedStep(NamedTuple):
+    step_number: int
+    question_id: int
+    timestamp: datetime.datetime
+    answer: Optional[str]
+    is_correct: bool
+
+
+def _pack_bits(bits: list[bool]) -> bytes:
+    packed = bytearray((len(bits) + 7) // 8)
+    for index, bit in enumerate(bits):
+        if bit:
+            packed[index >> 3] |= 1 << (index & 7)
+    return bytes(packed)
+
+
+def _unpack_bits(packed: bytes, count: int) -> list[bool]:
+    return [bool(packed[index >> 3] >> (index & 7) & 1) for index in range(count)]
+
+
+def pack_finished_test(user_id: int, steps: list[ArchivedStep]) -> FinishedTest:
+    """Packs the steps, which should be ordered by their numbers, going from 1 without gaps."""
+    if [step.step_number for step in steps] != list(range(1, len(steps) + 1)):
+        raise InvalidTestSteps(f'The steps of user {user_id} are not numbered from 1 without gaps')
+    # Answering a step updates its timestamp, so the first step is not necessarily the earliest one
+    started_at = min((step.timestamp for step in steps), default=datetime.datetime.utcnow())
+    timestamp_offsets = array.array(TIMESTAMP_OFFSETS_TYPECODE, [
+        round((step.timestamp - started_at) / datetime.timedelta(milliseconds=1)) for step in steps
+    ])
+    return FinishedTest(
+        user_id=user_id,
+        steps_count=len(steps),
+        started_at=started_at,
+        question_ids=_to_little_endian(array.array('i', [step.question_id for step in steps])).tobytes(),
+        timestamp_offsets=_to_little_endian(timestamp_offsets).tobytes(),
+        correctness=_pack_bits([bool(step.is_correct) for step in steps]),
+        answers=json.dumps([step.answer for step in steps], ensure_ascii=False),
+        steps_compacted=False,
+    )
+
+
+def unpack_finished_test(finished_test: FinishedTest) -> list[ArchivedStep]:
+    question_ids = array.array('i')
+    question_ids.frombytes(finished_test.question_ids)
+    legacy_offsets = len(finished_test.timestamp_offsets) < finished_test.steps_count * 8
+    timestamp_offsets = array.array(LEGACY_TIMESTAMP_OFFSETS_TYPECODE if legacy_offsets else TIMESTAMP_OFFSETS_TYPECODE)
+    timestamp_offsets.frombytes(finished_test.timestamp_offsets)
+    for column in (question_ids, timestamp_offsets):
+        _to_little_endian(column)  # Swapping back from little-endian
+    correctness = _unpack_bits(finished_test.correctness, finished_test.steps_count)
+    answers = json.loads(finished_test.answers)
+    return [
+        ArchivedStep(
+            step_number=index + 1,
+            question_id=question_ids[index],
+            timestamp=finished_test.started_at + datetime.timedelta(milliseconds=timestamp_offsets[index]),
+            answer=answers[index],
+            is_correct=correctness[index],
+        )
+        for index in range(finished_test.steps_count)
+    ]
+
+
+def archive_finished_test(user_id: int) -> Optional[FinishedTest]:
+    """
+    Adds the archive of the user's test to the session. The progress steps are kept. Returns None if the steps can't
+    be archived, then the results keep being read from the progress steps.
+    """
+    steps = [ArchivedStep(*row) for row in db_session.query(
+        ProgressStep.step_number,
+        ProgressStep.question_id,
+        ProgressStep.timestamp,
+        ProgressStep.answer,
+        ProgressStep.is_correct,
+    ).filter(
+        ProgressStep.user_id == user_id,
+    ).order_by(ProgressStep.step_number)]
+    try:
+        finished_test = pack_finished_test(user_id, steps)
+    except InvalidTestSteps as e:
+        logger.warning(f'Not archiving the test: {e}')
+        return None
+    db_session.add(finished_test)
+    return finished_test
+
+
+def get_finished_test(user: User) -> Optional[FinishedTest]:
+    if user.detected_level is None:
+        return None  # Only finished tests are archived
+    return db_session.get(FinishedTest, user.id)
+
+
+def compute_archived_summarized_stats(finished_test: FinishedTest, detected_level: LanguageLevel) -> SummarizedStats:
+    steps = unpack_finished_test(finished_test)
+    questions = get_questions(step.question_id for step in steps)
+    per_topic_counts: dict[tuple, list[int]] = {}
+    for step in steps:
+        question = questions.get(step.question_id)
+        if question is None:
+            continue  # Removed from the bank
+        counts = per_topic_counts.setdefault((question.category, question.topic_title), [0, 0])
+        counts[0] += 1
+        counts[1] += step.is_correct
+    per_topic_breakdown = [
+        TopicSuccessData(
+            category=category,
+            topic_title=topic_title,
+            questions_count=questions_count,
+            correct_answers_count=correct_answers_count,
+        )
+        # In the order the topics were met, as the steps are ordered by their numbers
+        for (category, topic_title), (questions_count, correct_answers_count) in per_topic_counts.items()
+    ]
+    return SummarizedStats(
+        detected_level=detected_level,
+        total_questions=sum(entry.questions_count for entry in per_topic_breakdown),
+        total_correct_answers=sum(entry.correct_answers_count for entry in per_topic_breakdown),
+        per_topic_breakdown=per_topic_breakdown,
+    )
+
+
+def iter_archived_passed_steps_rows(finished_test: FinishedTest) -> Iterator[tuple]:
+    """
+    Same rows as `iter_passed_steps_rows`, read from the archive.
+
+    The rows are read right away (a test has only a few dozen steps), since the ORM objects expire before a streamed
+    response is sent.
+    """
+    steps = unpack_finished_test(finished_test)
+    questions = get_questions(step.question_id for step in steps)
+    return iter([
+        (
+            question.question_title,
+            question.level,
+            question.answer_type,
+            question.answer_options,
+            question.filepath,
+            question.correct_answer,
+            step.answer,
+        )
+        for step in steps
+        if (question := questions.get(step.question_id)) is not None  # Unless removed from the bank
+    ])
+
+
+def iter_compacted_answers() -> Iterator[tuple]:
+    """
+    Yields (user_id, step_number, question_id, timestamp, is_correct, answer) of the answered steps that are only
+    stored in the archive, ordered by user and step number.
+    """
+    finished_tests_query = db_session.query(FinishedTest).filter(
+        FinishedTest.steps_compacted.is_(True),
+    ).order_by(FinishedTest.user_id).yield_per(USERS_CHUNK_SIZE)
+    for finished_test in finished_tests_query:
+        user_id = finished_test.user_id
+        for step_number, question_id, timestamp, answer, is_correct in unpack_finished_test(finished_test):
+            if answer is not None:
+                yield user_id, step_number, question_id, timestamp, is_correct, answer
+
+
+def archive_finished_tests() -> int:
+    """Archives the finished tests that haven't been archived yet. Returns the number of archived tests."""
+    archived_count = 0
+    last_user_id = 0
+    while True:
+        user_ids = [user_id for user_id, in db_session.query(User.id).outerjoin(
+            FinishedTest, FinishedTest.user_id == User.id,
+        ).filter(
+            User.id > last_user_id,
+            FinishedTest.user_id.is_(None),
+        ).order_by(User.id).limit(USERS_CHUNK_SIZE)]
+        if not user_ids:
+            return archived_count
+        last_user_id = user_ids[-1]
+
+        users = db_session.query(User).filter(User.id.in_(user_ids)).all()
+        # The detected level is not stored for the tests finished before it was introduced
+        legacy_stats = get_passed_levels_stats_for_users([user.id for user in users if user.detected_level is None])
+        for user in users:
+            if user.detected_level is None:
+                user.detected_level, _ = process_stats(legacy_stats[user.id])
+            if user.detected_level is not None and archive_finished_test(user.id) is not None:
+                archived_count += 1
+        db_session.commit()
+
+
+def compact_archived_steps() -> int:
+    """
+    Deletes the progress steps of the archived tests, that have been folded into the analytics aggregates.
+
+    Returns the number of compacted tests.
+    """
+    compacted_count = 0
+    while True:
+        user_ids = [user_id for user_id, in db_session.query(FinishedTest.user_id).filter(
+            FinishedTest.steps_compacted.is_(False),
+            ~db_session.query(ProgressStep).filter(
+                ProgressStep.user_id == FinishedTest.user_id,
+                ProgressStep.answer.isnot(None),
+                ProgressStep.analytics_folded.is_(False),
+            ).exists(),
+        ).order_by(FinishedTest.user_id).limit(USERS_CHUNK_SIZE)]
+        if not user_ids:
+            return compacted_count
+        db_session.execute(delete(ProgressStep).where(ProgressStep.user_id.in_(user_ids)))
+        db_session.query(FinishedTest).filter(FinishedTest.user_id.in_(user_ids)).update(
+            {FinishedTest.steps_compacted: True},
+            synchronize_session=False,
+        )
+        db_session.commit()
+        compacted_count += len(user_ids)
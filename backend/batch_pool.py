@@ -0,0 +1,122 @@
+"""
+Pool of pre-sampled level batches.
+
+A level batch is one random question of every (category, answer type, topic) group of a level. Sampling it requires
+reading all the questions of the level, so instead of doing it while the user waits for the next question, a
+background thread keeps up to `BATCH_POOL_DEPTH` batches per level ready, and refills the pool as batches are taken.
+
+Every batch is sampled independently and is handed out to exactly one user, so pre-sampling doesn't make the
+questions any less random. Batches older than `BATCH_POOL_MAX_AGE_SECONDS` are discarded, so that the changes of
+the question bank are picked up. With `BATCH_POOL_DEPTH=0` (the default) batches are sampled on demand.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+from flask import Flask
+
+from backend.logs import logger
+from backend.models import Question, db_session
+from backend.question_bank import question_bank
+from backend.types import LanguageLevel
+
+
+DEFAULT_MAX_AGE_SECONDS = 600
+
+
+def sample_question_ids(level: LanguageLevel) -> list[int]:
+    """Picks one random question of every group of the level. Groups are ordered by their first question."""
+    snapshot = question_bank.get_snapshot()
+    if snapshot is not None:
+        return [random.choice(question_ids) for question_ids in snapshot.level_groups(level)]
+
+    questions_query = db_session.query(
+        Question.id,
+        Question.category,
+        Question.answer_type,
+        Question.topic_title,
+    ).filter(
+        Question.level == level,
+    ).order_by(Question.id)
+
+    group_question_ids: dict[tuple, list[int]] = {}
+    for question_id, category, answer_type, topic_title in questions_query:
+        group_question_ids.setdefault((category, answer_type, topic_title), []).append(question_id)
+    return [random.choice(question_ids) for question_ids in group_question_ids.values()]
+
+
+class BatchPool:
+    def __init__(self, depth: int, max_age: float = DEFAULT_MAX_AGE_SECONDS):
+        self.depth = depth
+        self.max_age = max_age
+        self._batches: dict[LanguageLevel, deque[tuple[float, list[int]]]] = {
+            level: deque() for level in LanguageLevel
+        }
+        self._lock = threading.Lock()
+        self._needs_refill = threading.Event()
+        self._thread_pid: Optional[int] = None
+
+    def start(self, app: Flask) -> None:
+        """Starts the refill thread, once per process: a worker forked after `create_app` starts its own."""
+        if self.depth <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, args=(app,), name='batch-pool', daemon=True).start()
+        self._needs_refill.set()
+
+    def _run(self, app: Flask) -> None:
+        while True:
+            self._needs_refill.wait()
+            self._needs_refill.clear()
+            try:
+                with app.app_context():
+                    self.refill()
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+
+    def refill(self) -> None:
+        """Tops up the batches of every level. Must be called within an app context."""
+        for level in LanguageLevel:
+            while self.batches_count(level) < self.depth:
+                question_ids = sample_question_ids(level)
+                if not question_ids:
+                    break  # No questions of this level
+                with self._lock:
+                    self._batches[level].append((time.monotonic(), question_ids))
+
+    def batches_count(self, level: LanguageLevel) -> int:
+        with self._lock:
+            return len(self._batches[level])
+
+    def take_batch(self, level: LanguageLevel) -> list[int]:
+        """Returns the question ids of a new level batch, sampling it right away if the pool is empty."""
+        oldest_allowed_time = time.monotonic() - self.max_age
+        with self._lock:
+            batches = self._batches[level]
+            while batches and batches[0][0] < oldest_allowed_time:
+                batches.popleft()
+            batch = batches.popleft()[1] if batches else None
+        if self._thread_pid is not None:
+            self._needs_refill.set()
+        if batch is None:
+            batch = sample_question_ids(level)
+        return batch
+
+
+batch_pool = BatchPool(
+    depth=int(os.environ.get('BATCH_POOL_DEPTH', 0)),
+    max_age=float(os.environ.get('BATCH_POOL_MAX_AGE_SECONDS', DEFAULT_MAX_AGE_SECONDS)),
+)
+
+
+def init_batch_pool(app: Flask) -> None:
+    if batch_pool.depth <= 0:
+        return
+
+    # Started by the requests rather than here, as threads don't survive the fork of `gunicorn --preload`
+    @app.before_request
+    def start_batch_pool():
+        batch_pool.start(app)
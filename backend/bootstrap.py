@@ -0,0 +1,36 @@
+"""
+Initial state of the frontend, inlined into the served `index.html`.
+
+The page would otherwise call `/api/status` right after loading, before it can render anything. Instead, the status
+known from the session (see `get_cached_status` in `backend/rest_api.py`) is put into a
+`<script id="bootstrap" type="application/json">` element at the end of `<head>`, as `{"status": ...}`. The frontend
+reads it on the first render, and calls `/api/status` when the status is null (not known from the session).
+`index.html` is read once per build and split where the state is inserted.
+"""
+import os
+from functools import lru_cache
+from typing import Any
+from flask import current_app
+
+
+BOOTSTRAP_ELEMENT_ID = 'bootstrap'
+INSERTION_POINT = '</head>'
+
+
+@lru_cache(maxsize=4)
+def _read_index_html(path: str, _: int) -> tuple[str, str]:
+    """Returns the parts of `index.html` before and after the state. Cached by the modification time of the file."""
+    with open(path, encoding='utf-8') as file:
+        html = file.read()
+    insertion_index = html.find(INSERTION_POINT)
+    if insertion_index == -1:  # The deferred bundle still finds it at the end of the document
+        insertion_index = len(html)
+    return html[:insertion_index], html[insertion_index:]
+
+
+def render_index_html(build_dir: str, state: dict[str, Any]) -> str:
+    path = os.path.join(build_dir, 'index.html')
+    head, rest = _read_index_html(path, os.stat(path).st_mtime_ns)
+    # `<` is escaped, so that no string in the state can close the script element
+    state_json = current_app.json.dumps(state).replace('<', '\\u003c')
+    return f'{head}<script id="{BOOTSTRAP_ELEMENT_ID}" type="application/json">{state_json}</script>{rest}'
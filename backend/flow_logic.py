@@ -1,6 +1,8 @@
 from backend.types import (
     MAX_LANGUAGE_LEVEL,
     MIN_LANGUAGE_LEVEL,
+    NEXT_LANGUAGE_LEVEL,
+    PREVIOUS_LANGUAGE_LEVEL,
     LanguageLevel,
     PassedLevelStats,
     PassedStep,
@@ -8,15 +10,18 @@ from backend.types import (
     SummarizedStats,
     TopicSuccessData,
 )
-from typing import Iterable, Optional
-from sqlalchemy import func, Integer
+from typing import Iterable, Iterator, Optional
+from sqlalchemy import Row, func, Integer
 import sqlalchemy
 import random
-from backend.models import ProgressStep, Question, db_session
+from backend.models import ProgressStep, Question, User, db_session
 from backend.logs import logger
 from flask import session as flask_session
 
 
+PASSED_STEPS_CHUNK_SIZE = 500
+
+
 def get_questions_counts(level: LanguageLevel) -> Iterable[QuestionCountEntry]:
     questions_query = db_session.query(
         Question.category,
@@ -29,7 +34,7 @@ def get_questions_counts(level: LanguageLevel) -> Iterable[QuestionCountEntry]:
         Question.category,
         Question.answer_type,
         Question.topic_title,
-    )
+    ).order_by(func.min(Question.id))  # The order of the groups is not defined otherwise, and differs between DBs
     result = []
     for category, answer_type, topic_title, questions_count in questions_query:
         result.append(QuestionCountEntry(category, answer_type, topic_title, questions_count))
@@ -63,6 +68,16 @@ def generate_progress_steps_batch(
     flask_session['next_level_step_number'] = current_step_number + len(question_counts)
 
 
+def add_level_batch(question_ids: list[int], user_id: int, current_step_number: int) -> None:
+    """Adds the progress steps of a level batch, sampled by `sample_question_ids`, after the current step."""
+    db_session.add_all([
+        ProgressStep(user_id=user_id, step_number=step_number, question_id=question_id)
+        for step_number, question_id in enumerate(question_ids, start=current_step_number+1)
+    ])
+    db_session.commit()
+    flask_session['next_level_step_number'] = current_step_number + len(question_ids)
+
+
 def has_answered_pending_questions(user_id: int) -> bool:
     return db_session.query(ProgressStep).filter(
         ProgressStep.user_id == user_id,
@@ -70,6 +85,11 @@ def has_answered_pending_questions(user_id: int) -> bool:
     ).count() == 0
 
 
+def level_success_percentage():
+    # The average of the 0/1 values, as the division of two integers would be an integer division in SQLite
+    return func.round(func.avg(func.cast(ProgressStep.is_correct, Integer)) * 100)
+
+
 def get_passed_levels_stats(user_id: int) -> Optional[list[PassedLevelStats]]:
     has_unanswered_questions = db_session.query(ProgressStep).filter(
         ProgressStep.user_id == user_id,
@@ -81,7 +101,7 @@ def get_passed_levels_stats(user_id: int) -> Optional[list[PassedLevelStats]]:
 
     stats_query = db_session.query(
         Question.level,
-        func.round(func.sum(ProgressStep.is_correct) / func.count(ProgressStep.question_id) * 100),
+        level_success_percentage(),
         # func.min(ProgressStep.step_number).label('level_min_step_number'),
     ).join(ProgressStep).filter(
         ProgressStep.user_id == user_id,
@@ -94,6 +114,38 @@ def get_passed_levels_stats(user_id: int) -> Optional[list[PassedLevelStats]]:
     return result
 
 
+def get_passed_levels_stats_for_users(user_ids: list[int]) -> dict[int, Optional[list[PassedLevelStats]]]:
+    """Same as `get_passed_levels_stats`, but with two queries for all the given users instead of two per user."""
+    users_with_unanswered_questions = {user_id for user_id, in db_session.query(ProgressStep.user_id).filter(
+        ProgressStep.user_id.in_(user_ids),
+        ProgressStep.answer.is_(None),
+    ).distinct()}
+
+    stats_query = db_session.query(
+        ProgressStep.user_id,
+        Question.level,
+        level_success_percentage(),
+    ).join(ProgressStep).filter(
+        ProgressStep.user_id.in_(user_ids),
+    ).group_by(
+        ProgressStep.user_id,
+        Question.level,
+    ).order_by(
+        ProgressStep.user_id,
+        func.min(ProgressStep.step_number),
+    )
+
+    result: dict[int, Optional[list[PassedLevelStats]]] = {
+        user_id: None if user_id in users_with_unanswered_questions else [] for user_id in user_ids
+    }
+    for user_id, level, success_percentage in stats_query:
+        user_stats = result[user_id]
+        if user_stats is not None:
+            user_stats.append(PassedLevelStats(level, int(success_percentage)))
+
+    return result
+
+
 def process_stats(stats: Optional[list[PassedLevelStats]]) -> tuple[Optional[LanguageLevel], Optional[LanguageLevel]]:
     next_level: Optional[LanguageLevel] = None
     finished_with_level: Optional[LanguageLevel] = None
@@ -108,17 +160,27 @@ def process_stats(stats: Optional[list[PassedLevelStats]]) -> tuple[Optional[Lan
         if stats[-1].level == MAX_LANGUAGE_LEVEL:
             finished_with_level = MAX_LANGUAGE_LEVEL
         else:
-            next_level = LanguageLevel(stats[-1].level + 1)
+            next_level = NEXT_LANGUAGE_LEVEL[stats[-1].level]
     else:
         if stats[-1].level == MIN_LANGUAGE_LEVEL:
             finished_with_level = LanguageLevel.A0
         else:
-            next_level = stats[-1].level - 1
+            next_level = PREVIOUS_LANGUAGE_LEVEL[stats[-1].level]
 
     return finished_with_level, next_level
 
 
 
+def get_finished_level(user_id: int) -> Optional[LanguageLevel]:
+    """Returns the level detected for the user, or None if the user hasn't finished the test yet."""
+    detected_level = db_session.query(User.detected_level).filter(User.id == user_id).scalar()
+    if detected_level is not None:
+        return detected_level
+    # The detected level is not stored for the tests finished before it was introduced
+    finished_level, _ = process_stats(get_passed_levels_stats(user_id))
+    return finished_level
+
+
 def compute_summarized_stats(user_id: int) -> Optional[SummarizedStats]:
     """Compute per-topic results as well as total number of questions and correct answers."""
     per_topic_query = db_session.query(
@@ -128,7 +190,9 @@ def compute_summarized_stats(user_id: int) -> Optional[SummarizedStats]:
         func.sum(func.cast(ProgressStep.is_correct, Integer)),
     ).join(ProgressStep).filter(
         ProgressStep.user_id == user_id,
-    ).group_by(Question.category, Question.topic_title)
+    ).group_by(Question.category, Question.topic_title).order_by(
+        func.min(ProgressStep.step_number),  # In the order the topics were met, the same in every DB
+    )
     per_topic_breakdown = []
     total_questions = 0
     total_correct_answers = 0
@@ -137,14 +201,12 @@ def compute_summarized_stats(user_id: int) -> Optional[SummarizedStats]:
             category=category,
             topic_title=topic_title,
             questions_count=int(questions_count),
-            correct_answers_count=int(correct_answers_count),
+            correct_answers_count=int(correct_answers_count or 0),  # NULL while the questions are not answered
         ))
         total_questions += int(questions_count)
-        total_correct_answers += int(correct_answers_count)
+        total_correct_answers += int(correct_answers_count or 0)
 
-    if has_answered_pending_questions(user_id) is False:
-        return None
-    finished_level, _ = process_stats(get_passed_levels_stats(user_id))
+    finished_level = get_finished_level(user_id)
     if finished_level is None:
         return None
 
@@ -156,9 +218,12 @@ def compute_summarized_stats(user_id: int) -> Optional[SummarizedStats]:
     )
 
 
-def compute_detailed_stats(user_id: int) -> list[PassedStep]:
-    """Get all steps passed by the user, with the answers and expected correct answers."""
-    passed_steps_query = db_session.query(
+def iter_passed_steps_rows(user_id: int) -> Iterator[Row]:
+    """
+    Yields (question_title, level, answer_type, answer_options, filepath, correct_answer, given_answer) of all steps
+    passed by the user, streaming them from the DB.
+    """
+    return iter(db_session.query(
         Question.question_title,
         Question.level,
         Question.answer_type,
@@ -168,8 +233,11 @@ def compute_detailed_stats(user_id: int) -> list[PassedStep]:
         ProgressStep.answer,
     ).join(Question).filter(
         ProgressStep.user_id == user_id,
-    ).order_by(ProgressStep.step_number)
+    ).order_by(ProgressStep.step_number).yield_per(PASSED_STEPS_CHUNK_SIZE))
+
 
+def compute_detailed_stats(user_id: int) -> list[PassedStep]:
+    """Get all steps passed by the user, with the answers and expected correct answers."""
     passed_steps = []
     for (
         question_title,
@@ -179,7 +247,7 @@ def compute_detailed_stats(user_id: int) -> list[PassedStep]:
         filepath,
         correct_answer,
         given_answer,
-    ) in passed_steps_query:
+    ) in iter_passed_steps_rows(user_id):
         passed_steps.append(PassedStep(
             question_title=question_title,
             language_level=level,
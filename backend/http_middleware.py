@@ -0,0 +1,156 @@
+"""
+Response compression and HTTP caching.
+
+- Responses of compressible types larger than `COMPRESSION_MIN_SIZE` bytes are compressed with brotli (if the
+  `brotli` package is installed) or gzip, whichever the client prefers. Streamed responses are compressed on the fly.
+- Static files are served from their pre-compressed `.br`/`.gz` siblings when present (see `precompress_static.py`).
+  Fingerprinted static files (`main.3f2a1b9c.js`) are cached forever, the other ones are revalidated.
+- Results of finished tests never change, so they are cached for a short time and revalidated with an ETag.
+"""
+import gzip
+import mimetypes
+import os
+import re
+import zlib
+from typing import Callable, Iterable, Iterator, Optional
+from flask import Flask, Response, current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+
+DEFAULT_COMPRESSION_MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher qualities are too slow for compressing on the fly
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'application/manifest+json',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+}
+IMMUTABLE_MAX_AGE_SECONDS = 365 * 24 * 3600
+RESULTS_MAX_AGE_SECONDS = 60
+FINGERPRINTED_FILENAME_PATTERN = re.compile(r'\.[0-9a-f]{8,}\.')  # As produced by webpack (react-scripts)
+PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+def _supported_encodings() -> list[str]:
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def _negotiate_encoding(available_encodings: Iterable[str]) -> Optional[str]:
+    available_encodings = list(available_encodings)
+    if not available_encodings:
+        return None
+    return request.accept_encodings.best_match(available_encodings)
+
+
+def _compress_stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            compressed_chunk = compressor.process(chunk)
+            if compressed_chunk:
+                yield compressed_chunk
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        for chunk in chunks:
+            compressed_chunk = compressor.compress(chunk)
+            if compressed_chunk:
+                yield compressed_chunk
+        yield compressor.flush()
+
+
+def _compress_response(response: Response) -> Response:
+    if (
+        not 200 <= response.status_code < 300
+        or response.direct_passthrough  # Files, served by `send_file`
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding(_supported_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+    if response.get_etag()[0] is not None:
+        response.set_etag(response.get_etag()[0], weak=True)  # The bytes differ from the uncompressed ones
+    return response
+
+
+def _serve_static(filename: str) -> Response:
+    static_folder = current_app.static_folder
+    assert static_folder is not None
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    precompressed_encodings = {
+        encoding: filename + extension
+        for encoding, extension in PRECOMPRESSED_EXTENSIONS.items()  # Sending a .br file doesn't require brotli
+        if os.path.isfile(os.path.join(static_folder, filename + extension))
+    }
+    encoding = _negotiate_encoding(precompressed_encodings)
+    if encoding is not None:
+        response = send_from_directory(static_folder, precompressed_encodings[encoding], mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(static_folder, filename)
+    if precompressed_encodings:
+        response.vary.add('Accept-Encoding')
+
+    if FINGERPRINTED_FILENAME_PATTERN.search(os.path.basename(filename)):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE_SECONDS
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True  # Revalidated with the Last-Modified and ETag set by `send_file`
+    return response
+
+
+def make_result_response(etag: Optional[str], make_response: Callable[[], Response]) -> Response:
+    """
+    Caches the response for a short time and answers the revalidation requests without building the response.
+
+    `etag` should identify the content of the result, the response is not cached if it's None.
+    """
+    if etag is None:
+        response = make_response()
+        response.cache_control.no_store = True
+        return response
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response()
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = RESULTS_MAX_AGE_SECONDS
+    response.cache_control.must_revalidate = True
+    return response
+
+
+def init_http_middleware(app: Flask) -> None:
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', DEFAULT_COMPRESSION_MIN_SIZE))
+    if app.static_folder is not None and 'static' in app.view_functions:
+        app.view_functions['static'] = _serve_static
+    app.after_request(_compress_response)
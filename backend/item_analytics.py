@@ -0,0 +1,272 @@
+"""
+Item-level psychometrics over the whole answers history.
+
+Answered progress steps are streamed from the DB in chunks into columnar NumPy arrays, and question attributes are
+joined to them by a dense question index, so that every metric is computed with vectorized operations.
+"""
+from itertools import islice
+import json
+import threading
+from typing import Any, NamedTuple, Optional
+import numpy as np
+from sqlalchemy import func, select
+
+from backend.archive import iter_compacted_answers
+from backend.models import FinishedTest, ProgressStep, Question, db_session
+from backend.sharding import SHARD_USER_ID_STRIDE, iter_shards
+from backend.types import AnswerType, QuestionItemStats
+
+
+CHUNK_SIZE = 50_000
+MAX_ANSWER_SECONDS = 30 * 60  # Longer gaps between two answers are breaks rather than answering time
+MAX_OPTIONS_COUNT = 62  # Chosen options are stored as a bit mask in an int64
+
+
+class AnswerColumns(NamedTuple):
+    """Answered steps, ordered by user and step number."""
+    user_ids: np.ndarray
+    step_numbers: np.ndarray
+    question_ids: np.ndarray
+    timestamps: np.ndarray  # Seconds since the epoch
+    is_correct: np.ndarray
+    chosen_options: np.ndarray  # Bit mask of the chosen options, meaningful only for the select questions
+
+
+def _parse_chosen_options(answer: str) -> int:
+    """Converts '0' or '1,3' (indices of the chosen options) to a bit mask."""
+    mask = 0
+    for option in answer.split(','):
+        if option.isdigit() and int(option) < MAX_OPTIONS_COUNT:
+            mask |= 1 << int(option)
+    return mask
+
+
+def _empty_answer_columns() -> AnswerColumns:
+    return AnswerColumns(
+        user_ids=np.empty(0, dtype=np.int64),
+        step_numbers=np.empty(0, dtype=np.int64),
+        question_ids=np.empty(0, dtype=np.int64),
+        timestamps=np.empty(0, dtype=np.float64),
+        is_correct=np.empty(0, dtype=np.bool_),
+        chosen_options=np.empty(0, dtype=np.int64),
+    )
+
+
+def _rows_to_answer_columns(rows: list[Any], chosen_options_cache: dict[str, int]) -> AnswerColumns:
+    user_ids, step_numbers, question_ids, timestamps, is_correct, answers = zip(*rows)
+    chosen_options = []
+    for answer in answers:
+        mask = chosen_options_cache.get(answer)
+        if mask is None:
+            mask = chosen_options_cache[answer] = _parse_chosen_options(answer)
+        chosen_options.append(mask)
+    return AnswerColumns(
+        user_ids=np.array(user_ids, dtype=np.int64),
+        step_numbers=np.array(step_numbers, dtype=np.int64),
+        question_ids=np.array(question_ids, dtype=np.int64),
+        timestamps=np.array(timestamps, dtype='datetime64[us]').astype(np.int64) / 1e6,
+        is_correct=np.array([bool(value) for value in is_correct], dtype=np.bool_),
+        chosen_options=np.array(chosen_options, dtype=np.int64),
+    )
+
+
+def concatenate_answer_columns(chunks: list[AnswerColumns]) -> AnswerColumns:
+    if not chunks:
+        return _empty_answer_columns()
+    return AnswerColumns(*(np.concatenate(column_chunks) for column_chunks in zip(*chunks)))
+
+
+def load_answer_columns() -> AnswerColumns:
+    statement = select(
+        ProgressStep.user_id,
+        ProgressStep.step_number,
+        ProgressStep.question_id,
+        ProgressStep.timestamp,
+        ProgressStep.is_correct,
+        ProgressStep.answer,
+    ).where(
+        ProgressStep.answer.isnot(None),
+    ).order_by(
+        ProgressStep.user_id,
+        ProgressStep.step_number,
+    ).execution_options(yield_per=CHUNK_SIZE)
+
+    chosen_options_cache: dict[str, int] = {}  # Only a few distinct answers for the select questions
+    chunks = [
+        _rows_to_answer_columns(rows, chosen_options_cache)
+        for rows in db_session.execute(statement).partitions()
+    ]
+    # The steps of the compacted tests are only in the archive. Each user is in only one of the sources, so the
+    # answers of every user stay contiguous and ordered by step number.
+    compacted_answers = iter_compacted_answers()
+    while rows := list(islice(compacted_answers, CHUNK_SIZE)):
+        chunks.append(_rows_to_answer_columns(rows, chosen_options_cache))
+    return concatenate_answer_columns(chunks)
+
+
+def load_all_shards_answer_columns() -> AnswerColumns:
+    """Answers of every shard, with the user ids of a shard offset by `SHARD_USER_ID_STRIDE` to keep them unique."""
+    chunks = []
+    for shard_index in iter_shards():
+        columns = load_answer_columns()
+        chunks.append(columns._replace(user_ids=columns.user_ids + shard_index * SHARD_USER_ID_STRIDE))
+    return concatenate_answer_columns(chunks)
+
+
+def _group_medians(group_indices: np.ndarray, values: np.ndarray, groups_count: int) -> np.ndarray:
+    medians = np.full(groups_count, np.nan)
+    if len(values) == 0:
+        return medians
+    order = np.lexsort((values, group_indices))
+    sorted_groups, sorted_values = group_indices[order], values[order]
+    groups, starts, counts = np.unique(sorted_groups, return_index=True, return_counts=True)
+    lower_middles = sorted_values[starts + (counts - 1) // 2]
+    upper_middles = sorted_values[starts + counts // 2]
+    medians[groups] = (lower_middles + upper_middles) / 2
+    return medians
+
+
+def _optional_round(value: float, digits: int = 3) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), digits)
+
+
+def compute_item_stats(columns: AnswerColumns, questions: list[Any]) -> list[QuestionItemStats]:
+    """
+    Computes per-question statistics.
+
+    `questions` are rows of (id, level, category, topic_title, answer_type, answer_options).
+    """
+    questions_count = len(questions)
+    question_ids = np.array([question[0] for question in questions], dtype=np.int64)
+    index_by_question_id = np.full(int(question_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+    index_by_question_id[question_ids] = np.arange(questions_count)
+
+    # Drop answers to the questions that are not in the bank anymore
+    known = columns.question_ids < len(index_by_question_id)
+    known[known] = index_by_question_id[columns.question_ids[known]] >= 0
+    columns = AnswerColumns(*(column[known] for column in columns))
+    question_indices = index_by_question_id[columns.question_ids]
+    correct = columns.is_correct.astype(np.float64)
+
+    answers_counts = np.bincount(question_indices, minlength=questions_count)
+    correct_counts = np.bincount(question_indices, weights=correct, minlength=questions_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        difficulties = correct_counts / answers_counts
+
+    # Discrimination: correlation between the answer correctness and the share of the user's other correct answers
+    _, user_indices = np.unique(columns.user_ids, return_inverse=True)
+    user_answers_counts = np.bincount(user_indices)
+    user_correct_counts = np.bincount(user_indices, weights=correct)
+    rest_counts = user_answers_counts[user_indices] - 1
+    has_rest = rest_counts > 0
+    x = correct[has_rest]
+    y = (user_correct_counts[user_indices][has_rest] - x) / rest_counts[has_rest]
+    rest_question_indices = question_indices[has_rest]
+
+    def sums(weights: np.ndarray) -> np.ndarray:
+        return np.bincount(rest_question_indices, weights=weights, minlength=questions_count)
+    n = sums(np.ones_like(x))
+    sum_x, sum_y, sum_xy, sum_xx, sum_yy = sums(x), sums(y), sums(x * y), sums(x * x), sums(y * y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        discriminations = (n * sum_xy - sum_x * sum_y) / np.sqrt((n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2))
+
+    # Answering time: the gap after the previous answer of the same user
+    gaps = np.diff(columns.timestamps)
+    is_valid_gap = (
+        (columns.user_ids[1:] == columns.user_ids[:-1])
+        & (columns.step_numbers[1:] == columns.step_numbers[:-1] + 1)
+        & (gaps > 0)
+        & (gaps <= MAX_ANSWER_SECONDS)
+    )
+    gap_question_indices = question_indices[1:][is_valid_gap]
+    gaps = gaps[is_valid_gap]
+    gaps_counts = np.bincount(gap_question_indices, minlength=questions_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_gaps = np.bincount(gap_question_indices, weights=gaps, minlength=questions_count) / gaps_counts
+    median_gaps = _group_medians(gap_question_indices, gaps, questions_count)
+
+    # Option choice rates of the select questions
+    options_counts = np.zeros(questions_count, dtype=np.int64)
+    for question_index, question in enumerate(questions):
+        if question[4] in (AnswerType.SELECT_ONE, AnswerType.SELECT_MULTIPLE) and question[5] is not None:
+            options_counts[question_index] = min(len(json.loads(question[5])), MAX_OPTIONS_COUNT)
+    is_select_answer = options_counts[question_indices] > 0
+    select_question_indices = question_indices[is_select_answer]
+    select_chosen_options = columns.chosen_options[is_select_answer]
+    option_choice_counts = np.stack([
+        np.bincount(
+            select_question_indices,
+            weights=(select_chosen_options >> option) & 1,
+            minlength=questions_count,
+        ) for option in range(int(options_counts.max(initial=0)))
+    ], axis=1) if options_counts.any() else np.zeros((questions_count, 0))
+
+    item_stats = []
+    for question_index, (question_id, level, category, topic_title, answer_type, _) in enumerate(questions):
+        answers_count = int(answers_counts[question_index])
+        option_choice_rates = None
+        if options_counts[question_index] > 0 and answers_count > 0:
+            option_choice_rates = [
+                round(float(count) / answers_count, 3)
+                for count in option_choice_counts[question_index, :options_counts[question_index]]
+            ]
+        item_stats.append(QuestionItemStats(
+            question_id=question_id,
+            level=level,
+            category=category,
+            topic_title=topic_title,
+            answer_type=answer_type,
+            answers_count=answers_count,
+            difficulty=_optional_round(difficulties[question_index]),
+            discrimination=_optional_round(discriminations[question_index]),
+            option_choice_rates=option_choice_rates,
+            mean_answer_seconds=_optional_round(mean_gaps[question_index], 1),
+            median_answer_seconds=_optional_round(median_gaps[question_index], 1),
+        ))
+    return item_stats
+
+
+def load_questions() -> list[Any]:
+    return db_session.query(
+        Question.id,
+        Question.level,
+        Question.category,
+        Question.topic_title,
+        Question.answer_type,
+        Question.answer_options,
+    ).order_by(
+        Question.level,
+        Question.category,
+        Question.topic_title,
+        Question.id,
+    ).all()
+
+
+_cache_lock = threading.Lock()
+_cached_item_stats: Optional[tuple[tuple, list[QuestionItemStats]]] = None
+
+
+def _get_item_stats_cache_key() -> tuple:
+    answers_count, last_answer_timestamp = db_session.query(
+        func.count(ProgressStep.question_id),
+        func.max(ProgressStep.timestamp),
+    ).filter(
+        ProgressStep.answer.isnot(None),
+    ).one()
+    questions_count, max_question_id = db_session.query(func.count(Question.id), func.max(Question.id)).one()
+    compacted_tests_count = db_session.query(func.count(FinishedTest.user_id)).filter(
+        FinishedTest.steps_compacted.is_(True),
+    ).scalar()
+    return answers_count, last_answer_timestamp, questions_count, max_question_id, compacted_tests_count
+
+
+def get_item_stats() -> list[QuestionItemStats]:
+    """Returns the per-question statistics, recomputing them only if new answers have arrived since the last call."""
+    global _cached_item_stats
+    cache_key = tuple(_get_item_stats_cache_key() for _ in iter_shards())
+    with _cache_lock:
+        if _cached_item_stats is not None and _cached_item_stats[0] == cache_key:
+            return _cached_item_stats[1]
+        item_stats = compute_item_stats(load_all_shards_answer_columns(), load_questions())
+        _cached_item_stats = (cache_key, item_stats)
+    return item_stats
@@ -0,0 +1,156 @@
+"""
+JSON provider of the app: orjson when it's installed, the stdlib `json` otherwise.
+
+Both encoders serialize enums as their values and datetimes in the ISO 8601 format, and embed `JSONFragment`s
+(already encoded JSON) as is, without escaping them again: as `orjson.Fragment`s when orjson supports them, otherwise
+the containers of a payload with fragments are encoded by concatenating their encoded items.
+"""
+import datetime
+import enum
+import json
+from typing import Any, Callable, Optional
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider, _default as _flask_default
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None  # type: ignore[assignment]
+
+
+class JSONFragment:
+    """Already encoded JSON, which is inserted into the output verbatim."""
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded: str):
+        self.encoded = encoded
+
+
+class _FragmentFound(Exception):
+    """Stops an encoder that can't embed fragments, the payload is then encoded by `_join_fragments`."""
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, tuple):  # orjson doesn't serialize tuple subclasses, e.g. NamedTuples
+        return list(value)
+    return _flask_default(value)
+
+
+def _raising_default(value: Any) -> Any:
+    if isinstance(value, JSONFragment):
+        raise _FragmentFound()
+    return _default(value)
+
+
+def _orjson_fragment_default(value: Any) -> Any:
+    if isinstance(value, JSONFragment):
+        return orjson.Fragment(value.encoded)
+    return _default(value)
+
+
+def _decoding_default(value: Any) -> Any:
+    # Used for the formatted output, so that the fragments are formatted as well
+    if isinstance(value, JSONFragment):
+        return json.loads(value.encoded)
+    return _default(value)
+
+
+def _join_fragments(obj: Any, encode: Callable[[Any], str], sort_keys: bool) -> str:
+    """
+    Encodes the containers by concatenating the encoded items, with the fragments as they are. `encode` must produce
+    compact JSON and raise `_FragmentFound` on a fragment.
+    """
+    if isinstance(obj, JSONFragment):
+        return obj.encoded
+    if isinstance(obj, dict):
+        items = sorted(obj.items(), key=lambda item: item[0]) if sort_keys else obj.items()
+        # The key is encoded as in a dict, which converts the keys that are not strings
+        return '{' + ','.join(
+            f'{encode({key: None})[1:-len(":null}")]}:{_join_fragments(value, encode, sort_keys)}'
+            for key, value in items
+        ) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ','.join(_join_fragments(item, encode, sort_keys) for item in obj) + ']'
+    try:
+        return encode(obj)
+    except _FragmentFound:  # A fragment within an object converted by the default
+        return _join_fragments(_default(obj), encode, sort_keys)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(_default)  # type: ignore[assignment]
+
+    def __init__(self, app: Flask, use_orjson: Optional[bool] = None):
+        super().__init__(app)
+        self.use_orjson = orjson is not None if use_orjson is None else use_orjson
+
+    def _encode_orjson(self, obj: Any) -> str:
+        options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if hasattr(orjson, 'Fragment'):  # orjson 3.9.11 and later
+            return orjson.dumps(obj, default=_orjson_fragment_default, option=options).decode()
+
+        fragments_found: list[bool] = []
+
+        def default(value: Any) -> Any:
+            if isinstance(value, JSONFragment):
+                fragments_found.append(True)  # orjson raises its own error, without the cause
+            return _raising_default(value)
+
+        def encode(value: Any) -> str:
+            try:
+                return orjson.dumps(value, default=default, option=options).decode()
+            except orjson.JSONEncodeError:
+                if not fragments_found:
+                    raise
+                fragments_found.clear()
+                raise _FragmentFound() from None
+        try:
+            return encode(obj)
+        except _FragmentFound:
+            return _join_fragments(obj, encode, self.sort_keys)
+
+    def _encode_stdlib(self, obj: Any) -> str:
+        def encode(value: Any) -> str:
+            return json.dumps(
+                value,
+                default=_raising_default,
+                ensure_ascii=self.ensure_ascii,
+                sort_keys=self.sort_keys,
+                separators=(',', ':'),
+            )
+        try:
+            return encode(obj)
+        except _FragmentFound:
+            return _join_fragments(obj, encode, self.sort_keys)
+
+    def _encode(self, obj: Any) -> str:
+        return self._encode_orjson(obj) if self.use_orjson else self._encode_stdlib(obj)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:  # Formatting options are supported only by the stdlib encoder
+            kwargs.setdefault('default', _decoding_default)
+            kwargs.setdefault('ensure_ascii', self.ensure_ascii)
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            return json.dumps(obj, **kwargs)
+        return self._encode(obj)
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if self.use_orjson and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)  # Indented output
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(f'{self._encode(obj)}\n', mimetype=self.mimetype)
+
+
+def init_json_provider(app: Flask) -> None:
+    app.json = FastJSONProvider(app)
@@ -0,0 +1,463 @@
+"""
+In-process metrics registry with Prometheus text exposition.
+
+When several worker processes serve the app, set `METRICS_MULTIPROC_DIR` to a directory shared by all workers.
+Each worker then periodically dumps its values into its own file there, named by its pid and start time, so that a
+new worker reusing a pid doesn't overwrite the file of an exited one. The exposition endpoint sums the values of all
+the files. The files of exited workers are merged into a single tombstone file, so that counters never go backwards
+and the number of files stays bounded.
+
+The endpoint requires the admin password as a bearer token (`authorization: {credentials: ...}` in the Prometheus
+scrape config).
+"""
+import abc
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Optional
+from flask import Flask, Response, g, request
+from sqlalchemy import func
+
+from backend.logs import logger
+from backend.models import ProgressStep, db_session
+from backend.sharding import iter_shards
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+FLUSH_INTERVAL_SECONDS = 1.0
+
+LabelValues = tuple[str, ...]
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(abc.ABC):
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _check_labels(self, label_values: LabelValues) -> LabelValues:
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {label_values}')
+        return tuple(str(value) for value in label_values)
+
+    @abc.abstractmethod
+    def dump(self) -> dict:
+        """Returns the values of the current process, in a JSON-serializable form."""
+
+    @staticmethod
+    @abc.abstractmethod
+    def merge(merged: dict, dumped: dict) -> None:
+        """Adds the dumped values of a process to the merged ones."""
+
+    @abc.abstractmethod
+    def expose(self, merged_values: dict) -> list[str]:
+        """Returns the exposition lines of the merged values."""
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        key = self._check_labels(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        REGISTRY.mark_dirty()
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._values.items()}
+
+    @staticmethod
+    def merge(merged: dict, dumped: dict) -> None:
+        for key, value in dumped.items():
+            merged[key] = merged.get(key, 0) + value
+
+    def expose(self, merged_values: dict) -> list[str]:
+        lines = []
+        for key, value in sorted(merged_values.items()):
+            labels = _format_labels(self.label_names, tuple(json.loads(key)))
+            lines.append(f'{self.name}{labels} {_format_value(value)}')
+        return lines
+
+
+class Gauge(Counter):
+    """
+    A gauge which is either set explicitly or computed by `callback` at the collection time.
+
+    Set values are summed over the worker processes. Callback values are computed only by the process serving
+    the exposition, so the callback should read shared state (e.g. the DB). A callback value is reused for
+    `cache_seconds`, so that an expensive callback runs at most once per scrape interval.
+    """
+    type_name = 'gauge'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple[str, ...] = (),
+            callback: Optional[Callable[[], float]] = None,
+            cache_seconds: float = 0,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.callback = callback
+        self.cache_seconds = cache_seconds
+        self._cached_value: Optional[tuple[float, float]] = None  # (monotonic time, value)
+
+    def _get_callback_value(self) -> float:
+        assert self.callback is not None
+        now = time.monotonic()
+        with self._lock:
+            cached_value = self._cached_value
+        if cached_value is not None and now - cached_value[0] < self.cache_seconds:
+            return cached_value[1]
+        value = self.callback()
+        with self._lock:
+            self._cached_value = (now, value)
+        return value
+
+    def set(self, *label_values: str, value: float) -> None:
+        key = self._check_labels(label_values)
+        with self._lock:
+            self._values[key] = value
+        REGISTRY.mark_dirty()
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def dump(self) -> dict:
+        if self.callback is not None:
+            return {}
+        return super().dump()
+
+    def expose(self, merged_values: dict) -> list[str]:
+        if self.callback is not None:
+            try:
+                merged_values = {json.dumps(()): self._get_callback_value()}
+            except Exception as e:
+                logger.exception(e)
+                return []
+        return super().expose(merged_values)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+        # Per label values: [count per bucket (non-cumulative, the last one is +Inf), sum of observations]
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, *label_values: str, value: float) -> None:
+        key = self._check_labels(label_values)
+        bucket_index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][bucket_index] += 1
+            entry[1][0] += value
+        REGISTRY.mark_dirty()
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {json.dumps(key): [list(counts), total[0]] for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def merge(merged: dict, dumped: dict) -> None:
+        for key, (counts, total) in dumped.items():
+            if key not in merged:
+                merged[key] = [list(counts), total]
+                continue
+            merged_counts = merged[key][0]
+            for index, count in enumerate(counts):
+                merged_counts[index] += count
+            merged[key][1] += total
+
+    def expose(self, merged_values: dict) -> list[str]:
+        lines = []
+        for key, (counts, total) in sorted(merged_values.items()):
+            label_values = tuple(json.loads(key))
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative_count += count
+                labels = _format_labels(self.label_names, label_values, f'le="{_format_value(upper_bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative_count}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative_count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.multiproc_dir: Optional[Path] = None
+        self._dirty = threading.Event()
+        self._flusher_pid: Optional[int] = None  # Of the process that runs the flusher thread
+
+    def register(self, metric: Metric) -> None:
+        self.metrics[metric.name] = metric
+
+    def mark_dirty(self) -> None:
+        self._dirty.set()
+
+    def enable_multiprocess(self, directory: Path) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self.multiproc_dir = directory
+
+    def start_flusher(self) -> None:
+        """Starts the flusher thread, once per process: a worker forked after `create_app` starts its own."""
+        if self.multiproc_dir is None or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name='metrics-flusher', daemon=True).start()
+
+    def _process_file(self) -> Path:
+        assert self.multiproc_dir is not None
+        pid = os.getpid()
+        return self.multiproc_dir / f'metrics-{pid}-{_get_process_start_time(pid) or PROCESS_START_TIME}.json'
+
+    def dump(self) -> dict[str, dict]:
+        return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    def flush(self) -> None:
+        """Atomically writes the values of the current process into its file in the shared directory."""
+        self._dirty.clear()
+        process_file = self._process_file()
+        temporary_file = process_file.with_suffix('.tmp')
+        temporary_file.write_text(json.dumps(self.dump()))
+        os.replace(temporary_file, process_file)
+
+    def _flush_periodically(self) -> None:
+        while True:
+            self._dirty.wait()
+            try:
+                self.flush()
+            except OSError as e:
+                logger.exception(e)
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+
+    def _merge_dumps(self, dumps: list[dict[str, dict]]) -> dict[str, dict]:
+        merged: dict[str, dict] = {name: {} for name in self.metrics}
+        for dumped in dumps:
+            for name, values in dumped.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                metric.merge(merged[name], values)
+        return merged
+
+    def _read_tombstone(self) -> dict:
+        assert self.multiproc_dir is not None
+        try:
+            return json.loads((self.multiproc_dir / TOMBSTONE_FILE_NAME).read_text())
+        except FileNotFoundError:
+            return {'merged_files': [], 'metrics': {}}
+
+    def merge_exited_workers(self) -> None:
+        """Merges the files of the exited worker processes into the tombstone file, and deletes them."""
+        assert self.multiproc_dir is not None
+        exited_worker_files = [
+            process_file for process_file in self.multiproc_dir.glob('metrics-*-*.json')
+            if not _is_process_alive(*process_file.stem.split('-')[1:3])
+        ]
+        if not exited_worker_files:
+            return
+        with open(self.multiproc_dir / 'tombstone.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # The workers serving concurrent scrapes merge one at a time
+            tombstone = self._read_tombstone()
+            # The files merged before a crash that left them behind are not counted again
+            merged_files = set(tombstone['merged_files'])
+            dumps = [tombstone['metrics']]
+            newly_merged_files = []
+            for process_file in exited_worker_files:
+                if process_file.name in merged_files:
+                    continue
+                try:
+                    dumps.append(json.loads(process_file.read_text()))
+                except FileNotFoundError:
+                    continue  # Merged by another worker
+                newly_merged_files.append(process_file)
+            existing_merged_files = [
+                name for name in merged_files if (self.multiproc_dir / name).exists()
+            ] + [process_file.name for process_file in newly_merged_files]
+            temporary_file = self.multiproc_dir / f'{TOMBSTONE_FILE_NAME}.tmp'
+            temporary_file.write_text(json.dumps({
+                'merged_files': existing_merged_files,
+                'metrics': self._merge_dumps(dumps),
+            }))
+            os.replace(temporary_file, self.multiproc_dir / TOMBSTONE_FILE_NAME)
+            for process_file in exited_worker_files:
+                process_file.unlink(missing_ok=True)
+
+    def collect(self) -> dict[str, dict]:
+        """Returns the values of all the metrics, summed over all the worker processes."""
+        if self.multiproc_dir is None:
+            return self.dump()
+
+        try:
+            self.merge_exited_workers()
+        except (OSError, ValueError) as e:
+            logger.exception(e)
+        own_file = self._process_file()
+        tombstone = self._read_tombstone()
+        merged_files = set(tombstone['merged_files'])
+        dumps = [self.dump(), tombstone['metrics']]
+        for process_file in self.multiproc_dir.glob('metrics-*-*.json'):
+            if process_file == own_file or process_file.name in merged_files:
+                continue
+            try:
+                dumps.append(json.loads(process_file.read_text()))
+            except (OSError, ValueError):
+                continue  # The file is being replaced, the values will be picked up by the next scrape
+        return self._merge_dumps(dumps)
+
+    def generate_text(self) -> str:
+        collected = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type_name}')
+            lines.extend(metric.expose(collected.get(name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+TOMBSTONE_FILE_NAME = 'tombstone.json'
+PROCESS_START_TIME = time.time_ns()  # Where the start time of the processes is not known from /proc
+
+
+def _get_process_start_time(pid: int) -> Optional[str]:
+    """Returns the start time of the process (in clock ticks since boot) on Linux, None elsewhere."""
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+    # The fields after the command name, which may contain spaces, the start time is the 22nd field
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+
+def _is_process_alive(pid: str, start_time: str) -> bool:
+    if not pid.isdigit():
+        return True
+    current_start_time = _get_process_start_time(int(pid))
+    if current_start_time is not None:
+        return current_start_time == start_time  # Otherwise the pid was reused
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = MetricsRegistry()
+
+request_duration_seconds = Histogram(
+    'mooi_http_request_duration_seconds',
+    'Time spent processing a request.',
+    ('endpoint', 'method', 'status'),
+)
+tests_started_total = Counter('mooi_tests_started_total', 'Tests started, per start level.', ('level',))
+tests_finished_total = Counter('mooi_tests_finished_total', 'Tests finished, per detected level.', ('level',))
+process_stats_outcomes_total = Counter(
+    'mooi_process_stats_outcomes_total',
+    'Outcomes of grading a level: the test was finished or the user moved to the next level.',
+    ('outcome', 'level'),
+)
+answers_total = Counter('mooi_answers_total', 'Graded answers.', ('correct',))
+
+
+ACTIVE_TEST_SESSION_WINDOW = datetime.timedelta(minutes=30)
+# The gauge queries every shard, it's computed at most once per (typical) scrape interval
+ACTIVE_TEST_SESSIONS_CACHE_SECONDS = float(os.environ.get('METRICS_ACTIVE_TEST_SESSIONS_CACHE_SECONDS', 15))
+
+
+def count_active_test_sessions() -> int:
+    """Counts users that have unanswered questions in a level batch generated within the last 30 minutes."""
+    cutoff = datetime.datetime.utcnow() - ACTIVE_TEST_SESSION_WINDOW
+    return sum(db_session.query(func.count(func.distinct(ProgressStep.user_id))).filter(
+        ProgressStep.answer.is_(None),
+        ProgressStep.timestamp >= cutoff,
+    ).scalar() for _ in iter_shards())
+
+
+active_test_sessions = Gauge(
+    'mooi_active_test_sessions',
+    'Tests with unanswered questions in a level started within the last 30 minutes.',
+    callback=count_active_test_sessions,
+    cache_seconds=ACTIVE_TEST_SESSIONS_CACHE_SECONDS,
+)
+
+for _metric in (
+    request_duration_seconds,
+    tests_started_total,
+    tests_finished_total,
+    process_stats_outcomes_total,
+    answers_total,
+    active_test_sessions,
+):
+    REGISTRY.register(_metric)
+
+
+def _start_request_timer() -> None:
+    g.metrics_request_start_time = time.perf_counter()
+
+
+def _observe_request_duration(response: Response) -> Response:
+    start_time = g.pop('metrics_request_start_time', None)
+    if start_time is not None:
+        request_duration_seconds.observe(
+            request.endpoint or 'unknown',
+            request.method,
+            str(response.status_code),
+            value=time.perf_counter() - start_time,
+        )
+    return response
+
+
+def init_metrics(app: Flask) -> None:
+    metrics_multiproc_dir = os.environ.get('METRICS_MULTIPROC_DIR')
+    if metrics_multiproc_dir:
+        REGISTRY.enable_multiprocess(Path(metrics_multiproc_dir))
+        # Per worker process: a thread started before `gunicorn --preload` forks the workers only runs in the master
+        app.before_request(REGISTRY.start_flusher)
+    app.before_request(_start_request_timer)
+    app.after_request(_observe_request_duration)
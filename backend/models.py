@@ -8,18 +8,32 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import scoped_session
 from flask_sqlalchemy.session import Session as SqlAlchemySession
 from sqlalchemy.orm import mapped_column, Mapped, relationship
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import ForeignKey, LargeBinary, SmallInteger, String, Table, Text, TypeDecorator, event
+from sqlalchemy.engine import Connection
 from typing_extensions import Annotated
 
-from backend.types import AnswerType, LanguageLevel, QuestionCategory
+from backend.sharding import ShardedSession
+from backend.types import AnswerType, LanguageLevel, QuestionCategory, language_level_from_value
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardedSession})  # Routes the users' data to their shards
 dbModel: Any = db.Model  # doing this to avoid db.Model not defined error
 db_session: scoped_session[SqlAlchemySession] = db.session
 IntegerPrimaryKey = Annotated[int, mapped_column(primary_key=True)]
 
 
+class LanguageLevelType(TypeDecorator):
+    """Stores a `LanguageLevel` as its value in a SMALLINT column, so that levels are compared and sorted as numbers."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value: Optional[LanguageLevel], dialect) -> Optional[int]:
+        return None if value is None else value.value
+
+    def process_result_value(self, value: Optional[int], dialect) -> Optional[LanguageLevel]:
+        return None if value is None else language_level_from_value(value)
+
+
 def hard_reset_db(app: Flask):
     with app.app_context():
         metadata = db.MetaData()
@@ -33,7 +47,7 @@ class Question(dbModel):
     # # Improve: make sure that group_index is unique for each level/category/topic,
     # # starts from 0 and is continuous (e.g. count(group_index) == max(group_index) + 1)
     # group_index: Mapped[int]
-    level: Mapped['LanguageLevel']
+    level: Mapped['LanguageLevel'] = mapped_column(LanguageLevelType(), index=True)
     category: Mapped['QuestionCategory']
     topic_title: Mapped[str] = mapped_column(String(200))  # ignored for reading and listening
 
@@ -72,6 +86,8 @@ class Question(dbModel):
 class UserAnalytics(dbModel):
     uuid: Mapped[str] = mapped_column(String(200), default=lambda: str(uuid.uuid4()), primary_key=True)
     timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    # Set once counted in the analytics aggregates
+    analytics_folded: Mapped[bool] = mapped_column(default=False, index=True)
 
 
 class User(dbModel):
@@ -85,17 +101,92 @@ class User(dbModel):
     full_name: Mapped[str] = mapped_column(String(200))
 
     # Progress in the test
-    start_level: Mapped['LanguageLevel']
+    start_level: Mapped['LanguageLevel'] = mapped_column(LanguageLevelType())
     choosed_dont_know_level: Mapped[bool]
+    # Set when the test is finished, added to existing databases by migrate_levels.py
+    detected_level: Mapped[Optional['LanguageLevel']] = mapped_column(LanguageLevelType())
+    # Set once counted in the started tests of the analytics aggregates
+    analytics_folded: Mapped[bool] = mapped_column(default=False, index=True)
 
 
 class ProgressStep(dbModel):
     user_id: Mapped[IntegerPrimaryKey] = mapped_column(ForeignKey('user.id'))
     user: Mapped['User'] = relationship()
     step_number: Mapped[IntegerPrimaryKey]
-    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+    # Time of the creation of the step, and then of the answer to it
+    timestamp: Mapped[datetime.datetime] = mapped_column(
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+        index=True,  # Used by the retention and the metrics
+    )
 
     question_id: Mapped[int] = mapped_column(ForeignKey('question.id'))
     question: Mapped['Question'] = relationship()
     answer: Mapped[Optional[str]] = mapped_column(String(200))
     is_correct: Mapped[Optional[bool]]  # Used to reduce the complexity of the queries when querying correct answers
+    # Set once the answer is counted in the analytics aggregates. An answer is never changed once it's given.
+    analytics_folded: Mapped[bool] = mapped_column(default=False, index=True)
+
+
+class FinishedTest(dbModel):
+    """
+    Progress steps of a finished test, packed into a single row (see `backend.archive`).
+
+    Steps are stored in the order of their numbers, which go from 1 without gaps.
+    """
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    steps_count: Mapped[int]
+    started_at: Mapped[datetime.datetime]
+    question_ids: Mapped[bytes] = mapped_column(LargeBinary)  # Little-endian int32
+    timestamp_offsets: Mapped[bytes] = mapped_column(LargeBinary)  # Little-endian int64, milliseconds after started_at
+    correctness: Mapped[bytes] = mapped_column(LargeBinary)  # One bit per step, least significant bit first
+    answers: Mapped[str] = mapped_column(Text)  # JSON array
+    # Set once the progress steps of the test have been deleted by `compact_history.py`
+    steps_compacted: Mapped[bool] = mapped_column(default=False, index=True)
+
+
+class AnalyticsWatermark(dbModel):
+    """
+    Totals of the rows folded into the persisted analytics aggregates. The folded rows are flagged with
+    `analytics_folded`.
+
+    The table has a single row, with the id `ANALYTICS_WATERMARK_ID`, inserted when the table is created. Refreshes
+    of the aggregates lock it, so that they run one at a time.
+    """
+    id: Mapped[IntegerPrimaryKey]
+    page_opened_count: Mapped[int] = mapped_column(default=0)
+    started_the_test_count: Mapped[int] = mapped_column(default=0)
+
+
+ANALYTICS_WATERMARK_ID = 1
+
+
+@event.listens_for(AnalyticsWatermark.__table__, 'after_create')
+def _insert_analytics_watermark(table: Table, connection: Connection, **_: Any) -> None:
+    connection.execute(table.insert().values(id=ANALYTICS_WATERMARK_ID, page_opened_count=0, started_the_test_count=0))
+
+
+class TopicAnalyticsAggregate(dbModel):
+    category: Mapped['QuestionCategory'] = mapped_column(primary_key=True)
+    topic_title: Mapped[str] = mapped_column(String(200), primary_key=True)
+    questions_count: Mapped[int] = mapped_column(default=0)
+    correct_answers_count: Mapped[int] = mapped_column(default=0)
+
+
+class StartLevelAnalyticsAggregate(dbModel):
+    start_level: Mapped['LanguageLevel'] = mapped_column(LanguageLevelType(), primary_key=True)
+    choosed_dont_know_level: Mapped[bool] = mapped_column(primary_key=True)
+    users_count: Mapped[int] = mapped_column(default=0)
+
+
+class AbandonedTestAggregate(dbModel):
+    """Abandoned tests deleted by the retention job (see `backend.retention`), by the step where they were left."""
+    start_level: Mapped['LanguageLevel'] = mapped_column(LanguageLevelType(), primary_key=True)
+    choosed_dont_know_level: Mapped[bool] = mapped_column(primary_key=True)
+    answered_steps_count: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    users_count: Mapped[int] = mapped_column(default=0)
+
+
+class FinishedUserAnalyticsAggregate(dbModel):
+    """Users known to have finished the test. Finishing is final, so users are never removed from here."""
+    user_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
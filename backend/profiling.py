@@ -0,0 +1,128 @@
+"""
+Opt-in sampling profiler for production requests.
+
+Enabled with `PROFILING_ENABLED=1`. A `PROFILING_SAMPLE_RATE` fraction of requests (0 by default) is profiled, as
+well as any request carrying the `X-Profile-Request` header with the admin password. Stacks of the profiled requests
+are sampled by a background thread and aggregated per endpoint into the collapsed stacks format, that is accepted by
+flamegraph.pl, speedscope and similar tools. When the profiler is not enabled, no hooks are installed at all.
+"""
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Optional
+from flask import Flask, Response, g, request
+
+
+PROFILE_REQUEST_HEADER = 'X-Profile-Request'
+DEFAULT_SAMPLING_INTERVAL_SECONDS = 0.005
+
+
+class StackSampler:
+    """Periodically samples the stacks of the registered threads."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._profiled_threads: dict[int, str] = {}  # thread id -> endpoint
+        self._stacks: dict[str, Counter[str]] = {}  # endpoint -> collapsed stack -> samples count
+        self._lock = threading.Lock()
+        self._has_profiled_threads = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_profiling(self, thread_id: int, endpoint: str) -> None:
+        with self._lock:
+            self._profiled_threads[thread_id] = endpoint
+            self._has_profiled_threads.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+
+    def stop_profiling(self, thread_id: int) -> None:
+        with self._lock:
+            self._profiled_threads.pop(thread_id, None)
+            if not self._profiled_threads:
+                self._has_profiled_threads.clear()
+
+    def _run(self) -> None:
+        while True:
+            self._has_profiled_threads.wait()
+            self._take_sample()
+            time.sleep(self.interval)
+
+    def _take_sample(self) -> None:
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, endpoint in self._profiled_threads.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                endpoint_stacks = self._stacks.get(endpoint)
+                if endpoint_stacks is None:
+                    endpoint_stacks = self._stacks[endpoint] = Counter()
+                endpoint_stacks[collapse_stack(frame)] += 1
+
+    def collapsed_stacks(self, endpoint: Optional[str] = None) -> str:
+        """Returns `endpoint;frame;...;frame count` lines, the endpoint being the root frame."""
+        lines = []
+        with self._lock:
+            for stacks_endpoint, stacks in sorted(self._stacks.items()):
+                if endpoint is not None and stacks_endpoint != endpoint:
+                    continue
+                for stack, samples_count in stacks.most_common():
+                    lines.append(f'{stacks_endpoint};{stack} {samples_count}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    frame_names = []
+    while frame is not None:
+        module_name = frame.f_globals.get('__name__', '?')
+        frame_names.append(f'{module_name}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    frame_names.reverse()  # Root first
+    return ';'.join(frame_names).replace(' ', '_')
+
+
+sampler = StackSampler(float(os.environ.get('PROFILING_INTERVAL_SECONDS', DEFAULT_SAMPLING_INTERVAL_SECONDS)))
+
+
+def _should_profile_request(sample_rate: float) -> bool:
+    profile_header = request.headers.get(PROFILE_REQUEST_HEADER)
+    if profile_header is not None:
+        admin_password = os.environ.get('ADMIN_PASSWORD')
+        return admin_password is not None and hmac.compare_digest(profile_header.encode(), admin_password.encode())
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def init_profiling(app: Flask) -> None:
+    if os.environ.get('PROFILING_ENABLED') != '1':
+        return
+    sample_rate = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+
+    @app.before_request
+    def start_request_profiling():
+        if _should_profile_request(sample_rate):
+            g.profiled_thread_id = threading.get_ident()
+            sampler.start_profiling(g.profiled_thread_id, request.endpoint or 'unknown')
+
+    @app.teardown_request
+    def stop_request_profiling(exception):
+        profiled_thread_id = g.pop('profiled_thread_id', None)
+        if profiled_thread_id is not None:
+            sampler.stop_profiling(profiled_thread_id)
+
+
+def make_collapsed_stacks_response(endpoint: Optional[str] = None) -> Response:
+    return Response(
+        sampler.collapsed_stacks(endpoint),
+        mimetype='text/plain',
+        headers={'Content-Disposition': 'attachment; filename=profile.folded'},
+    )
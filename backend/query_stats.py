@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+from flask import Flask, Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryCounter:
+    """Accumulates the number of executed SQL statements, the time spent in the DB and the affected rows."""
+    __slots__ = ('queries', 'duration', 'rows', 'statements')
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.duration = 0.0  # seconds
+        self.rows = 0
+        self.statements: list[str] = []
+
+    def record(self, statement: str, duration: float, rows: int) -> None:
+        self.queries += 1
+        self.duration += duration
+        self.rows += rows
+        self.statements.append(statement)
+
+
+class EndpointQueryStats:
+    __slots__ = ('requests', 'queries', 'duration', 'rows', 'max_queries')
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.rows = 0
+        self.max_queries = 0
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'avg_queries': round(self.queries / self.requests, 2) if self.requests else 0,
+            'max_queries': self.max_queries,
+            'db_time_ms': round(self.duration * 1000, 3),
+            'avg_db_time_ms': round(self.duration * 1000 / self.requests, 3) if self.requests else 0,
+            'rows': self.rows,
+        }
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+_active_counters = threading.local()  # Counters collecting the queries executed by the current thread
+_endpoint_stats: dict[str, EndpointQueryStats] = {}
+_endpoint_stats_lock = threading.Lock()
+
+
+def _get_active_counters() -> list[QueryCounter]:
+    counters = getattr(_active_counters, 'stack', None)
+    if counters is None:
+        counters = _active_counters.stack = []
+    return counters
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    counters = _get_active_counters()
+    if not counters:
+        return
+    # `rowcount` is the number of affected rows for DML. For SELECT it is only reported by some drivers
+    # (MySQLdb does, sqlite3 returns -1), so the rows metric is best-effort.
+    rows = max(cursor.rowcount, 0)
+    for counter in counters:
+        counter.record(statement, duration, rows)
+
+
+def _handle_error(exception_context) -> None:
+    # `after_cursor_execute` is skipped for a failed statement, the start time would be left to the next one
+    connection = exception_context.connection
+    if connection is not None and exception_context.execution_context is not None:
+        start_times = connection.info.get('query_start_time')
+        if start_times:
+            start_times.pop()
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """Counts all the queries executed by the current thread inside the `with` block."""
+    counter = QueryCounter()
+    counters = _get_active_counters()
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@contextmanager
+def query_budget(max_queries: int) -> Iterator[QueryCounter]:
+    """
+    Fails with `QueryBudgetExceeded` if more than `max_queries` queries are executed inside the `with` block.
+
+    Intended for tests, e.g. `with query_budget(5): client.get('/api/status')`.
+    """
+    with count_queries() as counter:
+        yield counter
+    if counter.queries > max_queries:
+        executed_statements = '\n'.join(counter.statements)
+        raise QueryBudgetExceeded(
+            f'Executed {counter.queries} queries, while the budget is {max_queries}:\n{executed_statements}'
+        )
+
+
+def get_endpoint_query_stats() -> dict[str, dict[str, Any]]:
+    with _endpoint_stats_lock:
+        return {endpoint: stats.to_json() for endpoint, stats in sorted(_endpoint_stats.items())}
+
+
+def reset_endpoint_query_stats() -> None:
+    with _endpoint_stats_lock:
+        _endpoint_stats.clear()
+
+
+def _start_request_counter() -> None:
+    counter = QueryCounter()
+    _get_active_counters().append(counter)
+    g.query_counter = counter
+
+
+def _add_server_timing(response: Response) -> Response:
+    counter: Optional[QueryCounter] = g.get('query_counter')
+    if counter is None:
+        return response
+    # The queries made so far: the session is saved, and a streamed body is produced, after this hook
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={counter.duration * 1000:.2f};desc="{counter.queries} queries, {counter.rows} rows"',
+    )
+    return response
+
+
+def _finish_request_counter(exception: Optional[BaseException]) -> None:
+    # Called once the response is produced, also for the streamed ones (with `stream_with_context`)
+    # and for unhandled exceptions, for which `after_request` is skipped
+    counter: Optional[QueryCounter] = g.pop('query_counter', None)
+    if counter is None:
+        return
+    counters = _get_active_counters()
+    if counter in counters:
+        counters.remove(counter)
+
+    endpoint = request.endpoint or 'unknown'
+    with _endpoint_stats_lock:
+        stats = _endpoint_stats.get(endpoint)
+        if stats is None:
+            stats = _endpoint_stats[endpoint] = EndpointQueryStats()
+        stats.requests += 1
+        stats.queries += counter.queries
+        stats.duration += counter.duration
+        stats.rows += counter.rows
+        stats.max_queries = max(stats.max_queries, counter.queries)
+
+
+def init_query_stats(app: Flask) -> None:
+    """Counts queries, DB time and rows of every request and reports them in the `Server-Timing` header."""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_start_request_counter)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_finish_request_counter)
@@ -0,0 +1,273 @@
+"""
+Read-only snapshot of the question bank, shared by the worker processes.
+
+The snapshot is a single file, memory-mapped by every worker, so the OS keeps one copy of it in memory whatever the
+number of workers is. Questions are stored column-wise: sorted ids, codes of the level, category, answer type and
+topic, and offsets into a payload blob with the texts of every question. Questions are looked up by a binary search
+over the ids, and decoded only when accessed.
+
+The snapshot is written to a temporary file and renamed over the previous one (see `load_data.py`), and the workers
+notice the new file by its inode, size and modification time, without restarting. When `QUESTION_BANK_SNAPSHOT` is
+not set, or a question is missing from the snapshot, questions are read from the DB.
+"""
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Union
+from flask import Flask
+from sqlalchemy import insert
+
+from backend.models import ProgressStep, Question, db_session
+from backend.types import AnswerType, LanguageLevel, QuestionCategory, language_level_from_value
+
+
+MAGIC = b'MOOIQB'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<6sHIII')  # magic, format version, questions count, topics table size, payload size
+_CATEGORIES = list(QuestionCategory)
+_ANSWER_TYPES = list(AnswerType)
+RELOAD_CHECK_INTERVAL_SECONDS = 1.0
+
+
+class SnapshotQuestion(NamedTuple):
+    """A question read from the snapshot. Has the same attributes and methods as `Question`."""
+    id: int
+    level: LanguageLevel
+    category: QuestionCategory
+    topic_title: str
+    question_title: str
+    filepath: Optional[str]
+    answer_type: AnswerType
+    answer_options: Optional[str]
+    correct_answer: str
+
+    to_json = Question.to_json
+    is_answer_correct = Question.is_answer_correct
+
+
+def _padding(offset: int) -> int:
+    return -offset % 8
+
+
+def _to_little_endian(values: array.array) -> array.array:
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_snapshot(questions: Iterable[Union[Question, SnapshotQuestion]], path: Path) -> None:
+    """Atomically replaces the snapshot at `path` with the given questions."""
+    questions = sorted(questions, key=lambda question: question.id)
+    topics: dict[str, int] = {}
+    ids, offsets = array.array('q'), array.array('Q', [0])
+    topic_codes = array.array('H')
+    levels, categories, answer_types = array.array('B'), array.array('B'), array.array('B')
+    payload = bytearray()
+    for question in questions:
+        ids.append(question.id)
+        topic_codes.append(topics.setdefault(question.topic_title, len(topics)))
+        levels.append(question.level.value)
+        categories.append(_CATEGORIES.index(question.category))
+        answer_types.append(_ANSWER_TYPES.index(question.answer_type))
+        payload += json.dumps(
+            [question.question_title, question.filepath, question.answer_options, question.correct_answer],
+            ensure_ascii=False,
+        ).encode()
+        offsets.append(len(payload))
+
+    topics_table = json.dumps(list(topics), ensure_ascii=False).encode()
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, len(questions), len(topics_table), len(payload))
+    temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(temporary_path, 'wb') as file:
+        file.write(header)
+        file.write(topics_table)
+        file.write(b'\0' * _padding(len(header) + len(topics_table)))
+        for column in (ids, offsets, topic_codes, levels, categories, answer_types):
+            file.write(_to_little_endian(column).tobytes())
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+class QuestionBankSnapshot:
+    def __init__(self, path: Path):
+        if sys.byteorder == 'big':
+            raise RuntimeError('Question bank snapshots are supported only on little-endian platforms')
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        magic, version, questions_count, topics_table_size, payload_size = _HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a question bank snapshot of version {FORMAT_VERSION}')
+
+        position = _HEADER.size
+        self._topics: list[str] = json.loads(bytes(buffer[position:position + topics_table_size]))
+        position += topics_table_size + _padding(_HEADER.size + topics_table_size)
+
+        def take_column(typecode: str, length: int) -> memoryview:
+            nonlocal position
+            size = length * struct.calcsize(typecode)
+            column = buffer[position:position + size].cast(typecode)
+            position += size
+            return column
+        self._ids = take_column('q', questions_count)
+        self._offsets = take_column('Q', questions_count + 1)
+        self._topic_codes = take_column('H', questions_count)
+        self._levels = take_column('B', questions_count)
+        self._categories = take_column('B', questions_count)
+        self._answer_types = take_column('B', questions_count)
+        self._payload = buffer[position:position + payload_size]
+        self._level_groups: dict[LanguageLevel, list[list[int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def max_question_id(self) -> int:
+        return self._ids[-1] if len(self._ids) else 0
+
+    def _question_at(self, index: int) -> SnapshotQuestion:
+        question_title, filepath, answer_options, correct_answer = json.loads(
+            bytes(self._payload[self._offsets[index]:self._offsets[index + 1]])
+        )
+        return SnapshotQuestion(
+            id=self._ids[index],
+            level=language_level_from_value(self._levels[index]),
+            category=_CATEGORIES[self._categories[index]],
+            topic_title=self._topics[self._topic_codes[index]],
+            question_title=question_title,
+            filepath=filepath,
+            answer_type=_ANSWER_TYPES[self._answer_types[index]],
+            answer_options=answer_options,
+            correct_answer=correct_answer,
+        )
+
+    def get(self, question_id: int) -> Optional[SnapshotQuestion]:
+        index = bisect_left(self._ids, question_id)
+        if index == len(self._ids) or self._ids[index] != question_id:
+            return None
+        return self._question_at(index)
+
+    def __iter__(self):
+        return (self._question_at(index) for index in range(len(self._ids)))
+
+    def level_groups(self, level: LanguageLevel) -> list[list[int]]:
+        """
+        Ids of the questions of the level, grouped by (category, answer type, topic).
+
+        Groups are ordered by their first question.
+        """
+        level_groups = self._level_groups.get(level)
+        if level_groups is None:
+            groups: dict[tuple[int, int, int], list[int]] = {}
+            for index, level_value in enumerate(self._levels):
+                if level_value == level.value:
+                    group = (self._categories[index], self._answer_types[index], self._topic_codes[index])
+                    groups.setdefault(group, []).append(self._ids[index])
+            level_groups = self._level_groups[level] = list(groups.values())
+        return level_groups
+
+
+class QuestionBank:
+    """Holds the current snapshot, and replaces it when the file has been rewritten."""
+
+    def __init__(self) -> None:
+        self.path: Optional[Path] = None
+        self.check_interval = RELOAD_CHECK_INTERVAL_SECONDS
+        self._snapshot: Optional[QuestionBankSnapshot] = None
+        self._file_key: Optional[tuple[int, int, int]] = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def configure(self, path: Optional[Path]) -> None:
+        with self._lock:
+            self.path = path
+            self._snapshot = None
+            self._file_key = None
+            self._checked_at = float('-inf')
+
+    def get_snapshot(self) -> Optional[QuestionBankSnapshot]:
+        if self.path is None:
+            return None
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self._snapshot, self._file_key = None, None
+                return None
+            file_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if file_key != self._file_key:
+                # The previous snapshot is unmapped when the last reference to it is gone
+                self._snapshot, self._file_key = QuestionBankSnapshot(self.path), file_key
+            return self._snapshot
+
+
+question_bank = QuestionBank()
+
+
+def init_question_bank(app: Flask) -> None:
+    snapshot_path = os.environ.get('QUESTION_BANK_SNAPSHOT')
+    question_bank.configure(Path(snapshot_path) if snapshot_path else None)
+
+
+def insert_snapshot_questions(snapshot: QuestionBankSnapshot, chunk_size: int = 1000) -> None:
+    """Inserts the questions of the snapshot with their ids. Must be called within an app context."""
+    chunk: list[dict] = []
+    for question in snapshot:
+        chunk.append(question._asdict())
+        if len(chunk) == chunk_size:
+            db_session.execute(insert(Question), chunk)
+            chunk = []
+    if chunk:
+        db_session.execute(insert(Question), chunk)
+
+
+def get_question(question_id: int) -> Union[Question, SnapshotQuestion]:
+    snapshot = question_bank.get_snapshot()
+    question = snapshot.get(question_id) if snapshot is not None else None
+    if question is None:
+        question = db_session.get(Question, question_id)
+    return question
+
+
+def get_questions(question_ids: Iterable[int]) -> dict[int, Union[Question, SnapshotQuestion]]:
+    """Returns the questions by their ids, reading the ones missing from the snapshot with a single query."""
+    snapshot = question_bank.get_snapshot()
+    questions: dict[int, Union[Question, SnapshotQuestion]] = {}
+    missing_question_ids = set()
+    for question_id in question_ids:
+        question = snapshot.get(question_id) if snapshot is not None else None
+        if question is not None:
+            questions[question_id] = question
+        else:
+            missing_question_ids.add(question_id)
+    if missing_question_ids:
+        for question in db_session.query(Question).filter(Question.id.in_(missing_question_ids)):
+            questions[question.id] = question
+    return questions
+
+
+def get_step_question(user_id: int, step_number: int) -> Optional[Union[Question, SnapshotQuestion]]:
+    """Returns the question of the user's progress step."""
+    if question_bank.get_snapshot() is None:
+        return db_session.query(Question).join(ProgressStep).filter(
+            ProgressStep.user_id == user_id,
+            ProgressStep.step_number == step_number,
+        ).first()
+    question_id = db_session.query(ProgressStep.question_id).filter(
+        ProgressStep.user_id == user_id,
+        ProgressStep.step_number == step_number,
+    ).scalar()
+    return get_question(question_id) if question_id is not None else None
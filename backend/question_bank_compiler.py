@@ -0,0 +1,205 @@
+"""
+Compilation of the `test_data` tree of topic workbooks into a question bank snapshot.
+
+The tree is `<level>/<meta category>/<topic>.xlsx`, with `Восприятие/Аудирование/Вопросы.xlsx` and
+`Восприятие/Чтение/Вопросы.xlsx` for the questions with media files. Next to the snapshot, a manifest records the
+SHA-256 of every workbook and the ids of its questions. On the next compilation only the new and changed workbooks
+are parsed, the questions of the other ones are copied from the previous snapshot with the same ids.
+
+Question ids are assigned here, not by the DB: the questions of a new or changed workbook get the ids after the
+largest one ever assigned, so an id never points to another question. Answer options are shuffled with a seed
+derived from the workbook hash, so compiling the same workbook twice gives the same questions.
+"""
+import hashlib
+import json
+import os
+import random
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from backend.question_bank import FORMAT_VERSION, QuestionBankSnapshot, SnapshotQuestion, write_snapshot
+from backend.types import AnswerType, LanguageLevel, QuestionCategory
+
+
+MANIFEST_VERSION = 1
+ANSWER_TYPE_MAPPING = {
+    'Выбор одного варианта': AnswerType.SELECT_ONE,
+    'Выбор нескольких вариантов': AnswerType.SELECT_MULTIPLE,
+    'Заполнение пропуска': AnswerType.FILL_THE_BLANK,
+}
+META_CATEGORY_MAPPING = {
+    'Грамматика': QuestionCategory.GRAMMAR,
+    'Лексика': QuestionCategory.VOCABULARY,
+}
+PERCEPTION_META_CATEGORY = 'Восприятие'
+PERCEPTION_CATEGORY_MAPPING = {
+    # Directory name: (category, directory of the media files, pattern of the media files)
+    'Аудирование': (QuestionCategory.LISTENING, 'Аудиофайлы', '*.mp3'),
+    'Чтение': (QuestionCategory.READING, 'Тексты', '*.txt'),
+}
+PERCEPTION_QUESTIONS_FILENAME = 'Вопросы.xlsx'
+
+
+class TopicWorkbook(NamedTuple):
+    path: Path
+    level: LanguageLevel
+    category: QuestionCategory
+
+
+class CompilationResult(NamedTuple):
+    questions_count: int
+    parsed_workbooks: list[str]
+    reused_workbooks: list[str]
+    media_files: list[Path]
+
+
+def get_manifest_path(snapshot_path: Path) -> Path:
+    return snapshot_path.with_name(f'{snapshot_path.name}.manifest.json')
+
+
+def scan_test_data(root_dir: Path) -> tuple[list[TopicWorkbook], list[Path]]:
+    """Returns the topic workbooks and the media files of the tree, raises ValueError if the tree is malformed."""
+    workbooks: list[TopicWorkbook] = []
+    media_files: list[Path] = []
+    for level_dir in sorted(root_dir.iterdir()):
+        if not level_dir.is_dir():
+            raise ValueError(f'{level_dir} should be a directory')
+        transformed_level_name = level_dir.name.replace('.', '_')
+        if transformed_level_name not in LanguageLevel.__members__:
+            raise ValueError(f'Unknown level {level_dir.name}')
+        level = LanguageLevel[transformed_level_name]
+
+        for meta_category_dir in sorted(level_dir.iterdir()):
+            if not meta_category_dir.is_dir():
+                raise ValueError(f'{meta_category_dir} should be a directory')
+            if meta_category_dir.name in META_CATEGORY_MAPPING:
+                category = META_CATEGORY_MAPPING[meta_category_dir.name]
+                for topic_file in sorted(meta_category_dir.iterdir()):
+                    workbooks.append(TopicWorkbook(topic_file, level, category))
+            elif meta_category_dir.name == PERCEPTION_META_CATEGORY:
+                for dir_path in sorted(meta_category_dir.iterdir()):
+                    if dir_path.name not in PERCEPTION_CATEGORY_MAPPING:
+                        continue
+                    category, media_dir_name, media_pattern = PERCEPTION_CATEGORY_MAPPING[dir_path.name]
+                    workbooks.append(TopicWorkbook(dir_path / PERCEPTION_QUESTIONS_FILENAME, level, category))
+                    media_files.extend(sorted((dir_path / media_dir_name).glob(media_pattern)))
+            else:
+                raise ValueError(f'Unknown meta category {meta_category_dir.name}')
+
+    for workbook in workbooks:
+        if not workbook.path.is_file():
+            raise ValueError(f'{workbook.path} should be a file')
+    return workbooks, media_files
+
+
+def parse_topic_workbook(workbook: TopicWorkbook, first_question_id: int, seed: str) -> list[SnapshotQuestion]:
+    from openpyxl import load_workbook  # Slow to import, and not needed when no workbook has changed
+
+    rng = random.Random(seed)
+    questions = []
+    is_media = workbook.category in (QuestionCategory.LISTENING, QuestionCategory.READING)
+    loaded_workbook = load_workbook(workbook.path, read_only=True)
+    try:
+        for sheet in loaded_workbook.worksheets:
+            if sheet.title not in ANSWER_TYPE_MAPPING:
+                raise ValueError(f'Unknown answer type {sheet.title} in {workbook.path}')
+            answer_type = ANSWER_TYPE_MAPPING[sheet.title]
+            for row in sheet.iter_rows(min_row=2, values_only=True):
+                row_values = [str(cell) for cell in row if cell is not None]
+                if not row_values:
+                    continue  # Read-only worksheets may report trailing empty rows
+                filepath = None
+                if is_media:
+                    filepath = row_values[0]
+                    row_values = row_values[1:]
+                question_title = row_values[0]
+                answer_options: Optional[str]
+                if answer_type == AnswerType.SELECT_ONE:
+                    correct_answer_value = row_values[1]
+                    all_answers = row_values[1:]
+                    rng.shuffle(all_answers)
+                    answer_options = json.dumps(all_answers)
+                    correct_answer = str(all_answers.index(correct_answer_value))
+                elif answer_type == AnswerType.SELECT_MULTIPLE:
+                    correct_answers_num = int(row_values[1])
+                    correct_answers_values = row_values[2:2 + correct_answers_num]
+                    all_answers = row_values[2:]
+                    rng.shuffle(all_answers)
+                    answer_options = json.dumps(all_answers)
+                    correct_answer_indices = sorted(all_answers.index(value) for value in correct_answers_values)
+                    correct_answer = ','.join([str(index) for index in correct_answer_indices])
+                else:  # fill the blank
+                    answer_options = None
+                    correct_answer = json.dumps(row_values[1:])
+
+                questions.append(SnapshotQuestion(
+                    id=first_question_id + len(questions),
+                    level=workbook.level,
+                    category=workbook.category,
+                    topic_title=workbook.path.stem,
+                    question_title=question_title,
+                    filepath=filepath,
+                    answer_type=answer_type,
+                    answer_options=answer_options,
+                    correct_answer=correct_answer,
+                ))
+    finally:
+        loaded_workbook.close()
+    return questions
+
+
+def _load_previous_compilation(snapshot_path: Path) -> tuple[dict, Optional[QuestionBankSnapshot]]:
+    try:
+        manifest = json.loads(get_manifest_path(snapshot_path).read_text())
+        if manifest['version'] != MANIFEST_VERSION or manifest['snapshot_format_version'] != FORMAT_VERSION:
+            return {}, None
+        return manifest, QuestionBankSnapshot(snapshot_path)
+    except (OSError, ValueError, KeyError):
+        return {}, None  # Compiled from scratch
+
+
+def compile_question_bank(root_dir: Path, snapshot_path: Path) -> CompilationResult:
+    """Writes the snapshot of the questions of the tree and its manifest, parsing only the changed workbooks."""
+    workbooks, media_files = scan_test_data(root_dir)
+    previous_manifest, previous_snapshot = _load_previous_compilation(snapshot_path)
+    previous_workbooks: dict[str, dict] = previous_manifest.get('workbooks', {})
+    next_question_id: int = previous_manifest.get('next_question_id', 1)
+    if previous_snapshot is not None:  # In case the manifest is older than the snapshot
+        next_question_id = max(next_question_id, previous_snapshot.max_question_id + 1)
+
+    questions: list[SnapshotQuestion] = []
+    manifest_workbooks: dict[str, dict] = {}
+    parsed_workbooks, reused_workbooks = [], []
+    for workbook in workbooks:
+        relative_path = workbook.path.relative_to(root_dir).as_posix()
+        digest = hashlib.sha256(workbook.path.read_bytes()).hexdigest()
+        previous_entry = previous_workbooks.get(relative_path)
+        workbook_questions: Optional[list[SnapshotQuestion]] = None
+        if previous_snapshot is not None and previous_entry is not None and previous_entry['sha256'] == digest:
+            previous_questions = [previous_snapshot.get(question_id) for question_id in previous_entry['question_ids']]
+            if all(question is not None for question in previous_questions):
+                workbook_questions = previous_questions  # type: ignore[assignment]
+                reused_workbooks.append(relative_path)
+        if workbook_questions is None:
+            workbook_questions = parse_topic_workbook(workbook, next_question_id, seed=digest)
+            next_question_id += len(workbook_questions)
+            parsed_workbooks.append(relative_path)
+
+        questions.extend(workbook_questions)
+        manifest_workbooks[relative_path] = {
+            'sha256': digest,
+            'question_ids': [question.id for question in workbook_questions],
+        }
+
+    write_snapshot(questions, snapshot_path)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'snapshot_format_version': FORMAT_VERSION,
+        'next_question_id': next_question_id,
+        'workbooks': manifest_workbooks,
+    }
+    manifest_path = get_manifest_path(snapshot_path)
+    temporary_path = manifest_path.with_name(f'{manifest_path.name}.{os.getpid()}.tmp')
+    temporary_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2))
+    os.replace(temporary_path, manifest_path)  # After the snapshot, so the manifest never describes a missing one
+    return CompilationResult(len(questions), parsed_workbooks, reused_workbooks, media_files)
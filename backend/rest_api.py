@@ -1,21 +1,66 @@
 
+import datetime
+import hmac
 import os
 import uuid
-from flask import Blueprint, jsonify, request, send_from_directory, session as flask_session
-from marshmallow import Schema, ValidationError, fields
+from typing import Optional
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    jsonify,
+    request,
+    send_from_directory,
+    session as flask_session,
+    stream_with_context,
+)
+from marshmallow import Schema, ValidationError, fields, validate
+from sqlalchemy import case, update
 from backend.admin import calculate_all_analytics, export_users_results_and_upload_to_google_drive
 from backend.flow_logic import (
-    compute_detailed_stats,
+    add_level_batch,
     compute_summarized_stats,
-    generate_progress_steps_batch,
+    get_finished_level,
     get_passed_levels_stats,
-    get_questions_counts,
+    iter_passed_steps_rows,
     has_answered_pending_questions,
     process_stats,
 )
+from backend.adaptive import process_adaptive_responses
+from backend.answer_log import answer_log, apply_buffered_answers, buffer_answer
+from backend.archive import (
+    archive_finished_test,
+    compute_archived_summarized_stats,
+    get_finished_test,
+    iter_archived_passed_steps_rows,
+)
+from backend.batch_pool import batch_pool
+from backend.bootstrap import render_index_html
+from backend.http_middleware import make_result_response
+from backend.json_provider import JSONFragment
 from backend.logs import logger
+from backend.metrics import (
+    REGISTRY as METRICS_REGISTRY,
+    answers_total,
+    process_stats_outcomes_total,
+    tests_finished_total,
+    tests_started_total,
+)
 from backend.models import ProgressStep, Question, User, UserAnalytics, db_session
-from backend.types import LanguageLevel
+from backend.profiling import make_collapsed_stacks_response, sampler as profiling_sampler
+from backend.question_bank import get_question, get_step_question
+from backend.query_stats import get_endpoint_query_stats, reset_endpoint_query_stats
+from backend.retention import run_retention
+from backend.serialization import (
+    encode_batch_question,
+    encode_passed_step,
+    media_type_for_category,
+    stream_all_analytics,
+    stream_json_array,
+)
+from backend.sharding import select_request_shard
+from backend.types import LanguageLevel, language_level_from_value
+from backend.validation import compile_schema
 
 
 main_blueprint = Blueprint('main', __name__, url_prefix='/')
@@ -27,12 +72,18 @@ main_blueprint.register_blueprint(api_blueprint)
 @main_blueprint.route('/<path:path>')
 def catch_all(path = None):
     if 'user_uuid' not in flask_session:
-        analytics = UserAnalytics()
+        analytics = UserAnalytics(uuid=str(uuid.uuid4()))
+        select_request_shard(analytics.uuid)  # The page opening is kept in the shard of the user it becomes
         db_session.add(analytics)
         db_session.commit()
         flask_session['user_uuid'] = analytics.uuid
 
-    return send_from_directory('../frontend/build', 'index.html')
+    # With the status inlined, the page doesn't need to call `/api/status` before rendering
+    html = render_index_html(current_app.config['FRONTEND_BUILD_DIR'], {'status': get_cached_status()})
+    response = Response(html, mimetype='text/html')
+    response.cache_control.no_cache = True  # Refers to the fingerprinted bundle, which changes with every build
+    response.cache_control.private = True  # Has the user's status
+    return response
 
 
 class StartSchema(Schema):
@@ -43,13 +94,17 @@ class StartSchema(Schema):
 
 class NextStepSchema(Schema):
     answer = fields.String(required=True)
+    step_number = fields.Integer()  # Sent by clients answering prefetched questions, to detect out-of-order answers
 
 
+load_start_data = compile_schema(StartSchema)
+load_next_step_data = compile_schema(NextStepSchema)
+
 @api_blueprint.route('/start', methods=['POST'])
 def start():
     """Saves contact data of a new user. Sets the user's identifier cookie."""
     try:
-        data = StartSchema().load(request.json)
+        data = load_start_data(request.json)
     except ValidationError as e:
         return jsonify(e.messages), 400
 
@@ -63,6 +118,7 @@ def start():
     if user_uuid is None:
         logger.error(f'User UUID for {data} is not set')  # Should always be set
         user_uuid = str(uuid.uuid4())
+        select_request_shard(user_uuid)
 
     user = User(
         uuid=user_uuid,
@@ -73,21 +129,76 @@ def start():
     )
     db_session.add(user)
     db_session.commit()
+    tests_started_total.inc(str(start_level))
     flask_session['user_id'] = user.id
     flask_session['current_step_number'] = 1
+    flask_session.pop('finished_user_uuid', None)
     flask_session.modified = True
 
-    generate_progress_steps_batch(
-        question_counts=get_questions_counts(user.start_level),
-        user_id=user.id,
-        current_step_number=0,
-        level=user.start_level,
-    )
+    if current_app.config['ADAPTIVE_TESTING'] is True:
+        flask_session['adaptive_start_level'] = start_level.value
+        flask_session['adaptive_responses'] = []
+        decision = process_adaptive_responses([], start_level)
+        if decision.finished_with_level is not None:  # No questions to ask
+            return finish_test(user.id, decision.finished_with_level)
+        db_session.add(ProgressStep(user_id=user.id, step_number=1, question_id=decision.next_question_id))
+        db_session.commit()
+    else:
+        add_level_batch(batch_pool.take_batch(user.start_level), user_id=user.id, current_step_number=0)
     # Get the first question
-    next_question = db_session.query(Question).join(ProgressStep).filter(
-        ProgressStep.user_id == user.id,
-        ProgressStep.step_number == 1,
-    ).first()
+    next_question = get_step_question(user.id, step_number=1)
+    flask_session['current_question_id'] = [1, next_question.id]
+    return jsonify(next_question.to_json())
+
+
+TEST_SESSION_KEYS = (
+    'current_step_number',
+    'next_level_step_number',
+    'adaptive_start_level',
+    'adaptive_responses',
+    'buffered_answers',
+    'current_question_id',  # [step number, question id], of the last question sent
+)
+
+
+def finish_test(user_id: int, finished_with_level: LanguageLevel):
+    tests_finished_total.inc(str(finished_with_level))
+    for key in TEST_SESSION_KEYS:
+        flask_session.pop(key, None)
+    user = db_session.query(User).filter(User.id == user_id).first()
+    user.detected_level = finished_with_level
+    if current_app.config['ARCHIVE_FINISHED_TESTS'] is True:
+        archive_finished_test(user_id)
+    user_uuid = user.uuid  # The user would be reloaded after the commit
+    db_session.commit()
+    flask_session['finished_user_uuid'] = user_uuid
+    return jsonify({'user_uuid': user_uuid, 'finished': True})
+
+
+def finish_level(user_id: int, last_step_number: int):
+    """
+    Grades the passed levels once the last question of a level is answered.
+
+    Either finishes the test (and returns the response) or generates the questions of the next level.
+    """
+    apply_buffered_answers(user_id)
+    stats = get_passed_levels_stats(user_id)  # Always has at least one element
+    finished_with_level, next_level = process_stats(stats)
+    if finished_with_level is not None:
+        process_stats_outcomes_total.inc('finished', str(finished_with_level))
+        return finish_test(user_id, finished_with_level)
+
+    # next_level is not None
+    process_stats_outcomes_total.inc('next_level', str(next_level))
+    add_level_batch(batch_pool.take_batch(next_level), user_id=user_id, current_step_number=last_step_number)
+    return None
+
+
+def move_to_step(user_id: int, step_number: int):
+    flask_session['current_step_number'] = step_number
+    # Get new question
+    next_question = get_step_question(user_id, step_number)
+    flask_session['current_question_id'] = [step_number, next_question.id]
     return jsonify(next_question.to_json())
 
 
@@ -101,7 +212,7 @@ def next_step():
     """
     logger.debug('Next step called')
     try:
-        data = NextStepSchema().load(request.json)
+        data = load_next_step_data(request.json)
     except ValidationError as e:
         return jsonify(e.messages), 400
 
@@ -109,43 +220,167 @@ def next_step():
     user_id = flask_session['user_id']
     current_step_number = flask_session['current_step_number']
     next_level_step_number = flask_session.get('next_level_step_number')
+    if data.get('step_number', current_step_number) != current_step_number:
+        return jsonify({'step_number': [f'Expected the answer for step {current_step_number}.']}), 409
 
     current_progress_step = db_session.query(ProgressStep).filter(
         ProgressStep.user_id == user_id,
         ProgressStep.step_number == current_step_number,
     ).one()
-    answered_question = db_session.query(Question).filter(
-        Question.id == current_progress_step.question_id,
-    ).one()
-    current_progress_step.answer = answer  # Save the answer
-    current_progress_step.is_correct = answered_question.is_answer_correct(answer)
-    db_session.commit()
+    answered_question = get_question(current_progress_step.question_id)
+    is_correct = answered_question.is_answer_correct(answer)
+    if answer_log.enabled and 'adaptive_responses' not in flask_session:
+        buffer_answer(user_id, current_step_number, answer, is_correct)  # Saved to the DB later
+    else:
+        current_progress_step.answer = answer  # Save the answer
+        current_progress_step.is_correct = is_correct
+        db_session.commit()
+    answers_total.inc(str(is_correct).lower())
+
+    if 'adaptive_responses' in flask_session:
+        responses = flask_session['adaptive_responses'] + [(answered_question.id, is_correct)]
+        flask_session['adaptive_responses'] = responses
+        start_level = language_level_from_value(flask_session['adaptive_start_level'])
+        decision = process_adaptive_responses(responses, start_level)
+        if decision.finished_with_level is not None:
+            return finish_test(user_id, decision.finished_with_level)
+        db_session.add(ProgressStep(
+            user_id=user_id,
+            step_number=current_step_number + 1,
+            question_id=decision.next_question_id,
+        ))
+        db_session.commit()
+    elif current_step_number == next_level_step_number:
+        finish_response = finish_level(user_id, current_step_number)
+        if finish_response is not None:
+            return finish_response
 
-    if current_step_number == next_level_step_number:
-        stats = get_passed_levels_stats(user_id)  # Always has at least one element
-        finished_with_level, next_level = process_stats(stats)
-        if finished_with_level is not None:
-            flask_session.pop('current_step_number')
-            flask_session.pop('next_level_step_number')
-            user = db_session.query(User).filter(User.id == user_id).first()
-            db_session.commit()
-            return jsonify({'user_uuid': user.uuid, 'finished': True})
-        else:  # next_level is not None
-            generate_progress_steps_batch(
-                question_counts=get_questions_counts(next_level),
-                user_id=user_id,
-                current_step_number=current_step_number,
-                level=next_level,
-            )
-
-    current_step_number += 1
-    flask_session['current_step_number'] = current_step_number
-    # Get new question
-    next_question = db_session.query(Question).join(ProgressStep).filter(
+    return move_to_step(user_id, current_step_number + 1)
+
+
+class AnswersSchema(Schema):
+    answers = fields.Dict(keys=fields.Integer(), values=fields.String(), required=True)  # step number -> answer
+    # Step number -> seconds spent on the question, so that every answer keeps its own time
+    answer_seconds = fields.Dict(
+        keys=fields.Integer(),
+        values=fields.Float(validate=validate.Range(min=0, max=24 * 60 * 60)),
+    )
+
+
+load_answers_data = compile_schema(AnswersSchema)
+
+@api_blueprint.route('/answers', methods=['POST'])
+def submit_answers():
+    """
+    Accepts the answers to all the remaining questions of the current level at once, keyed by step number.
+
+    The answers are graded together and saved with a single UPDATE, then the level is graded like in `/next-step`.
+    The answer times are counted back from now using `answer_seconds`, the last answer being given right now.
+    Returns the first question of the next level or a message that the test is finished.
+    """
+    if 'current_step_number' not in flask_session:
+        return 'The test is not in progress', 400
+    if 'adaptive_responses' in flask_session:
+        return 'Questions of an adaptive test are chosen one by one', 400
+    try:
+        data = load_answers_data(request.json)
+    except ValidationError as e:
+        return jsonify(e.messages), 400
+
+    answers = data['answers']
+    user_id = flask_session['user_id']
+    current_step_number = flask_session['current_step_number']
+    next_level_step_number = flask_session['next_level_step_number']
+    expected_step_numbers = set(range(current_step_number, next_level_step_number + 1))
+    if set(answers) != expected_step_numbers:
+        return jsonify({'answers': [
+            f'Expected the answers for steps {current_step_number}-{next_level_step_number}.',
+        ]}), 409
+
+    answered_questions = db_session.query(ProgressStep.step_number, Question).join(Question).filter(
         ProgressStep.user_id == user_id,
-        ProgressStep.step_number == current_step_number,
-    ).first()
-    return jsonify(next_question.to_json())
+        ProgressStep.step_number >= current_step_number,
+        ProgressStep.step_number <= next_level_step_number,
+    )
+    is_correct_by_step_number = {
+        step_number: question.is_answer_correct(answers[step_number])
+        for step_number, question in answered_questions
+    }
+    answer_seconds = data.get('answer_seconds', {})
+    answered_at = datetime.datetime.utcnow()
+    answered_at_by_step_number = {}
+    for step_number in sorted(answers, reverse=True):
+        answered_at_by_step_number[step_number] = answered_at
+        answered_at -= datetime.timedelta(seconds=answer_seconds.get(step_number, 0))
+    db_session.execute(
+        update(ProgressStep).where(
+            ProgressStep.user_id == user_id,
+            ProgressStep.step_number.in_(list(is_correct_by_step_number)),
+        ).values(
+            answer=case(answers, value=ProgressStep.step_number),
+            is_correct=case(is_correct_by_step_number, value=ProgressStep.step_number),
+            timestamp=case(answered_at_by_step_number, value=ProgressStep.step_number),
+        ).execution_options(synchronize_session=False)
+    )
+    db_session.commit()
+    for is_correct in is_correct_by_step_number.values():
+        answers_total.inc(str(is_correct).lower())
+
+    finish_response = finish_level(user_id, next_level_step_number)
+    if finish_response is not None:
+        return finish_response
+    return move_to_step(user_id, next_level_step_number + 1)
+
+
+@api_blueprint.route('/level-batch', methods=['GET'])
+def level_batch():
+    """
+    Returns all the remaining questions of the current level at once, so that the client can render them without
+    waiting for the server. Answers are still sent to `/next-step` (with `step_number`) or to `/answers`.
+
+    Media files of the questions are announced with preload `Link` headers.
+    """
+    if 'current_step_number' not in flask_session:
+        return 'The test is not in progress', 400
+    if 'adaptive_responses' in flask_session:
+        return 'Questions of an adaptive test are chosen one by one', 400
+
+    current_step_number = flask_session['current_step_number']
+    next_level_step_number = flask_session['next_level_step_number']
+    batch_query = db_session.query(
+        ProgressStep.step_number,
+        Question.question_title,
+        Question.category,
+        Question.answer_type,
+        Question.answer_options,
+        Question.filepath,
+    ).join(Question).filter(
+        ProgressStep.user_id == flask_session['user_id'],
+        ProgressStep.step_number >= current_step_number,
+        ProgressStep.step_number <= next_level_step_number,
+    ).order_by(ProgressStep.step_number)
+
+    questions = []
+    preload_links = []
+    for row in batch_query:
+        questions.append(JSONFragment(encode_batch_question(*row)))
+        media_type = media_type_for_category(row.category)
+        if media_type == 'audio':
+            preload_links.append(f'</api/media/{row.filepath}>; rel=preload; as=audio')
+        elif media_type == 'text':
+            preload_links.append(f'</api/media/{row.filepath}>; rel=preload; as=fetch; crossorigin')
+
+    response = jsonify({'questions': questions, 'next_level_step_number': next_level_step_number})
+    if preload_links:
+        response.headers['Link'] = ', '.join(preload_links)
+    return response
+
+
+def get_result_etag(user: User) -> Optional[str]:
+    """Results don't change once the level is detected. Tests finished before it was stored are not cached."""
+    if user.detected_level is None:
+        return None
+    return f'{user.uuid}-{user.detected_level.name}'
 
 
 @api_blueprint.route('/results/<user_uuid>/summarized', methods=['GET'])
@@ -160,11 +395,20 @@ def results_summarized(user_uuid):
     if user is None:
         return 'User not found', 404
 
+    etag = get_result_etag(user)
+    if etag is not None:  # Finished, the stats are computed only if the client doesn't have them yet
+        def make_response():
+            finished_test = get_finished_test(user)
+            if finished_test is not None:
+                return jsonify(compute_archived_summarized_stats(finished_test, user.detected_level).to_json())
+            return jsonify(compute_summarized_stats(user.id).to_json())
+        return make_result_response(etag, make_response)
+
     stats = compute_summarized_stats(user.id)
     if stats is None:
         return 'User is still in progress', 400
 
-    return jsonify(stats.to_json())
+    return make_result_response(None, lambda: jsonify(stats.to_json()))
 
 
 @api_blueprint.route('/results/<user_uuid>/detailed', methods=['GET'])
@@ -180,37 +424,60 @@ def results_detailed(user_uuid):
         return 'User not found', 404
 
     # Check that the user has finished the test
-    if has_answered_pending_questions(user.id) is False:
-        return 'User is still in progress', 400
-    finished_level, _ = process_stats(get_passed_levels_stats(user.id))
-    if finished_level is None:
+    etag = get_result_etag(user)
+    if etag is None and get_finished_level(user.id) is None:
         return 'User is still in progress', 400
 
-    passed_steps = compute_detailed_stats(user.id)
-    return jsonify([step.to_json() for step in passed_steps])
+    def make_response():
+        finished_test = get_finished_test(user)
+        if finished_test is not None:
+            rows = iter_archived_passed_steps_rows(finished_test)
+        else:
+            rows = iter_passed_steps_rows(user.id)
+        encoded_steps = (encode_passed_step(*row) for row in rows)
+        return Response(stream_with_context(stream_json_array(encoded_steps)), mimetype='application/json')
+    return make_result_response(etag, make_response)
+
+
+def get_cached_status() -> Optional[dict]:
+    """
+    Returns the same status as `/api/status` from what the session remembers, without querying the users' tables, or
+    None if the session doesn't know it (e.g. the session started before the status was remembered).
+    """
+    if 'user_id' not in flask_session:
+        return {'status': 'NOT_STARTED'}
+    if 'finished_user_uuid' in flask_session:
+        return {'status': 'FINISHED', 'user_uuid': flask_session['finished_user_uuid']}
+    current_step_number = flask_session.get('current_step_number')
+    if current_step_number is None:
+        return None
+    # Only valid for the step it was sent for, the step may have been moved without sending its question
+    question_step_number, question_id = flask_session.get('current_question_id', (None, None))
+    if question_step_number != current_step_number:
+        return None
+    return {'status': 'IN_PROGRESS', 'question': get_question(question_id).to_json()}
 
 
 @api_blueprint.route('/status', methods=['GET'])
 def status():
-    if 'user_id' not in flask_session:
-        return jsonify({'status': 'NOT_STARTED'})
+    cached_status = get_cached_status()
+    if cached_status is not None:
+        return jsonify(cached_status)
 
     user_id = flask_session['user_id']
     user = db_session.query(User).filter(User.id == user_id).first()
-    answered_pending = has_answered_pending_questions(user_id)
-    if answered_pending is True:
+    finished_with_level = user.detected_level
+    if finished_with_level is None and has_answered_pending_questions(user_id) is True:
         finished_with_level, _ = process_stats(get_passed_levels_stats(user_id))
-        if finished_with_level is not None:
-            return jsonify({'status': 'FINISHED', 'user_uuid': user.uuid})
+    if finished_with_level is not None:
+        flask_session['finished_user_uuid'] = user.uuid
+        return jsonify({'status': 'FINISHED', 'user_uuid': user.uuid})
 
     if 'current_step_number' not in flask_session:
         return jsonify({'status': 'NOT_STARTED'})
 
     current_step_number = flask_session['current_step_number']
-    next_question = db_session.query(Question).join(ProgressStep).filter(
-        ProgressStep.user_id == user_id,
-        ProgressStep.step_number == current_step_number,
-    ).first()
+    next_question = get_step_question(user_id, current_step_number)
     return jsonify({'status': 'IN_PROGRESS', 'question': next_question.to_json()})
 
 
@@ -254,8 +521,81 @@ def get_analytics():
         logger.exception(e)
         return 'Error while calculating analytics. Please try again or contact the developers', 409
 
-    serialized_analytics = analytics.to_json()
-    return serialized_analytics
+    return Response(stream_all_analytics(analytics), mimetype='application/json')
+
+
+@api_blueprint.route('/admin/item-analytics', methods=['POST'])
+def get_item_analytics():
+    """Returns difficulty, discrimination, option choice rates and answering time of every question."""
+    validation_result = validate_admin_password()
+    if validation_result != 'OK':
+        return validation_result
+
+    from backend.item_analytics import get_item_stats  # Imported on first use, as it loads numpy
+
+    try:
+        item_stats = get_item_stats()
+    except Exception as e:
+        logger.exception(e)
+        return 'Error while calculating analytics. Please try again or contact the developers', 409
+
+    return jsonify([item.to_json() for item in item_stats])
+
+
+@api_blueprint.route('/admin/cleanup', methods=['POST'])
+def cleanup():
+    """Deletes the abandoned tests, old page openings and expired sessions. Returns the number of deleted rows."""
+    validation_result = validate_admin_password()
+    if validation_result != 'OK':
+        return validation_result
+
+    try:
+        report = run_retention()
+    except Exception as e:
+        logger.exception(e)
+        return 'Error while cleaning up. Please try again or contact the developers', 409
+
+    return jsonify(report.to_json())
+
+
+@api_blueprint.route('/admin/query-stats', methods=['POST'])
+def get_query_stats():
+    """Returns the number of queries, DB time and rows per endpoint since the start (or the last reset)."""
+    validation_result = validate_admin_password()
+    if validation_result != 'OK':
+        return validation_result
+
+    query_stats = get_endpoint_query_stats()
+    if request.json.get('reset') is True:
+        reset_endpoint_query_stats()
+    return jsonify(query_stats)
+
+
+@api_blueprint.route('/admin/profile', methods=['POST'])
+def download_profile():
+    """Returns the sampled stacks of the profiled requests as a collapsed stacks file (for flamegraphs)."""
+    validation_result = validate_admin_password()
+    if validation_result != 'OK':
+        return validation_result
+
+    response = make_collapsed_stacks_response(request.json.get('endpoint'))
+    if request.json.get('reset') is True:
+        profiling_sampler.reset()
+    return response
+
+
+@api_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Exposes the metrics in the Prometheus text format. Requires the admin password as a bearer token."""
+    correct_admin_password = os.environ.get('ADMIN_PASSWORD')
+    given_authorization = request.headers.get('Authorization', '')
+    if correct_admin_password is None or not hmac.compare_digest(
+        given_authorization.encode(),
+        f'Bearer {correct_admin_password}'.encode(),
+    ):
+        return 'Invalid admin password', 403
+
+    return Response(METRICS_REGISTRY.generate_text(), mimetype='text/plain; version=0.0.4')
 
 
 @api_blueprint.route('/media/<path:path>', methods=['GET'])
@@ -0,0 +1,160 @@
+"""
+Retention of the data of abandoned tests, page openings and expired sessions.
+
+A test is abandoned when it isn't finished and nothing has happened in it for `ABANDONED_TEST_RETENTION_DAYS` (and
+for at least the lifetime of the sessions). Its user and progress steps are deleted, after counting the test in
+`AbandonedTestAggregate` by start level and the number of answered steps, i.e. where the funnel was left. Page
+openings are deleted after `PAGE_OPENING_RETENTION_DAYS`, and sessions once they have expired.
+
+Only the rows already folded into the analytics aggregates are deleted, so the analytics don't change. Rows are
+deleted in chunks of `RETENTION_CHUNK_SIZE`, each in its own short transaction, with a pause between the chunks so
+that the requests waiting for the locks are not starved. Run with `cleanup.py` or `/api/admin/cleanup`.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, func
+
+from backend.admin import refresh_analytics_aggregates
+from backend.flow_logic import get_passed_levels_stats_for_users, process_stats
+from backend.logs import logger
+from backend.models import AbandonedTestAggregate, ProgressStep, User, UserAnalytics, db_session
+from backend.sharding import iter_shards
+from backend.types import RetentionReport
+
+
+ABANDONED_TEST_RETENTION_DAYS = float(os.environ.get('ABANDONED_TEST_RETENTION_DAYS', 30))
+PAGE_OPENING_RETENTION_DAYS = float(os.environ.get('PAGE_OPENING_RETENTION_DAYS', 365))
+RETENTION_CHUNK_SIZE = int(os.environ.get('RETENTION_CHUNK_SIZE', 500))
+CHUNK_PAUSE_SECONDS = 0.05
+
+
+def _pause() -> None:
+    if CHUNK_PAUSE_SECONDS > 0:
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+
+def _find_abandoned_user_ids(cutoff: datetime, after_user_id: int) -> list[int]:
+    last_activity = db_session.query(
+        ProgressStep.user_id,
+        func.max(ProgressStep.timestamp).label('timestamp'),
+    ).group_by(ProgressStep.user_id).subquery()
+    return [user_id for user_id, in db_session.query(User.id).outerjoin(
+        last_activity, last_activity.c.user_id == User.id,
+    ).filter(
+        User.id > after_user_id,
+        User.analytics_folded.is_(True),  # Counted in the started tests
+        User.detected_level.is_(None),
+        User.timestamp < cutoff,
+        func.coalesce(last_activity.c.timestamp, User.timestamp) < cutoff,
+        ~db_session.query(ProgressStep).filter(  # Answers counted in the topics success
+            ProgressStep.user_id == User.id,
+            ProgressStep.answer.isnot(None),
+            ProgressStep.analytics_folded.is_(False),
+        ).exists(),
+    ).order_by(User.id).limit(RETENTION_CHUNK_SIZE)]
+
+
+def _aggregate_abandoned_tests(user_ids: list[int]) -> None:
+    answered_steps_counts = dict(db_session.query(
+        ProgressStep.user_id,
+        func.count(ProgressStep.answer),
+    ).filter(
+        ProgressStep.user_id.in_(user_ids),
+    ).group_by(ProgressStep.user_id).all())
+    for user_id, start_level, choosed_dont_know_level in db_session.query(
+        User.id,
+        User.start_level,
+        User.choosed_dont_know_level,
+    ).filter(User.id.in_(user_ids)):
+        key = (start_level, choosed_dont_know_level, answered_steps_counts.get(user_id, 0))
+        aggregate = db_session.get(AbandonedTestAggregate, key)
+        if aggregate is None:
+            aggregate = AbandonedTestAggregate(
+                start_level=start_level,
+                choosed_dont_know_level=choosed_dont_know_level,
+                answered_steps_count=key[2],
+                users_count=0,
+            )
+            db_session.add(aggregate)
+        aggregate.users_count += 1
+
+
+def delete_abandoned_tests(cutoff: datetime) -> tuple[int, int]:
+    """Returns the numbers of deleted tests and progress steps."""
+    deleted_tests_count, deleted_steps_count = 0, 0
+    last_user_id = 0
+    while user_ids := _find_abandoned_user_ids(cutoff, last_user_id):
+        last_user_id = user_ids[-1]
+        # The detected level is not stored for the tests finished before it was introduced, these are kept
+        abandoned_user_ids = []
+        for user_id, stats in get_passed_levels_stats_for_users(user_ids).items():
+            finished_level, _ = process_stats(stats)
+            if finished_level is None:
+                abandoned_user_ids.append(user_id)
+            else:
+                db_session.query(User).filter(User.id == user_id).update({User.detected_level: finished_level})
+
+        if abandoned_user_ids:
+            _aggregate_abandoned_tests(abandoned_user_ids)
+            deleted_steps_count += db_session.execute(
+                delete(ProgressStep).where(ProgressStep.user_id.in_(abandoned_user_ids))
+            ).rowcount
+            deleted_tests_count += db_session.execute(delete(User).where(User.id.in_(abandoned_user_ids))).rowcount
+        db_session.commit()
+        _pause()
+    return deleted_tests_count, deleted_steps_count
+
+
+def delete_old_page_openings(cutoff: datetime) -> int:
+    deleted_count = 0
+    while True:
+        uuids = [analytics_uuid for analytics_uuid, in db_session.query(UserAnalytics.uuid).filter(
+            UserAnalytics.timestamp < cutoff,
+            UserAnalytics.analytics_folded.is_(True),  # Counted in the page openings
+        ).limit(RETENTION_CHUNK_SIZE)]
+        if not uuids:
+            return deleted_count
+        deleted_count += db_session.execute(delete(UserAnalytics).where(UserAnalytics.uuid.in_(uuids))).rowcount
+        db_session.commit()
+        _pause()
+
+
+def delete_expired_sessions(now: datetime) -> int:
+    session_model = current_app.session_interface.sql_session_model
+    deleted_count = 0
+    while True:
+        session_ids = [session_id for session_id, in db_session.query(session_model.id).filter(
+            session_model.expiry < now,
+        ).limit(RETENTION_CHUNK_SIZE)]
+        if not session_ids:
+            return deleted_count
+        deleted_count += db_session.execute(delete(session_model).where(session_model.id.in_(session_ids))).rowcount
+        db_session.commit()
+        _pause()
+
+
+def run_retention() -> RetentionReport:
+    """Deletes the data that is past its retention, in every shard. Must be called within an app context."""
+    now = datetime.utcnow()
+    # A user is never deleted while a session may still continue their test
+    abandoned_test_retention = max(
+        timedelta(days=ABANDONED_TEST_RETENTION_DAYS),
+        current_app.permanent_session_lifetime,
+    )
+    abandoned_tests, progress_steps, page_openings = 0, 0, 0
+    for _ in iter_shards():
+        refresh_analytics_aggregates()  # So that the rows are folded before deleting
+        deleted_tests_count, deleted_steps_count = delete_abandoned_tests(now - abandoned_test_retention)
+        abandoned_tests += deleted_tests_count
+        progress_steps += deleted_steps_count
+        page_openings += delete_old_page_openings(now - timedelta(days=PAGE_OPENING_RETENTION_DAYS))
+    report = RetentionReport(
+        abandoned_tests=abandoned_tests,
+        progress_steps=progress_steps,
+        page_openings=page_openings,
+        sessions=delete_expired_sessions(now),  # Not sharded
+    )
+    logger.info(f'Retention: {report.to_json()}')
+    return report
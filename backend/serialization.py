@@ -0,0 +1,113 @@
+"""
+Fast JSON encoding of the result records.
+
+The large responses (detailed results, analytics topics) are encoded straight from the query rows into JSON strings,
+without building an intermediate record and dict per row, and are streamed in chunks. The encoded objects have the
+same keys in the same order as the `to_json()` of the corresponding records in `backend.types`.
+"""
+from json import dumps
+from json.encoder import encode_basestring_ascii as _encode_string  # type: ignore[attr-defined]
+from typing import Iterable, Iterator, Optional
+
+from backend.types import AllAnalytics, AnswerType, LanguageLevel, QuestionCategory, media_type_for_filepath
+
+
+STREAM_CHUNK_ITEMS = 500
+
+_ANSWER_TYPE_JSON = {answer_type: _encode_string(answer_type.value) for answer_type in AnswerType}
+_CATEGORY_JSON = {category: _encode_string(category.value) for category in QuestionCategory}
+
+
+def _encode_optional_string(value: Optional[str]) -> str:
+    return 'null' if value is None else _encode_string(value)
+
+
+def encode_passed_step(
+        question_title: str,
+        language_level: LanguageLevel,
+        answer_type: AnswerType,
+        answer_options: Optional[str],
+        filepath: Optional[str],
+        correct_answer: str,
+        given_answer: Optional[str],
+) -> str:
+    """Encodes a row of `iter_passed_steps_rows` as `PassedStep.to_json()` would."""
+    return (
+        f'{{"question_title":{_encode_string(question_title)},'
+        f'"language_level":{language_level.value},'
+        f'"answer_type":{_ANSWER_TYPE_JSON[answer_type]},'
+        f'"answer_options":{_encode_optional_string(answer_options)},'
+        f'"correct_answer":{_encode_string(correct_answer)},'
+        f'"media_type":"{media_type_for_filepath(filepath)}",'
+        f'"filepath":{_encode_optional_string(filepath)},'
+        f'"given_answer":{_encode_optional_string(given_answer)}}}'
+    )
+
+
+_MEDIA_TYPE_BY_CATEGORY = {category: 'none' for category in QuestionCategory} | {
+    QuestionCategory.READING: 'text',
+    QuestionCategory.LISTENING: 'audio',
+}
+
+
+def media_type_for_category(category: QuestionCategory) -> str:
+    """Media type of the question, as in `Question.to_json()`."""
+    return _MEDIA_TYPE_BY_CATEGORY[category]
+
+
+def encode_batch_question(
+        step_number: int,
+        question_title: str,
+        category: QuestionCategory,
+        answer_type: AnswerType,
+        answer_options: Optional[str],
+        filepath: Optional[str],
+) -> str:
+    """Encodes a question of a level batch as `Question.to_json()` with the step number would."""
+    return (
+        f'{{"step_number":{int(step_number)},'
+        f'"question_title":{_encode_string(question_title)},'
+        f'"answer_type":{_ANSWER_TYPE_JSON[answer_type]},'
+        f'"answer_options":{_encode_optional_string(answer_options)},'
+        f'"filepath":{_encode_optional_string(filepath)},'
+        f'"media_type":"{_MEDIA_TYPE_BY_CATEGORY[category]}"}}'
+    )
+
+
+def encode_topic_success(
+        category: QuestionCategory,
+        topic_title: str,
+        questions_count: int,
+        correct_answers_count: int,
+) -> str:
+    """Encodes the fields of a `TopicSuccessData` as its `to_json()` would."""
+    return (
+        f'{{"category":{_CATEGORY_JSON[category]},'
+        f'"topic_title":{_encode_string(topic_title)},'
+        f'"questions_count":{int(questions_count)},'
+        f'"correct_answers_count":{int(correct_answers_count)}}}'
+    )
+
+
+def stream_json_array(encoded_items: Iterable[str], chunk_items: int = STREAM_CHUNK_ITEMS) -> Iterator[bytes]:
+    """Joins already encoded items into a JSON array, yielding it in chunks of `chunk_items` items."""
+    buffer = ['[']
+    separator = ''
+    for encoded_item in encoded_items:
+        buffer.append(separator)
+        buffer.append(encoded_item)
+        separator = ','
+        if len(buffer) >= 2 * chunk_items:
+            yield ''.join(buffer).encode()
+            buffer.clear()
+    buffer.append(']')
+    yield ''.join(buffer).encode()
+
+
+def stream_all_analytics(analytics: AllAnalytics) -> Iterator[bytes]:
+    stages_json = dumps(analytics.stages_analytics.to_json(), separators=(',', ':'))
+    distribution_json = dumps([list(entry) for entry in analytics.start_level_selection_distribution])
+    yield f'{{"stages_analytics":{stages_json},"start_level_selection_distribution":{distribution_json},'.encode()
+    yield b'"topics_success":'
+    yield from stream_json_array(encode_topic_success(*topic) for topic in analytics.topics_success)
+    yield b'}'
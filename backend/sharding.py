@@ -0,0 +1,141 @@
+"""
+Routing of the users' data to one of several databases.
+
+With `DATABASE_SHARD_URIS` (comma-separated) set, every user lives in one of these databases, chosen by a hash of
+`User.uuid`. A shard is a complete database: the user's progress steps, archive and page opening are in the same
+shard, along with the analytics aggregates of that shard's users. `question` is replicated to every shard (and to
+`DATABASE_URI`), so the joins with it stay local. Only the server-side sessions stay in `DATABASE_URI`, since the
+shard is found from the session.
+
+A request is routed to the shard of the user in its URL (the results pages) or in its session. Code running outside
+of a user's request (the admin endpoints, background threads and scripts) selects the shard with `using_shard`, or
+fans out with `iter_shards` and merges the results. Touching the users' tables with no shard selected raises
+`ShardNotSelected`, instead of silently reading a single shard.
+
+The shard of a user depends on the number of shards, so adding a shard requires moving the users. Without
+`DATABASE_SHARD_URIS` everything is in `DATABASE_URI` and nothing is routed.
+"""
+import hashlib
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+from flask import Flask, current_app, request, session as flask_session
+from flask_sqlalchemy.session import Session as SqlAlchemySession
+from sqlalchemy import Table, inspect
+from sqlalchemy.sql.util import find_tables
+
+
+SHARD_BIND_KEY_PREFIX = 'shard-'
+UNSHARDED_TABLE_NAMES = frozenset({'sessions'})
+REPLICATED_TABLE_NAMES = frozenset({'question'})
+# Added to the user ids of a shard when the rows of all the shards are merged, so that the ids stay unique
+SHARD_USER_ID_STRIDE = 1 << 40
+
+current_shard: ContextVar[Optional[int]] = ContextVar('current_shard', default=None)
+
+
+class ShardNotSelected(RuntimeError):
+    pass
+
+
+def get_shard_uris() -> list[str]:
+    return [uri.strip() for uri in os.environ.get('DATABASE_SHARD_URIS', '').split(',') if uri.strip()]
+
+
+def get_shard_binds(shard_uris: list[str]) -> dict[str, str]:
+    return {f'{SHARD_BIND_KEY_PREFIX}{shard_index}': uri for shard_index, uri in enumerate(shard_uris)}
+
+
+def get_shards_count() -> int:
+    """Returns 1 when not sharded, the default database being the only shard."""
+    return max(len(current_app.config['DATABASE_SHARD_URIS']), 1)
+
+
+def is_sharded() -> bool:
+    return len(current_app.config['DATABASE_SHARD_URIS']) > 0
+
+
+def get_shard_engines() -> list[Any]:
+    engines = current_app.extensions['sqlalchemy'].engines
+    return [engines[bind_key] for bind_key in get_shard_binds(current_app.config['DATABASE_SHARD_URIS'])]
+
+
+def shard_for_uuid(user_uuid: str, shards_count: int) -> int:
+    digest = hashlib.blake2b(user_uuid.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards_count
+
+
+@contextmanager
+def using_shard(shard_index: Optional[int]) -> Iterator[None]:
+    token = current_shard.set(shard_index)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+def iter_shards() -> Iterator[int]:
+    """
+    Selects every shard in turn, yielding its index. Commit before moving on: the session is closed after every
+    shard, so that the objects of different shards, which may have the same primary keys, are never mixed.
+    """
+    session = current_app.extensions['sqlalchemy'].session
+    for shard_index in range(get_shards_count()):
+        with using_shard(shard_index):
+            try:
+                yield shard_index
+            finally:
+                session.close()
+
+
+def select_request_shard(user_uuid: Optional[str]) -> None:
+    """Routes the rest of the request to the shard of the user. The shard is unselected when the request ends."""
+    if user_uuid is not None and is_sharded():
+        current_shard.set(shard_for_uuid(user_uuid, get_shards_count()))
+
+
+def _select_shard_before_request() -> None:
+    user_uuid = (request.view_args or {}).get('user_uuid') or flask_session.get('user_uuid')
+    select_request_shard(user_uuid)
+
+
+def _unselect_shard(_: Optional[BaseException]) -> None:
+    current_shard.set(None)
+
+
+def _get_table_names(mapper: Any, clause: Any) -> set[str]:
+    table_names = set()
+    if mapper is not None:
+        table_names.add(inspect(mapper).local_table.name)
+    if clause is not None:
+        table_names.update(
+            table.name for table in find_tables(clause, include_crud=True) if isinstance(table, Table)
+        )
+    return table_names
+
+
+class ShardedSession(SqlAlchemySession):
+    """Sends the statements that touch the users' tables to the engine of the selected shard."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and current_app.config['DATABASE_SHARD_URIS']:
+            table_names = _get_table_names(mapper, clause)
+            if not table_names & UNSHARDED_TABLE_NAMES:
+                shard_index = current_shard.get()
+                if shard_index is not None:
+                    return self._db.engines[f'{SHARD_BIND_KEY_PREFIX}{shard_index}']
+                if not table_names or not table_names <= REPLICATED_TABLE_NAMES:
+                    raise ShardNotSelected(f'No shard is selected for a statement on {sorted(table_names)}')
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def create_shard_tables() -> None:
+    metadata = current_app.extensions['sqlalchemy'].metadata
+    for engine in get_shard_engines():
+        metadata.create_all(bind=engine)
+
+
+def init_sharding(app: Flask) -> None:
+    app.before_request(_select_shard_before_request)
+    app.teardown_request(_unselect_shard)
@@ -0,0 +1,43 @@
+"""
+Embedded SQLite mode, for small deployments and the tests.
+
+With a `sqlite:///path` `DATABASE_URI` (or shard URI) the app runs without a database server. Every SQLite connection
+is switched to WAL, so readers and the writer don't block each other, and is tuned for a web app: `synchronous=NORMAL`
+(still safe from corruption with WAL, only the last transactions may be lost on a power failure), a busy timeout
+instead of failing right away on a locked database, and a larger page cache and memory map. The connections are
+pooled, and a request keeps its connection for its whole duration, so a query costs an in-process call instead of a
+network round trip.
+"""
+import sqlite3
+from typing import Any
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),  # Milliseconds
+    ('cache_size', -64000),  # Negative is in KiB
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', 256 * 1024 * 1024),
+)
+
+
+def is_sqlite_uri(database_uri: str) -> bool:
+    return database_uri.startswith('sqlite')
+
+
+def _configure_connection(dbapi_connection: Any, _: Any) -> None:
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+
+def init_sqlite() -> None:
+    """Tunes every SQLite connection opened from now on. Connections to the other databases are left as they are."""
+    if not event.contains(Engine, 'connect', _configure_connection):
+        event.listen(Engine, 'connect', _configure_connection)
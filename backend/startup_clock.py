@@ -0,0 +1,8 @@
+"""
+Start time of the startup report. Imported first by `backend/__init__.py`, so that the imports phase of the report
+covers the imports of all the other modules.
+"""
+import time
+
+
+IMPORTS_START_TIME = time.perf_counter()
@@ -1,21 +1,66 @@
 from copy import deepcopy
+import datetime
+import gzip
 from http import HTTPStatus
 import importlib
-from flask import Response
+from flask import Response, jsonify
 from flask.testing import FlaskClient
+from marshmallow import ValidationError
+import numpy as np
 import pytest
 import json
 import os
+import subprocess
+import sys
+import time
+import types
 
-from sqlalchemy import MetaData, inspect
+from sqlalchemy import MetaData, func, inspect, select, text
+from sqlalchemy.exc import OperationalError
 from backend import create_basic_app, initialize_app_modules
-from backend import models, db
+from backend import adaptive, metrics, models, profiling, db
 from backend.flow_logic import compute_detailed_stats, compute_summarized_stats, generate_progress_steps_batch, get_passed_levels_stats, get_questions_counts
 
-from backend.models import ProgressStep, Question, User, db_session
-from backend.types import AnswerType, LanguageLevel, PassedLevelStats, QuestionCategory, QuestionCountEntry, SummarizedStats, TopicSuccessData
+from backend.answer_log import LoggedAnswer, answer_log, apply_answers
+from backend.archive import (
+    ArchivedStep,
+    archive_finished_test,
+    archive_finished_tests,
+    compact_archived_steps,
+    pack_finished_test,
+    unpack_finished_test,
+)
+from backend.adaptive import MAX_QUESTIONS, ItemTable, get_item_table, invalidate_item_table, process_adaptive_responses
+from backend.batch_pool import BatchPool
+from backend.bootstrap import render_index_html
+from backend.admin import calculate_all_analytics, refresh_analytics_aggregates
+from backend.item_analytics import AnswerColumns, compute_item_stats, load_answer_columns
+from backend.json_provider import FastJSONProvider, JSONFragment
+from backend.models import AbandonedTestAggregate, AnalyticsWatermark, FinishedTest, ProgressStep, Question, User, UserAnalytics, db_session
+from backend.question_bank import QuestionBankSnapshot, insert_snapshot_questions, question_bank, write_snapshot
+from backend.question_bank_compiler import compile_question_bank
+from backend.query_stats import (
+    QueryBudgetExceeded,
+    count_queries,
+    get_endpoint_query_stats,
+    query_budget,
+    reset_endpoint_query_stats,
+)
+from backend import answer_log as answer_log_module, retention
+from backend.sqlite import is_sqlite_uri
+from backend.sharding import ShardNotSelected, iter_shards, shard_for_uuid
+from backend.traffic_capture import traffic_capture
+from backend.serialization import encode_passed_step, stream_all_analytics, stream_json_array
+from backend.validation import compile_schema
+from backend.rest_api import AnswersSchema, NextStepSchema, StartSchema
+from backend.types import NEXT_LANGUAGE_LEVEL, PREVIOUS_LANGUAGE_LEVEL, AllAnalytics, AnswerType, LanguageLevel, PassedLevelStats, PassedStep, QuestionCategory, QuestionCountEntry, StagesAnalytics, SummarizedStats, TopicSuccessData
 
-os.environ["DATABASE_URI"] = f'{os.environ["DATABASE_URI"].rsplit("/", maxsplit=1)[0]}/mooi_test'  # mock the db name for tests
+# Every test gets its own SQLite database, so that the tests are independent and can run in parallel. With a MySQL
+# `DATABASE_URI`, the tests share its `mooi_test` database instead.
+SERVER_DATABASE_URI = None
+if not is_sqlite_uri(os.environ.get('DATABASE_URI', 'sqlite://')):
+    SERVER_DATABASE_URI = f'{os.environ["DATABASE_URI"].rsplit("/", maxsplit=1)[0]}/mooi_test'  # mock the db name for tests
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
 
 make_test_questions_a1_1_one_per_group = lambda: [
     Question(
@@ -95,7 +140,7 @@ make_test_questions_a1_2_one_per_group = lambda: [
         topic_title='Future Simple',
         question_title='What is the correct form of the verb?',
         filepath=None,
-        answer_type=AnswerType.FILL_THE_BLANK,
+        answer_type=AnswerType.SELECT_ONE,
         answer_options=json.dumps(['will', 'shall', 'going to']),
         correct_answer='2',
     ), Question(
@@ -117,7 +162,7 @@ make_test_questions_a1_2_one_per_group = lambda: [
         filepath='audiofile-1.mp3',
         answer_type=AnswerType.FILL_THE_BLANK,
         answer_options=None,
-        correct_answer='awesome',
+        correct_answer=json.dumps(['awesome']),
     ), 
 ]
 
@@ -150,9 +195,11 @@ make_test_question_counts = lambda: [
 make_test_users = lambda: [
     User(
         id=10,
+        uuid='test-user-uuid',
         email='some-email@example.com',
         full_name='Georgiy Vasilyev',
         start_level=LanguageLevel.A1_1,
+        choosed_dont_know_level=False,
     ),
 ]
 
@@ -162,21 +209,25 @@ make_test_progress_steps_a1_1 = lambda: [
         step_number=0,
         question_id=1,
         answer='0',
+        is_correct=True,
     ), ProgressStep(
         user_id=10,
         step_number=1,
         question_id=3,
         answer='2',
+        is_correct=True,
     ), ProgressStep(
         user_id=10,
         step_number=2,
         question_id=4,
         answer='2',
+        is_correct=False,
     ), ProgressStep(
         user_id=10,
         step_number=3,
         question_id=6,
         answer='3',
+        is_correct=True,
     ),
 ]
 
@@ -186,23 +237,28 @@ make_test_progress_steps_a1_2 = lambda: [
         step_number=4,
         question_id=7,
         answer='1',
+        is_correct=False,
     ), ProgressStep(
         user_id=10,
         step_number=5,
         question_id=8,
         answer='12',
+        is_correct=True,
     ), ProgressStep(
         user_id=10,
         step_number=6,
         question_id=9,
         answer='0',
+        is_correct=False,
     ),
 ]
 
 
-@pytest.fixture()
-def client():
+def make_test_client() -> FlaskClient:
     app = create_basic_app()
+    # The metadata of every bind is kept by `db`, forget the shards of the apps created by the previous tests
+    for bind_key in [key for key in db.metadatas if key is not None and key not in app.config['SQLALCHEMY_BINDS']]:
+        del db.metadatas[bind_key]
     with app.app_context():
         db.reflect()
         db.drop_all()
@@ -214,8 +270,19 @@ def client():
         db.create_all()
     initialize_app_modules(app=app)
     app.testing = True
-    client = app.test_client()
-    yield client
+    return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def database_uri(monkeypatch, tmp_path):
+    database_uri = SERVER_DATABASE_URI or f'sqlite:///{tmp_path / "mooi.db"}'
+    monkeypatch.setenv('DATABASE_URI', database_uri)
+    return database_uri
+
+
+@pytest.fixture()
+def client():
+    yield make_test_client()
 
 
 def test_questions_count(client: FlaskClient):
@@ -335,11 +402,47 @@ def test_compute_detailed_stats(client: FlaskClient):
     assert len(passed_steps) == len(make_test_progress_steps_a1_1()) + len(make_test_progress_steps_a1_2())
 
 
-def test_index(client: FlaskClient):
+def read_bootstrap_state(response: Response) -> dict:
+    html = response.data.decode('utf-8')
+    start_tag = '<script id="bootstrap" type="application/json">'
+    return json.loads(html[html.index(start_tag) + len(start_tag):html.index('</script></head>')])
+
+
+def test_index(client: FlaskClient, tmp_path):
+    (tmp_path / 'index.html').write_text('<!doctype html><head><title>Mooi</title></head><div id="root"></div>')
+    client.application.config['FRONTEND_BUILD_DIR'] = str(tmp_path)
     response: Response = client.get('/')
     assert response.status_code == 200
-    with open('frontend/build/index.html', 'r') as file:
-        assert file.read() == response.data.decode('utf-8')
+    assert response.data.decode('utf-8') == (
+        '<!doctype html><head><title>Mooi</title><script id="bootstrap" type="application/json">'
+        '{"status":{"status":"NOT_STARTED"}}</script></head><div id="root"></div>'
+    )
+    assert 'private' in response.headers['Cache-Control']
+
+    # The status is inlined from the session, the same as `/api/status` returns
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group() + make_test_questions_a1_2_one_per_group())
+        db_session.commit()
+    response = client.post('/api/start', json={'email': 'test@example.com', 'full_name': 'Test User', 'start_level': 'A1_1'})
+    assert read_bootstrap_state(client.get('/')) == {'status': {'status': 'IN_PROGRESS', 'question': response.json}}
+    response = client.post('/api/next-step', json={'answer': '0'})
+    assert read_bootstrap_state(client.get('/')) == {'status': {'status': 'IN_PROGRESS', 'question': response.json}}
+    assert client.get('/api/status').json == {'status': 'IN_PROGRESS', 'question': response.json}
+    for answer in ['2', '0', 'xyz', 'xyz', 'xyz', 'awesome']:
+        response = client.post('/api/next-step', json={'answer': answer})
+    finished_status = {'status': 'FINISHED', 'user_uuid': response.json['user_uuid']}
+    assert read_bootstrap_state(client.get('/')) == {'status': finished_status}
+    assert client.get('/api/status').json == finished_status
+
+    # Not known from the sessions started before the status was remembered
+    with client.session_transaction() as session:
+        del session['finished_user_uuid']
+    assert read_bootstrap_state(client.get('/')) == {'status': None}
+    assert client.get('/api/status').json == finished_status
+
+    with client.application.app_context():
+        html = render_index_html(str(tmp_path), {'title': '</script><script>alert(1)</script>'})
+        assert html.count('</script>') == 1
 
 
 def test_pass_the_test(client: FlaskClient):
@@ -416,3 +519,1061 @@ def test_pass_the_test(client: FlaskClient):
     with client.application.app_context():
         progress_steps_count = db_session.query(ProgressStep).count()
         assert progress_steps_count == len(test_questions_a1_1_one_per_group) + len(test_questions_a1_2_one_per_group)
+
+
+def test_query_budgets(client: FlaskClient):
+    """Guards the number of queries per endpoint (including the session load and save)"""
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.commit()
+
+    with query_budget(3):
+        response = client.get('/api/status')
+    assert response.headers['Server-Timing'].startswith('db;dur=')
+
+    with query_budget(16):
+        client.post(
+            '/api/start',
+            json={
+                'email': 'test@example.com',
+                'full_name': 'Test User',
+                'start_level': 'A1_1',
+            },
+        )
+
+    with query_budget(7):
+        client.post('/api/next-step', json={'answer': '0'})
+
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(1):
+            client.get('/api/status')
+
+    # A failed statement doesn't leave its start time to the next statements of the pooled connection
+    with client.application.app_context(), db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text('SELECT * FROM missing_table'))
+        assert connection.info['query_start_time'] == []
+
+
+def test_metrics(client: FlaskClient, tmp_path, monkeypatch):
+    monkeypatch.setenv('ADMIN_PASSWORD', 'admin-password')
+    authorization = {'Authorization': 'Bearer admin-password'}
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.commit()
+    client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    client.post('/api/next-step', json={'answer': '0'})
+
+    assert client.get('/api/metrics').status_code == 403
+    assert client.get('/api/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    metrics.active_test_sessions._cached_value = None
+    response = client.get('/api/metrics', headers=authorization)
+    assert response.status_code == 200
+    exposition = response.data.decode('utf-8')
+    assert '# TYPE mooi_http_request_duration_seconds histogram' in exposition
+    assert 'mooi_http_request_duration_seconds_count{endpoint="main.api.start",method="POST",status="200"}' in exposition
+    assert 'mooi_tests_started_total{level="A1.1"}' in exposition
+    assert 'mooi_answers_total{correct=' in exposition
+    assert 'mooi_active_test_sessions 1' in exposition
+    # The gauge is cached for the scrape interval
+    client.post('/api/next-step', json={'answer': '2'})
+    with query_budget(0):
+        assert metrics.active_test_sessions.expose({}) == ['mooi_active_test_sessions 1']
+
+    # Values of the other worker processes are summed
+    started_count = metrics.tests_started_total.dump()[json.dumps(['A1.1'])]
+    live_worker_file = tmp_path / f'metrics-{os.getppid()}-{metrics._get_process_start_time(os.getppid())}.json'
+    live_worker_file.write_text(json.dumps({'mooi_tests_started_total': {json.dumps(['A1.1']): 2}}))
+    # The file of an exited worker whose pid was reused is merged into the tombstone
+    exited_worker_file = tmp_path / f'metrics-{os.getppid()}-1.json'
+    exited_worker_file.write_text(json.dumps({'mooi_tests_started_total': {json.dumps(['A1.1']): 3}}))
+    metrics.REGISTRY.multiproc_dir = tmp_path
+    try:
+        for _ in range(2):  # The merged values are counted once
+            exposition = client.get('/api/metrics', headers=authorization).data.decode('utf-8')
+            assert f'mooi_tests_started_total{{level="A1.1"}} {int(started_count) + 5}' in exposition
+    finally:
+        metrics.REGISTRY.multiproc_dir = None
+    assert live_worker_file.exists() and not exited_worker_file.exists()
+    assert json.loads((tmp_path / 'tombstone.json').read_text())['metrics'] == {
+        name: {} for name in metrics.REGISTRY.metrics
+    } | {'mooi_tests_started_total': {json.dumps(['A1.1']): 3}}
+
+
+def test_profiling(client: FlaskClient, monkeypatch):
+    monkeypatch.setenv('PROFILING_ENABLED', '1')
+    monkeypatch.setenv('ADMIN_PASSWORD', 'admin-password')
+    profiling.init_profiling(client.application)
+    profiling.sampler.reset()
+
+    original_start_profiling = profiling.sampler.start_profiling
+
+    def start_profiling_and_sample(thread_id: int, endpoint: str):
+        original_start_profiling(thread_id, endpoint)
+        profiling.sampler._take_sample()
+    monkeypatch.setattr(profiling.sampler, 'start_profiling', start_profiling_and_sample)
+
+    client.get('/api/status')  # Not flagged, so not profiled
+    assert profiling.sampler.collapsed_stacks() == ''
+
+    client.get('/api/status', headers={profiling.PROFILE_REQUEST_HEADER: 'admin-password'})
+    response = client.post('/api/admin/profile', json={'admin_password': 'admin-password', 'reset': True})
+    assert response.status_code == 200
+    collapsed_stack, samples_count = response.data.decode('utf-8').strip().rsplit(' ', maxsplit=1)
+    assert collapsed_stack.startswith('main.api.status;')
+    assert 'backend.profiling:start_request_profiling' in collapsed_stack
+    assert samples_count == '1'
+    assert profiling.sampler.collapsed_stacks() == ''
+
+
+def test_compute_item_stats():
+    questions = [
+        (1, LanguageLevel.A1_1, QuestionCategory.GRAMMAR, 'Present Simple', AnswerType.SELECT_ONE, json.dumps(['am', 'is', 'are'])),
+        (2, LanguageLevel.A1_1, QuestionCategory.VOCABULARY, 'Medicine', AnswerType.SELECT_ONE, json.dumps(['pill', 'tree', 'car'])),
+        (3, LanguageLevel.A1_1, QuestionCategory.GRAMMAR, 'Past Simple', AnswerType.FILL_THE_BLANK, None),
+    ]
+    columns = AnswerColumns(
+        user_ids=np.array([1, 1, 2, 2]),
+        step_numbers=np.array([1, 2, 1, 2]),
+        question_ids=np.array([1, 2, 1, 2]),
+        timestamps=np.array([100.0, 130.0, 200.0, 260.0]),
+        is_correct=np.array([True, False, False, True]),
+        chosen_options=np.array([0b001, 0b010, 0b100, 0b001]),
+    )
+    first_stats, second_stats, third_stats = compute_item_stats(columns, questions)
+
+    assert first_stats.answers_count == 2
+    assert first_stats.difficulty == 0.5
+    assert first_stats.discrimination == -1.0
+    assert first_stats.option_choice_rates == [0.5, 0.0, 0.5]
+    assert first_stats.mean_answer_seconds is None
+
+    assert second_stats.option_choice_rates == [0.5, 0.5, 0.0]
+    assert second_stats.mean_answer_seconds == 45.0
+    assert second_stats.median_answer_seconds == 45.0
+
+    assert third_stats.answers_count == 0
+    assert third_stats.difficulty is None
+    assert third_stats.option_choice_rates is None
+
+
+def test_incremental_analytics(client: FlaskClient):
+    hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    make_users = lambda first_user_id, count: [
+        User(
+            id=user_id,
+            uuid=f'uuid-{user_id}',
+            timestamp=hour_ago,
+            email='some-email@example.com',
+            full_name='Georgiy Vasilyev',
+            start_level=LanguageLevel.A1_1,
+            choosed_dont_know_level=user_id % 2 == 0,
+        ) for user_id in range(first_user_id, first_user_id + count)
+    ]
+    make_answers = lambda user_id, answers: [
+        ProgressStep(
+            user_id=user_id,
+            step_number=step_number,
+            question_id=question.id,
+            timestamp=hour_ago,
+            answer=answer,
+            is_correct=question.is_answer_correct(answer) if answer is not None else None,
+        ) for step_number, (question, answer) in enumerate(zip(make_test_questions_a1_1_one_per_group(), answers))
+    ]
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.add_all([UserAnalytics(uuid=f'uuid-{index}', timestamp=hour_ago) for index in range(10)])
+        db_session.add_all(make_users(first_user_id=1, count=2))
+        db_session.add_all(make_answers(user_id=1, answers=['0', '2', '0', '3']))  # Passed A1.1, goes to A1.2
+        db_session.add_all(make_answers(user_id=2, answers=['0', '2', None, None]))
+        db_session.commit()
+
+        analytics = calculate_all_analytics()
+        assert analytics.stages_analytics.finished_the_test_percentage == 0
+        assert analytics.start_level_selection_distribution == [('A0', 50), ('A1_1', 50)]
+        assert [topic.questions_count for topic in analytics.topics_success] == [2, 2, 2]
+
+        # User 2 fails the remaining questions and finishes the test with A0
+        for progress_step in db_session.query(ProgressStep).filter(ProgressStep.user_id == 2, ProgressStep.answer.is_(None)):
+            progress_step.answer = 'xyz'
+            progress_step.is_correct = False
+            progress_step.timestamp = hour_ago + datetime.timedelta(minutes=1)
+        db_session.add_all(make_users(first_user_id=3, count=3))
+        db_session.commit()
+
+        analytics = calculate_all_analytics()
+        assert analytics.stages_analytics.finished_the_test_percentage == 10
+        assert analytics.stages_analytics.started_the_test_percentage == 40
+        assert analytics.start_level_selection_distribution == [('A0', 40), ('A1_1', 60)]
+        assert analytics.topics_success == [
+            TopicSuccessData(QuestionCategory.GRAMMAR, 'Past Simple', 2, 2),
+            TopicSuccessData(QuestionCategory.GRAMMAR, 'Present Simple', 2, 2),
+            TopicSuccessData(QuestionCategory.VOCABULARY, 'Medicine', 4, 2),
+        ]
+
+        # Already folded rows are flagged, and not scanned again
+        assert db_session.query(ProgressStep).filter(
+            ProgressStep.answer.isnot(None),
+            ProgressStep.analytics_folded.is_(False),
+        ).count() == 0
+        assert db_session.query(User).filter(User.analytics_folded.is_(False)).count() == 0
+        assert calculate_all_analytics() == analytics
+        # Flagging keeps the times of the answers
+        assert {timestamp for timestamp, in db_session.query(ProgressStep.timestamp).filter(
+            ProgressStep.user_id == 2,
+            ProgressStep.step_number >= 2,
+        )} == {hour_ago + datetime.timedelta(minutes=1)}
+
+        # A row committed after a refresh is folded by the next one, even if its timestamp is older
+        db_session.add(UserAnalytics(uuid='late-opening', timestamp=hour_ago - datetime.timedelta(days=1)))
+        db_session.commit()
+        calculate_all_analytics()
+        assert db_session.query(AnalyticsWatermark).one().page_opened_count == 11
+
+
+def test_process_adaptive_responses():
+    difficulty_by_question_id = {}
+    for level in (LanguageLevel.A1_1, LanguageLevel.A1_2, LanguageLevel.A2_1):
+        for offset in (-0.4, -0.2, 0, 0.2, 0.4) * 4:
+            difficulty_by_question_id[len(difficulty_by_question_id) + 1] = level.value + offset
+    sorted_items = sorted((difficulty, question_id) for question_id, difficulty in difficulty_by_question_id.items())
+    item_table = ItemTable(
+        sorted_difficulties=[difficulty for difficulty, _ in sorted_items],
+        sorted_question_ids=[question_id for _, question_id in sorted_items],
+        difficulty_by_question_id=difficulty_by_question_id,
+        level_difficulties={LanguageLevel.A1_1: 2, LanguageLevel.A1_2: 3, LanguageLevel.A2_1: 4},
+    )
+
+    for always_correct, expected_level in ((True, LanguageLevel.A2_1), (False, LanguageLevel.A0)):
+        responses = []
+        while True:
+            decision = process_adaptive_responses(responses, LanguageLevel.A1_2, item_table)
+            if decision.finished_with_level is not None:
+                break
+            assert decision.next_question_id not in {question_id for question_id, _ in responses}
+            responses.append((decision.next_question_id, always_correct))
+        assert decision.finished_with_level == expected_level
+        assert len(responses) <= MAX_QUESTIONS
+
+
+def test_pass_the_adaptive_test(client: FlaskClient):
+    client.application.config['ADAPTIVE_TESTING'] = True
+    invalidate_item_table()
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.commit()
+    response = client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    assert response.status_code == 200
+
+    for _ in range(MAX_QUESTIONS):
+        response = client.post('/api/next-step', json={'answer': 'xyz'})
+        if response.json.get('finished') is True:
+            break
+    assert response.json['finished'] is True
+
+    with client.application.app_context():
+        user = db_session.query(User).one()
+        assert user.detected_level == LanguageLevel.A0
+        assert db_session.query(ProgressStep).filter(ProgressStep.answer.is_(None)).count() == 0
+    assert client.get('/api/status').json == {'status': 'FINISHED', 'user_uuid': user.uuid}
+    assert client.get(f'/api/results/{user.uuid}/summarized').json['detected_level'] == LanguageLevel.A0.value
+
+
+def test_adaptive_test_without_questions(client: FlaskClient):
+    client.application.config['ADAPTIVE_TESTING'] = True
+    invalidate_item_table()
+    response = client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    assert response.status_code == 200
+    assert response.json['finished'] is True
+    with client.application.app_context():
+        assert db_session.query(User).one().detected_level == LanguageLevel.A0
+        assert db_session.query(ProgressStep).count() == 0
+
+
+def test_item_table_rebuilt_in_background(client: FlaskClient, monkeypatch):
+    invalidate_item_table()
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.commit()
+        stale_item_table = get_item_table()
+        assert get_item_table() is stale_item_table
+        monkeypatch.setattr(adaptive, '_item_table_built_at', time.monotonic() - adaptive.ITEM_TABLE_TTL_SECONDS - 1)
+        # The stale table is returned right away, while the new one is built
+        assert get_item_table() is stale_item_table
+        for _ in range(500):
+            if get_item_table() is not stale_item_table:
+                break
+            time.sleep(0.01)
+        assert get_item_table() is not stale_item_table
+        assert get_item_table() == stale_item_table  # Same answers, same difficulties
+    invalidate_item_table()
+
+
+def test_level_batch(client: FlaskClient):
+    test_questions = make_test_questions_a1_1_one_per_group() + [Question(
+        id=20,
+        level=LanguageLevel.A1_1,
+        category=QuestionCategory.LISTENING,
+        topic_title='Audio',
+        question_title='What is the weather like?',
+        filepath='audiofile-2.mp3',
+        answer_type=AnswerType.SELECT_ONE,
+        answer_options=json.dumps(['sunny', 'rainy']),
+        correct_answer='0',
+    )]
+    test_questions_json = [question.to_json() for question in test_questions]
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+    assert client.get('/api/level-batch').status_code == 400
+
+    client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    response = client.get('/api/level-batch')
+    assert response.status_code == 200
+    assert response.json['next_level_step_number'] == len(test_questions)
+    assert [question['step_number'] for question in response.json['questions']] == [1, 2, 3, 4, 5]
+    assert sorted(question['question_title'] for question in response.json['questions']) == sorted(
+        question['question_title'] for question in test_questions_json
+    )
+    assert response.headers['Link'] == '</api/media/audiofile-2.mp3>; rel=preload; as=audio'
+
+    # Answers for the prefetched questions have to come in order
+    response = client.post('/api/next-step', json={'answer': '0', 'step_number': 2})
+    assert response.status_code == 409
+    response = client.post('/api/next-step', json={'answer': '0', 'step_number': 1})
+    assert response.status_code == 200
+    assert [question['step_number'] for question in client.get('/api/level-batch').json['questions']] == [2, 3, 4, 5]
+
+
+def test_submit_answers(client: FlaskClient):
+    test_questions = make_test_questions_a1_1_one_per_group()
+    correct_answers = {question.question_title: question.correct_answer for question in test_questions}
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+    assert client.post('/api/answers', json={'answers': {}}).status_code == 400
+
+    client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    response = client.post('/api/answers', json={})
+    assert response.status_code == 400
+    assert response.json == {'answers': ['Missing data for required field.']}
+    response = client.post('/api/answers', json={'answers': {'1': '0'}})
+    assert response.status_code == 409
+    with client.session_transaction() as session:  # Session data should have not changed
+        assert session['current_step_number'] == 1
+
+    batch = client.get('/api/level-batch').json['questions']
+    answers = {str(question['step_number']): 'xyz' for question in batch}
+    answers['1'] = correct_answers[batch[0]['question_title']]
+    answer_seconds = {str(question['step_number']): 20 for question in batch}
+    with query_budget(11):  # Including the archiving of the finished test
+        response = client.post('/api/answers', json={'answers': answers, 'answer_seconds': answer_seconds})
+    assert response.status_code == 200
+    assert response.json['finished'] == True
+
+    with client.application.app_context():
+        progress_steps = db_session.query(ProgressStep).order_by(ProgressStep.step_number).all()
+        assert [step.answer for step in progress_steps] == [answers[str(step.step_number)] for step in progress_steps]
+        timestamps = [step.timestamp for step in progress_steps]  # Every answer keeps its own time
+        assert [(later - earlier).total_seconds() for earlier, later in zip(timestamps, timestamps[1:])] == [20] * 3
+        assert [step.is_correct for step in progress_steps] == [True, False, False, False]
+        assert db_session.query(User).one().detected_level == LanguageLevel.A0
+        detailed_stats_json = [step.to_json() for step in compute_detailed_stats(user_id=1)]
+    reset_endpoint_query_stats()
+    with count_queries() as counter:
+        assert client.get(f'/api/results/{response.json["user_uuid"]}/detailed').json == detailed_stats_json
+    # Including the queries of the streamed body and the session save, but not the session load before the request
+    assert get_endpoint_query_stats()['main.api.results_detailed']['queries'] == counter.queries - 1
+
+
+def test_batch_pool(client: FlaskClient):
+    test_questions = make_test_questions_a1_1_one_per_group() + make_test_questions_a1_1_many_in_group()
+    group_by_question_id = {
+        question.id: (question.category, question.answer_type, question.topic_title) for question in test_questions
+    }
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+
+        pool = BatchPool(depth=2)
+        pool.refill()
+        assert pool.batches_count(LanguageLevel.A1_1) == 2
+        assert pool.batches_count(LanguageLevel.B2_2) == 0  # No questions of this level
+
+        for expected_batches_count in (1, 0, 0):
+            question_ids = pool.take_batch(LanguageLevel.A1_1)
+            assert pool.batches_count(LanguageLevel.A1_1) == expected_batches_count
+            # One question of every group, in the order of the groups' first questions
+            assert [group_by_question_id[question_id] for question_id in question_ids] == [
+                (group.category, group.answer_type, group.topic_title) for group in make_test_question_counts()
+            ]
+
+        stale_pool = BatchPool(depth=1, max_age=-1)
+        stale_pool.refill()
+        stale_pool.take_batch(LanguageLevel.A1_1)
+        assert stale_pool.batches_count(LanguageLevel.A1_1) == 0
+
+
+def test_language_level_storage(client: FlaskClient):
+    assert LanguageLevel.A1_1 + 1 == NEXT_LANGUAGE_LEVEL[LanguageLevel.A1_1] == LanguageLevel.A1_2
+    assert LanguageLevel.A1_1 - 1 == PREVIOUS_LANGUAGE_LEVEL[LanguageLevel.A1_1] == LanguageLevel.A0
+    assert LanguageLevel.A0 not in PREVIOUS_LANGUAGE_LEVEL and LanguageLevel.B2_2 not in NEXT_LANGUAGE_LEVEL
+    assert LanguageLevel.A0 < LanguageLevel.A1_1 <= LanguageLevel.A1_1 < LanguageLevel.B2_2
+    with pytest.raises(ValueError):
+        LanguageLevel.A0 - 1
+    with pytest.raises(TypeError):
+        LanguageLevel.A0 > 1
+
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_2_one_per_group() + make_test_questions_a1_1_one_per_group())
+        db_session.commit()
+        # Levels are stored as numbers, so they are sorted by their order rather than by name
+        assert db.session.execute(text('SELECT DISTINCT level FROM question ORDER BY level')).scalars().all() == [
+            LanguageLevel.A1_1.value, LanguageLevel.A1_2.value,
+        ]
+        assert db_session.query(Question.level).order_by(Question.level).first()[0] == LanguageLevel.A1_1
+
+
+def test_serialization():
+    rows = [
+        ('Wat is "dit"?', LanguageLevel.A1_2, AnswerType.SELECT_ONE, json.dumps(['één', 'twee']), None, '0', '1'),
+        ('Lees de tekst', LanguageLevel.B1_1, AnswerType.FILL_THE_BLANK, None, 'text-1.txt', '["huis"]', None),
+        ('Luister', LanguageLevel.A0, AnswerType.SELECT_MULTIPLE, '[]', 'audiofile-1.mp3', '0,1', '0'),
+    ]
+    for row in rows:
+        encoded_step = encode_passed_step(*row)
+        assert json.loads(encoded_step) == PassedStep(*row[:5], correct_answer=row[5], given_answer=row[6]).to_json()
+        assert list(json.loads(encoded_step)) == list(PassedStep(*row[:5], row[5], row[6]).to_json())  # Same key order
+
+    assert b''.join(stream_json_array([])) == b'[]'
+    chunks = list(stream_json_array((encode_passed_step(*row) for row in rows), chunk_items=2))
+    assert len(chunks) == 2
+    assert json.loads(b''.join(chunks)) == [json.loads(encode_passed_step(*row)) for row in rows]
+
+    analytics = AllAnalytics(
+        stages_analytics=StagesAnalytics(100, 50, 25),
+        start_level_selection_distribution=[('A0', 40), ('A1_1', 60)],
+        topics_success=[TopicSuccessData(QuestionCategory.GRAMMAR, 'Présent', 10, 7)],
+    )
+    assert json.loads(b''.join(stream_all_analytics(analytics))) == analytics.to_json()
+
+
+def test_json_provider(client: FlaskClient):
+    payload = {
+        'level': LanguageLevel.A1_2,
+        'timestamp': datetime.datetime(2024, 1, 2, 3, 4, 5),
+        'stats': PassedLevelStats(LanguageLevel.A1_1, 80),
+        'fragments': [JSONFragment('{"answer_options":["één","twee"]}'), JSONFragment('null')],
+        'title': 'één',
+        'by_step_number': {1: JSONFragment('[1]'), 2: 'twee'},
+    }
+    expected = {
+        'level': LanguageLevel.A1_2.value,
+        'timestamp': '2024-01-02T03:04:05',
+        'stats': [LanguageLevel.A1_1.value, 80],
+        'fragments': [{'answer_options': ['één', 'twee']}, None],
+        'title': 'één',
+        'by_step_number': {'1': [1], '2': 'twee'},
+    }
+    with client.application.app_context():
+        for use_orjson in (True, False):
+            provider = FastJSONProvider(client.application, use_orjson=use_orjson)
+            assert provider.dumps({1: 'een', 2: [LanguageLevel.A1_1]}) == '{"1":"een","2":[2]}'
+            assert json.loads(provider.dumps(payload)) == expected
+            assert json.loads(provider.dumps(payload, indent=2)) == expected
+            assert provider.loads(provider.dumps(payload)) == expected
+        assert isinstance(client.application.json, FastJSONProvider)
+        assert json.loads(jsonify(payload).get_data()) == expected
+
+
+def test_http_middleware(client: FlaskClient, tmp_path, monkeypatch):
+    # Compression of the dynamic responses
+    monkeypatch.setenv('ADMIN_PASSWORD', 'admin-password')
+    response = client.get('/api/metrics', headers={'Accept-Encoding': 'gzip', 'Authorization': 'Bearer admin-password'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()).startswith(b'# HELP mooi_http_request_duration_seconds')
+    response = client.get('/api/status', headers={'Accept-Encoding': 'gzip'})  # Smaller than the threshold
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+    # Static files
+    client.application.static_folder = str(tmp_path)
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'main.3f2a1b9c.js').write_text('console.log("mooi")')
+    (tmp_path / 'js' / 'main.3f2a1b9c.js.gz').write_bytes(gzip.compress(b'console.log("mooi")'))
+    (tmp_path / 'manifest.json').write_text('{}')
+    response = client.get('/static/js/main.3f2a1b9c.js', headers={'Accept-Encoding': 'br;q=1.0, gzip;q=0.8'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/javascript'
+    assert gzip.decompress(response.get_data()) == b'console.log("mooi")'
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 3600
+    response = client.get('/static/js/main.3f2a1b9c.js')
+    assert 'Content-Encoding' not in response.headers and response.get_data() == b'console.log("mooi")'
+    response.close()
+    response = client.get('/static/manifest.json')
+    assert response.cache_control.no_cache and not response.cache_control.immutable
+    response.close()
+
+    # Results of the finished tests are revalidated with an ETag
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.add(User(
+            id=1,
+            uuid='finished-user',
+            email='test@example.com',
+            full_name='Test User',
+            start_level=LanguageLevel.A1_1,
+            choosed_dont_know_level=False,
+            detected_level=LanguageLevel.A1_1,
+        ))
+        db_session.add(ProgressStep(user_id=1, step_number=1, question_id=1, answer='0', is_correct=True))
+        db_session.commit()
+    for results_url in ('/api/results/finished-user/summarized', '/api/results/finished-user/detailed'):
+        response = client.get(results_url, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.cache_control.max_age == 60 and response.cache_control.must_revalidate
+        etag = response.headers['ETag']
+        uncompressed_data = client.get(results_url).get_data()
+        if results_url.endswith('detailed'):  # Streamed, so compressed regardless of the size
+            assert gzip.decompress(response.get_data()) == uncompressed_data
+        with query_budget(4):  # The user lookup and the session
+            response = client.get(results_url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+
+def test_compiled_validation():
+    payloads = {
+        NextStepSchema: [
+            {'answer': '0'}, {'answer': '0', 'step_number': 3}, {'answer': '0', 'step_number': '3'}, {},
+            {'answer': None}, {'answer': 1}, {'answer': '0', 'step_number': True}, {'answer': '0', 'extra': 1}, [],
+        ],
+        StartSchema: [
+            {'email': 'a@b.c', 'full_name': 'A B', 'start_level': 'A0'},
+            {'email': 'a@b.c', 'full_name': 'A B', 'start_level': 'C1'},
+            {'email': 'a@b.c', 'full_name': 'A B', 'start_level': 1},
+            {'email': 'a@b.c', 'start_level': 'A1_1'},
+        ],
+        AnswersSchema: [
+            {'answers': {'1': '0', '2': 'xyz'}}, {'answers': {}}, {'answers': {'01': '0', ' 2': '1'}},
+            {'answers': {'x': '0', '2': 3}}, {'answers': []},
+        ],
+    }
+    for schema_class, schema_payloads in payloads.items():
+        load = compile_schema(schema_class)
+        for payload in schema_payloads:
+            try:
+                expected = schema_class().load(payload)
+            except ValidationError as e:
+                with pytest.raises(ValidationError) as error_info:
+                    load(payload)
+                assert error_info.value.messages == e.messages
+            else:
+                assert load(payload) == expected
+
+
+def test_lazy_imports(client: FlaskClient):
+    # Heavy dependencies are not loaded by the web workers until an admin endpoint needs them
+    code = 'import sys, backend; print(sorted({"numpy", "openpyxl", "pydrive2"} & set(sys.modules)))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+    assert set(client.application.config['STARTUP_REPORT']) == {'imports', 'app creation', 'modules', 'create tables'}
+
+
+def test_question_bank_snapshot(client: FlaskClient, tmp_path):
+    test_questions = make_test_questions_a1_1_one_per_group() + make_test_questions_a1_1_many_in_group()
+    snapshot_path = tmp_path / 'question_bank.snapshot'
+    write_snapshot(test_questions, snapshot_path)
+    snapshot = QuestionBankSnapshot(snapshot_path)
+    assert len(snapshot) == len(test_questions)
+    for question in test_questions:
+        snapshot_question = snapshot.get(question.id)
+        assert snapshot_question.to_json() == question.to_json()
+        assert (snapshot_question.level, snapshot_question.topic_title) == (question.level, question.topic_title)
+        assert snapshot_question.is_answer_correct(question.correct_answer) is True
+    assert snapshot.get(1000) is None
+    assert [len(group) for group in snapshot.level_groups(LanguageLevel.A1_1)] == [
+        entry.questions_count for entry in make_test_question_counts()
+    ]
+    assert snapshot.level_groups(LanguageLevel.B1_1) == []
+
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group() + make_test_questions_a1_1_many_in_group())
+        db_session.commit()
+    question_bank.configure(snapshot_path)
+    try:
+        question_bank.check_interval = 0
+        response = client.post(
+            '/api/start',
+            json={
+                'email': 'test@example.com',
+                'full_name': 'Test User',
+                'start_level': 'A1_1',
+            },
+        )
+        first_question_title = response.json['question_title']
+        with query_budget(6):  # One less than with the DB, the questions are read from the snapshot
+            response = client.post('/api/next-step', json={'answer': '0'})
+        assert response.status_code == 200
+
+        # A rewritten snapshot is picked up without a restart
+        renamed_questions = deepcopy(test_questions)
+        for question in renamed_questions:
+            question.question_title = f'Renamed: {question.question_title}'
+        write_snapshot(renamed_questions, snapshot_path)
+        assert client.get('/api/status').json['question']['question_title'].startswith('Renamed: ')
+        assert not first_question_title.startswith('Renamed: ')
+    finally:
+        question_bank.configure(None)
+
+
+def write_topic_workbook(path, rows_by_sheet):
+    from openpyxl import Workbook
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for sheet_title, rows in rows_by_sheet.items():
+        sheet = workbook.create_sheet(sheet_title)
+        sheet.append(['Вопрос', 'Ответ'])
+        for row in rows:
+            sheet.append(row)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    workbook.save(path)
+
+
+def test_question_bank_compiler(client: FlaskClient, tmp_path, monkeypatch):
+    root_dir = tmp_path / 'test_data'
+    snapshot_path = tmp_path / 'question_bank.snapshot'
+    food_path = root_dir / 'A1.1' / 'Лексика' / 'Еда.xlsx'
+    write_topic_workbook(food_path, {
+        'Выбор одного варианта': [['Apple', 'Яблоко', 'Груша', 'Слива']],
+        'Заполнение пропуска': [['I ___ an apple', 'eat', 'ate']],
+    })
+    write_topic_workbook(root_dir / 'A1.2' / 'Грамматика' / 'Future Simple.xlsx', {
+        'Выбор нескольких вариантов': [['Future forms', '2', 'will go', 'am going to go', 'went']],
+    })
+
+    result = compile_question_bank(root_dir, snapshot_path)
+    assert result.questions_count == 3
+    assert result.parsed_workbooks == ['A1.1/Лексика/Еда.xlsx', 'A1.2/Грамматика/Future Simple.xlsx']
+    questions = {question.question_title: question for question in QuestionBankSnapshot(snapshot_path)}
+    assert [question.id for question in questions.values()] == [1, 2, 3]
+    apple = questions['Apple']
+    assert (apple.level, apple.category, apple.topic_title) == (LanguageLevel.A1_1, QuestionCategory.VOCABULARY, 'Еда')
+    assert apple.is_answer_correct(str(json.loads(apple.answer_options).index('Яблоко')))
+    assert questions['I ___ an apple'].is_answer_correct('Ate')
+    future_forms = questions['Future forms']
+    options = json.loads(future_forms.answer_options)
+    assert future_forms.is_answer_correct(','.join(sorted(str(options.index(value)) for value in ('will go', 'am going to go'))))
+
+    # Unchanged workbooks are not parsed again, and keep the ids of their questions
+    def fail_parse(*args, **kwargs):
+        raise AssertionError('Unchanged workbooks should not be parsed')
+    with monkeypatch.context() as patch:
+        patch.setattr('backend.question_bank_compiler.parse_topic_workbook', fail_parse)
+        result = compile_question_bank(root_dir, snapshot_path)
+    assert result.parsed_workbooks == []
+    assert {question.question_title: question for question in QuestionBankSnapshot(snapshot_path)} == questions
+
+    write_topic_workbook(food_path, {'Выбор одного варианта': [['Pear', 'Груша', 'Яблоко']]})
+    result = compile_question_bank(root_dir, snapshot_path)
+    assert result.parsed_workbooks == ['A1.1/Лексика/Еда.xlsx']
+    assert result.reused_workbooks == ['A1.2/Грамматика/Future Simple.xlsx']
+    assert {question.question_title: question.id for question in QuestionBankSnapshot(snapshot_path)} == {
+        'Pear': 4,
+        'Future forms': 3,
+    }
+
+    with client.application.app_context():
+        insert_snapshot_questions(QuestionBankSnapshot(snapshot_path))
+        db_session.commit()
+        assert db_session.get(Question, 4).to_json() == QuestionBankSnapshot(snapshot_path).get(4).to_json()
+
+
+def test_finished_test_archive(client: FlaskClient):
+    test_questions = make_test_questions_a1_1_one_per_group()
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+    client.post(
+        '/api/start',
+        json={
+            'email': 'test@example.com',
+            'full_name': 'Test User',
+            'start_level': 'A1_1',
+        },
+    )
+    answers = {str(question['step_number']): 'xyz' for question in client.get('/api/level-batch').json['questions']}
+    user_uuid = client.post('/api/answers', json={'answers': answers}).json['user_uuid']
+
+    with client.application.app_context():
+        finished_test = db_session.get(FinishedTest, 1)
+        assert finished_test.steps_count == len(test_questions)
+        steps = unpack_finished_test(finished_test)
+        assert steps == [
+            ArchivedStep(step.step_number, step.question_id, step.timestamp, step.answer, step.is_correct)
+            for step in db_session.query(ProgressStep).order_by(ProgressStep.step_number)
+        ]
+        summarized_stats_json = compute_summarized_stats(user_id=1).to_json()
+        detailed_stats_json = [step.to_json() for step in compute_detailed_stats(user_id=1)]
+    with query_budget(6) as counter:  # Read from the archive and the questions, without joining the progress steps
+        assert client.get(f'/api/results/{user_uuid}/summarized').json == summarized_stats_json
+    assert not any('progress_step' in statement for statement in counter.statements)
+    with query_budget(6):
+        assert client.get(f'/api/results/{user_uuid}/detailed').json == detailed_stats_json
+
+    # A test finished an hour ago, before the archive was introduced
+    hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    with client.application.app_context():
+        db_session.add(User(
+            id=2,
+            uuid='uuid-2',
+            timestamp=hour_ago,
+            email='some-email@example.com',
+            full_name='Georgiy Vasilyev',
+            start_level=LanguageLevel.A1_1,
+            choosed_dont_know_level=False,
+        ))
+        db_session.add_all([
+            ProgressStep(
+                user_id=2,
+                step_number=step_number,
+                question_id=question.id,
+                timestamp=hour_ago,
+                answer=question.correct_answer if step_number == 1 else 'xyz',
+                is_correct=step_number == 1,
+            ) for step_number, question in enumerate(make_test_questions_a1_1_one_per_group(), start=1)
+        ])
+        db_session.commit()
+        columns_before = load_answer_columns()
+
+        assert archive_finished_tests() == 1
+        assert db_session.get(User, 2).detected_level == LanguageLevel.A0
+        assert archive_finished_tests() == 0
+        summarized_stats_json = compute_summarized_stats(user_id=2).to_json()
+
+        # Only the steps folded by the analytics are deleted
+        assert compact_archived_steps() == 0
+        refresh_analytics_aggregates()
+        assert compact_archived_steps() == 2
+        assert db_session.query(ProgressStep).count() == 0
+        assert db_session.get(FinishedTest, 2).steps_compacted is True
+        columns_after = load_answer_columns()
+        assert sorted(zip(columns_after.user_ids, columns_after.question_ids, columns_after.is_correct)) == sorted(
+            zip(columns_before.user_ids, columns_before.question_ids, columns_before.is_correct)
+        )
+    assert client.get('/api/results/uuid-2/summarized').json == summarized_stats_json
+
+
+
+def test_finished_test_archive_packing(client: FlaskClient):
+    started_at = datetime.datetime(2024, 1, 1)
+    steps = [
+        ArchivedStep(1, 10, started_at, '0', True),
+        ArchivedStep(2, 11, started_at + datetime.timedelta(days=60, milliseconds=5), 'xyz', False),
+    ]
+    # Longer than the 49 days of uint32 milliseconds
+    assert unpack_finished_test(pack_finished_test(1, steps)) == steps
+
+    # Archived before the offsets were stored as int64
+    legacy_finished_test = pack_finished_test(1, steps[:1] + [steps[1]._replace(timestamp=started_at)])
+    legacy_finished_test.timestamp_offsets = bytes(8)
+    assert [step.timestamp for step in unpack_finished_test(legacy_finished_test)] == [started_at, started_at]
+
+    # A test with a gap in its steps is left unarchived
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group())
+        db_session.add(User(
+            id=1,
+            uuid='uuid-1',
+            email='some-email@example.com',
+            full_name='Georgiy Vasilyev',
+            start_level=LanguageLevel.A1_1,
+            choosed_dont_know_level=False,
+            detected_level=LanguageLevel.A0,
+        ))
+        db_session.add_all([ProgressStep(user_id=1, step_number=step_number, question_id=1) for step_number in (1, 3)])
+        db_session.commit()
+        assert archive_finished_test(1) is None
+        assert archive_finished_tests() == 0
+        assert db_session.query(FinishedTest).count() == 0
+
+def test_write_behind_answers(client: FlaskClient, tmp_path, monkeypatch):
+    test_questions = make_test_questions_a1_1_one_per_group()
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+    answer_log.configure(tmp_path)
+    try:
+        client.post(
+            '/api/start',
+            json={
+                'email': 'test@example.com',
+                'full_name': 'Test User',
+                'start_level': 'A1_1',
+            },
+        )
+        hour_ago = time.time() - 60 * 60
+        monkeypatch.setattr(answer_log_module, 'time', types.SimpleNamespace(time=lambda: hour_ago))
+        with query_budget(6) as counter:
+            assert client.post('/api/next-step', json={'answer': 'xyz'}).status_code == 200
+        monkeypatch.undo()
+        # The session row is written anyway, as the current step changes
+        assert [statement for statement in counter.statements if not statement.startswith('SELECT')] == [
+            'UPDATE sessions SET data=?, expiry=? WHERE sessions.id = ?',
+        ]
+        [segment_path] = tmp_path.glob('*.log')
+        [logged_answer] = [json.loads(line) for line in segment_path.read_text().splitlines()]
+        assert logged_answer == [1, 1, 'xyz', False, None, hour_ago]
+
+        with client.application.app_context():
+            assert db_session.get(ProgressStep, (1, 1)).answer is None
+            assert answer_log.flush() == 1
+            assert db_session.get(ProgressStep, (1, 1)).answer == 'xyz'
+            answered_at = db_session.get(ProgressStep, (1, 1)).timestamp  # Not the time of the flush
+            assert abs((answered_at - datetime.datetime.utcfromtimestamp(hour_ago)).total_seconds()) < 1
+
+            # Applying the answer again changes neither the step nor the analytics
+            db_session.add(UserAnalytics())
+            db_session.commit()
+            timestamp_before = db_session.get(ProgressStep, (1, 1)).timestamp
+            analytics_before = calculate_all_analytics()
+            assert sum(topic.questions_count for topic in analytics_before.topics_success) == 1
+            apply_answers([LoggedAnswer(1, 1, 'xyz', False), LoggedAnswer(1, 1, '0', True)])
+            db_session.expire_all()
+            assert db_session.get(ProgressStep, (1, 1)).answer == 'xyz'
+            assert db_session.get(ProgressStep, (1, 1)).timestamp == timestamp_before
+            assert calculate_all_analytics() == analytics_before
+        assert list(tmp_path.glob('*.log')) == []
+
+        # The log of a crashed worker is replayed, up to the last complete line
+        client.post('/api/next-step', json={'answer': 'xyz'})
+        (tmp_path / 'answers-crashed.log').write_text('[1, 3, "abc", false]\n[1, 4, "ab')
+        with client.application.app_context():
+            assert answer_log.replay_orphaned_segments() == 1
+            assert [step.answer for step in db_session.query(ProgressStep).order_by(ProgressStep.step_number)] == [
+                'xyz', None, 'abc', None,
+            ]
+
+        # Finishing the level applies the buffered answers before grading it
+        client.post('/api/next-step', json={'answer': 'xyz'})
+        response = client.post('/api/next-step', json={'answer': 'xyz'})
+        assert response.json['finished'] is True
+        with client.application.app_context():
+            # The replayed answer is kept, an answered step is never overwritten
+            assert [step.answer for step in db_session.query(ProgressStep).order_by(ProgressStep.step_number)] == [
+                'xyz', 'xyz', 'abc', 'xyz',
+            ]
+            assert db_session.query(User).one().detected_level == LanguageLevel.A0
+            assert answer_log.flush() == 3
+        assert list(tmp_path.glob('*.log')) == []
+    finally:
+        answer_log.configure(None)
+
+    # Without the log, the answer is committed to the step before the session is saved
+    other_client = client.application.test_client()
+    other_client.post('/api/start', json={'email': 'other@example.com', 'full_name': 'Other User', 'start_level': 'A1_1'})
+    with query_budget(7) as counter:
+        assert other_client.post('/api/next-step', json={'answer': 'xyz'}).status_code == 200
+    assert [statement.split(' SET ')[0] for statement in counter.statements if not statement.startswith('SELECT')] == [
+        'UPDATE progress_step', 'UPDATE sessions',
+    ]
+
+
+def test_retention(client: FlaskClient, monkeypatch):
+    monkeypatch.setenv('ADMIN_PASSWORD', 'admin-password')
+    monkeypatch.setattr(retention, 'CHUNK_PAUSE_SECONDS', 0)
+    test_questions = make_test_questions_a1_1_one_per_group()
+    with client.application.app_context():
+        db_session.add_all(test_questions)
+        db_session.commit()
+    client.post('/api/start', json={'email': 'old@example.com', 'full_name': 'Old User', 'start_level': 'A1_1'})
+    client.post('/api/next-step', json={'answer': 'xyz'})
+    client.post('/api/next-step', json={'answer': 'xyz'})
+    recent_client = client.application.test_client()
+    recent_client.post('/api/start', json={'email': 'new@example.com', 'full_name': 'New User', 'start_level': 'A1_1'})
+
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=400)
+    with client.application.app_context():
+        old_user = db_session.query(User).filter(User.email == 'old@example.com').one()
+        old_user.timestamp = long_ago
+        db_session.query(ProgressStep).filter(ProgressStep.user_id == old_user.id).update(
+            {ProgressStep.timestamp: long_ago},
+        )
+        db_session.add(UserAnalytics(uuid='old-opening', timestamp=long_ago))
+        db_session.add(UserAnalytics(uuid='new-opening', timestamp=datetime.datetime.utcnow()))
+        session_model = client.application.session_interface.sql_session_model
+        # The session of the recent client, which is not opened (and deleted) by the cleanup request
+        db_session.query(session_model).order_by(session_model.id.desc()).first().expiry = long_ago
+        db_session.commit()
+        analytics_before = calculate_all_analytics().to_json()
+
+    assert client.post('/api/admin/cleanup', json={'admin_password': 'wrong'}).status_code != 200
+    response = client.post('/api/admin/cleanup', json={'admin_password': 'admin-password'})
+    assert response.status_code == 200
+    assert response.json == {'abandoned_tests': 1, 'progress_steps': 4, 'page_openings': 1, 'sessions': 1}
+
+    with client.application.app_context():
+        assert [user.email for user in db_session.query(User)] == ['new@example.com']
+        assert [analytics.uuid for analytics in db_session.query(UserAnalytics)] == ['new-opening']
+        [aggregate] = db_session.query(AbandonedTestAggregate).all()
+        assert (aggregate.start_level, aggregate.answered_steps_count, aggregate.users_count) == (
+            LanguageLevel.A1_1, 2, 1,
+        )
+        # The deleted rows were folded before, so the analytics don't change
+        assert calculate_all_analytics().to_json() == analytics_before
+        # Nothing is left to delete
+        assert retention.run_retention().to_json() == {
+            'abandoned_tests': 0, 'progress_steps': 0, 'page_openings': 0, 'sessions': 0,
+        }
+
+
+def test_sharding(monkeypatch, tmp_path):
+    monkeypatch.setenv('DATABASE_SHARD_URIS', ','.join(f'sqlite:///{tmp_path / f"shard-{index}.db"}' for index in range(2)))
+    client = make_test_client()
+    app = client.application
+    with app.app_context():
+        with pytest.raises(ShardNotSelected):
+            db_session.query(User).count()
+        for _ in iter_shards():
+            db_session.add_all(make_test_questions_a1_1_one_per_group())
+            db_session.commit()
+
+    user_uuids = [f'user-{index}' for index in range(4)]
+    assert {shard_for_uuid(user_uuid, 2) for user_uuid in user_uuids} == {0, 1}
+    for user_uuid in user_uuids:
+        user_client = app.test_client()
+        with user_client.session_transaction() as session:
+            session['user_uuid'] = user_uuid
+        user_client.post(
+            '/api/start',
+            json={'email': f'{user_uuid}@example.com', 'full_name': 'Test User', 'start_level': 'A1_1'},
+        )
+        assert user_client.post('/api/next-step', json={'answer': '0'}).status_code == 200
+        assert user_client.get('/api/status').json['status'] == 'IN_PROGRESS'
+        # Routed by the uuid in the URL
+        assert client.get(f'/api/results/{user_uuid}/detailed').data == b'User is still in progress'
+
+    with app.app_context():
+        for shard_index in iter_shards():
+            users = db_session.query(User).all()
+            assert [shard_for_uuid(user.uuid, 2) for user in users] == [shard_index] * len(users)
+            assert [user.id for user in users] == list(range(1, len(users) + 1))  # Ids are unique within a shard
+            db_session.add_all([UserAnalytics(uuid=user.uuid) for user in users])
+            db_session.commit()
+        with db.engine.connect() as connection:  # Only the sessions are in the default database
+            assert connection.execute(select(func.count()).select_from(User.__table__)).scalar() == 0
+            assert connection.execute(text('SELECT COUNT(*) FROM sessions')).scalar() == len(user_uuids) + 1
+
+        analytics = calculate_all_analytics()
+        assert analytics.stages_analytics.started_the_test_percentage == 100
+        assert analytics.start_level_selection_distribution == [('A1_1', 100)]
+        assert sum(topic.questions_count for topic in analytics.topics_success) == len(user_uuids)
+
+
+@pytest.mark.skipif(SERVER_DATABASE_URI is not None, reason='Tests the embedded SQLite mode')
+def test_sqlite_mode(client: FlaskClient):
+    with client.application.app_context():
+        assert db_session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert db_session.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        assert db_session.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+
+
+def test_traffic_capture(monkeypatch, tmp_path):
+    from benchmarks.replay import AppClient, load_capture, replay, summarize
+
+    capture_path = tmp_path / 'capture.log'
+    monkeypatch.setenv('TRAFFIC_CAPTURE_PATH', str(capture_path))
+    (tmp_path / 'index.html').write_text('<!doctype html><div id="root"></div>')
+    try:
+        client = make_test_client()
+    finally:
+        monkeypatch.delenv('TRAFFIC_CAPTURE_PATH')
+    client.application.config['FRONTEND_BUILD_DIR'] = str(tmp_path)
+    with client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group() + make_test_questions_a1_2_one_per_group())
+        db_session.commit()
+    try:
+        assert client.get('/').status_code == 200
+        client.post('/api/start', json={'email': 'test@example.com', 'full_name': 'Test User', 'start_level': 'A1_1'})
+        for answer in ['0', '2', '0', 'xyz', 'xyz', 'xyz', 'awesome']:
+            response = client.post('/api/next-step', json={'answer': answer})
+        user_uuid = response.json['user_uuid']
+        assert client.get(f'/api/results/{user_uuid}/summarized').status_code == 200
+        assert client.get(f'/results/{user_uuid}').status_code == 200
+        client.post('/api/admin/validate-password', json={'password': 'wrong'})  # Not captured
+    finally:
+        traffic_capture.close()
+
+    capture = capture_path.read_text()
+    assert 'test@example.com' not in capture and 'Test User' not in capture and user_uuid not in capture
+    records = load_capture(capture_path)
+    assert [record.rule for record in records] == ['/', '/api/start'] + ['/api/next-step'] * 7 + [
+        '/api/results/<user_uuid>/summarized', '/<path:path>',
+    ]
+    assert len({record.session for record in records}) == 1 and records[0].session is not None
+    assert records[-2].view_args == {'user_uuid': records[0].session}
+    assert records[-1].view_args == {'path': f'results/{records[0].session}'}
+    assert records[1].payload == {'email': {'~len': 16}, 'full_name': {'~len': 9}, 'start_level': 'A1_1'}
+    assert [record.payload['answer'] for record in records[2:9]] == [
+        '0', '2', '0', {'~len': 3}, {'~len': 3}, {'~len': 3}, {'~len': 7},
+    ]
+
+    # Replayed against a fresh build with the same questions, the users follow the same path
+    replay_client = make_test_client()
+    replay_client.application.config['FRONTEND_BUILD_DIR'] = str(tmp_path)
+    with replay_client.application.app_context():
+        db_session.add_all(make_test_questions_a1_1_one_per_group() + make_test_questions_a1_2_one_per_group())
+        db_session.commit()
+    summary = summarize(replay(records, lambda: AppClient(replay_client.application), speed=1000))
+    assert sum(stats['count'] for stats in summary.values()) == len(records)
+    assert all(stats['errors'] == 0 and stats['status_changes'] == 0 for stats in summary.values())
+
+
+def test_micro_benchmarks(client: FlaskClient):
+    from benchmarks.micro import TOPICS_PER_LEVEL, insert_benchmark_data, make_benchmarks
+
+    with client.application.app_context():
+        insert_benchmark_data()
+        with client.application.test_request_context():
+            benchmarks = make_benchmarks()
+            assert benchmarks['process_stats/finished']() == (LanguageLevel.A1_2, None)
+            assert benchmarks['question/is_answer_correct/fill_blank']() is True
+            assert benchmarks['flow_logic/compute_summarized_stats']().total_questions == 20
+            assert len(benchmarks['batch_pool/take_batch']()) == TOPICS_PER_LEVEL
+            for function in benchmarks.values():  # Every benchmark still runs
+                function()
@@ -0,0 +1,128 @@
+"""
+Opt-in capture of the users' requests, for replaying them in benchmarks (see `benchmarks/replay.py`).
+
+With `TRAFFIC_CAPTURE_PATH` set, every request of the users is appended to that file as a JSON line, with its time,
+session, method, URL rule, view arguments, payload shape, status and duration. The workers append to the same file,
+one write per line. Nothing identifying is recorded: sessions and the uuids in the URLs (including those in the paths
+of the pages, like `/results/<uuid>`) are replaced by keyed hashes of the uuid, and only the shape of the payload is
+kept. A string is replaced by its length, unless it's a choice of options (`'0'`, `'1,3'`) or a start level, so that
+the replayed users follow the same level paths. The admin endpoints are not captured.
+When the capture is not enabled, no hooks are installed.
+"""
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from typing import Any, NamedTuple, Optional
+from flask import Flask, Response, current_app, g, request, session as flask_session
+
+
+STRING_LENGTH_KEY = '~len'  # {'~len': 12} stands for a string of 12 characters
+KEPT_STRING_FIELDS = frozenset({'start_level'})
+OPTIONS_ANSWER_PATTERN = re.compile(r'[0-9]+(,[0-9]+)*')
+SKIPPED_PATH_PREFIXES = ('/api/admin/', '/api/metrics', '/static/')
+ANONYMIZED_VIEW_ARGS = frozenset({'user_uuid'})
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}')
+ANONYMIZED_UUID_PATTERN = re.compile(r'\b[0-9a-f]{16}\b')  # Output of `anonymize`
+
+
+class CapturedRequest(NamedTuple):
+    time: float  # Seconds since the epoch, when the request started
+    session: Optional[str]  # Anonymized uuid of the user
+    method: str
+    rule: str  # e.g. '/api/results/<user_uuid>/summarized'
+    view_args: dict[str, Any]
+    payload: Any  # Shape of the JSON payload
+    status: int
+    duration_ms: float
+
+    def to_json(self) -> list[Any]:
+        return list(self)
+
+    @classmethod
+    def from_json(cls, values: list[Any]) -> 'CapturedRequest':
+        return cls(*values)
+
+
+def anonymize(user_uuid: str) -> str:
+    return hmac.new(current_app.secret_key.encode(), user_uuid.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def anonymize_view_arg(name: str, value: Any) -> Any:
+    if name in ANONYMIZED_VIEW_ARGS:
+        return anonymize(value)
+    if isinstance(value, str):
+        return UUID_PATTERN.sub(lambda match: anonymize(match.group()), value)
+    return value
+
+
+def payload_shape(value: Any, key: Optional[str] = None) -> Any:
+    if isinstance(value, dict):
+        return {item_key: payload_shape(item_value, item_key) for item_key, item_value in value.items()}
+    if isinstance(value, list):
+        return [payload_shape(item) for item in value]
+    if isinstance(value, str) and key not in KEPT_STRING_FIELDS and not OPTIONS_ANSWER_PATTERN.fullmatch(value):
+        return {STRING_LENGTH_KEY: len(value)}
+    return value
+
+
+class TrafficCapture:
+    def __init__(self) -> None:
+        self._fd: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._fd is not None
+
+    def open(self, path: Optional[str]) -> None:
+        self.close()
+        if path:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def write(self, captured_request: CapturedRequest) -> None:
+        if self._fd is None:
+            return
+        line = json.dumps(captured_request.to_json(), ensure_ascii=False, separators=(',', ':')) + '\n'
+        os.write(self._fd, line.encode())  # A single append, so that the lines of the workers don't interleave
+
+
+traffic_capture = TrafficCapture()
+
+
+def _start_capture() -> None:
+    g.capture_start_time = time.time()
+    g.capture_start_counter = time.perf_counter()
+
+
+def _capture_request(response: Response) -> Response:
+    start_time = g.pop('capture_start_time', None)
+    if start_time is None or request.url_rule is None or request.path.startswith(SKIPPED_PATH_PREFIXES):
+        return response
+    user_uuid = flask_session.get('user_uuid')  # Set by the first page load
+    view_args = {name: anonymize_view_arg(name, value) for name, value in (request.view_args or {}).items()}
+    traffic_capture.write(CapturedRequest(
+        time=round(start_time, 3),
+        session=anonymize(user_uuid) if user_uuid is not None else None,
+        method=request.method,
+        rule=request.url_rule.rule,
+        view_args=view_args,
+        payload=payload_shape(request.get_json(silent=True)),
+        status=response.status_code,
+        duration_ms=round((time.perf_counter() - g.pop('capture_start_counter')) * 1000, 2),
+    ))
+    return response
+
+
+def init_traffic_capture(app: Flask) -> None:
+    traffic_capture.open(os.environ.get('TRAFFIC_CAPTURE_PATH'))
+    if not traffic_capture.enabled:
+        return
+    app.before_request(_start_capture)
+    app.after_request(_capture_request)
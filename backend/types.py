@@ -1,5 +1,6 @@
 
 from enum import auto
+from functools import lru_cache
 import enum
 from typing import Any, NamedTuple, Optional
 
@@ -23,25 +24,61 @@ class LanguageLevel(enum.Enum):
     B2_1 = auto()
     B2_2 = auto()
 
+    # Levels are compared by their values. The comparisons are called in the hot loops (grading, export, analytics),
+    # so they check the exact class instead of `isinstance`, and return NotImplemented to get the usual TypeError.
     def __gt__(self, other: 'LanguageLevel') -> bool:
-        if not isinstance(other, LanguageLevel):
-            raise TypeError(f"'>' not supported between instances of '{type(self)}' and '{type(other)}'")
-        return self.value > other.value
-    
+        if other.__class__ is not LanguageLevel:
+            return NotImplemented
+        return self._value_ > other._value_
+
+    def __lt__(self, other: 'LanguageLevel') -> bool:
+        if other.__class__ is not LanguageLevel:
+            return NotImplemented
+        return self._value_ < other._value_
+
+    def __ge__(self, other: 'LanguageLevel') -> bool:
+        if other.__class__ is not LanguageLevel:
+            return NotImplemented
+        return self._value_ >= other._value_
+
+    def __le__(self, other: 'LanguageLevel') -> bool:
+        if other.__class__ is not LanguageLevel:
+            return NotImplemented
+        return self._value_ <= other._value_
+
     def __add__(self, other: int) -> 'LanguageLevel':
-        if not isinstance(other, int):
-            raise TypeError(f"unsupported operand type(s) for +: '{type(self)}' and '{type(other)}'")
-        return LanguageLevel(self.value + other)
+        if other.__class__ is not int:
+            return NotImplemented
+        return language_level_from_value(self._value_ + other)
 
     def __sub__(self, other: int) -> 'LanguageLevel':
-        if not isinstance(other, int):
-            raise TypeError(f"unsupported operand type(s) for -: '{type(self)}' and '{type(other)}'")
-        return LanguageLevel(self.value - other)
+        if other.__class__ is not int:
+            return NotImplemented
+        return language_level_from_value(self._value_ - other)
 
     def __str__(self) -> str:
         return self.name.replace('_', '.')
 
 
+# Levels indexed by their values (which start from 1), to avoid the enum lookup by value
+_LANGUAGE_LEVELS_BY_VALUE: tuple[Optional[LanguageLevel], ...] = (None, *LanguageLevel)
+assert all(level.value == index for index, level in enumerate(_LANGUAGE_LEVELS_BY_VALUE) if level is not None)
+
+
+def language_level_from_value(value: int) -> LanguageLevel:
+    level = _LANGUAGE_LEVELS_BY_VALUE[value] if 0 < value < len(_LANGUAGE_LEVELS_BY_VALUE) else None
+    if level is None:
+        raise ValueError(f'{value} is not a valid LanguageLevel')
+    return level
+
+
+NEXT_LANGUAGE_LEVEL: dict[LanguageLevel, LanguageLevel] = {
+    level: next_level for level, next_level in zip(LanguageLevel, list(LanguageLevel)[1:])
+}
+PREVIOUS_LANGUAGE_LEVEL: dict[LanguageLevel, LanguageLevel] = {
+    next_level: level for level, next_level in NEXT_LANGUAGE_LEVEL.items()
+}
+
 MIN_LANGUAGE_LEVEL = LanguageLevel.A1_1
 MAX_LANGUAGE_LEVEL = LanguageLevel.A2_1
 
@@ -100,6 +137,16 @@ class SummarizedStats(NamedTuple):
         }
 
 
+@lru_cache(maxsize=4096)
+def media_type_for_filepath(filepath: Optional[str]) -> str:
+    if filepath is not None:
+        if filepath.endswith('.txt'):
+            return 'text'
+        elif filepath.endswith('.mp3'):
+            return 'audio'
+    return 'none'
+
+
 class PassedStep(NamedTuple):
     question_title: str
     language_level: LanguageLevel
@@ -110,19 +157,13 @@ class PassedStep(NamedTuple):
     given_answer: str
 
     def to_json(self) -> dict[str, Any]:
-        media_type = 'none'
-        if self.filepath is not None:
-            if self.filepath.endswith('.txt'):
-                media_type = 'text'
-            elif self.filepath.endswith('.mp3'):
-                media_type = 'audio'
         return {
             'question_title': self.question_title,
             'language_level': self.language_level.value,
             'answer_type': self.answer_type.value,
             'answer_options': self.answer_options,
             'correct_answer': self.correct_answer,
-            'media_type': media_type,
+            'media_type': media_type_for_filepath(self.filepath),
             'filepath': self.filepath,
             'given_answer': self.given_answer,
         }
@@ -141,6 +182,21 @@ class StagesAnalytics(NamedTuple):
         }
 
 
+class RetentionReport(NamedTuple):
+    abandoned_tests: int
+    progress_steps: int
+    page_openings: int
+    sessions: int
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'abandoned_tests': self.abandoned_tests,
+            'progress_steps': self.progress_steps,
+            'page_openings': self.page_openings,
+            'sessions': self.sessions,
+        }
+
+
 class AllAnalytics(NamedTuple):
     stages_analytics: StagesAnalytics
     start_level_selection_distribution: list[tuple[str, int]]
@@ -152,3 +208,32 @@ class AllAnalytics(NamedTuple):
             'start_level_selection_distribution': [list(x) for x in self.start_level_selection_distribution],
             'topics_success': [single_topic_data.to_json() for single_topic_data in self.topics_success],
         }
+
+
+class QuestionItemStats(NamedTuple):
+    question_id: int
+    level: LanguageLevel
+    category: QuestionCategory
+    topic_title: str
+    answer_type: AnswerType
+    answers_count: int
+    difficulty: Optional[float]  # Share of correct answers
+    discrimination: Optional[float]  # Point-biserial correlation with the rest of the user's answers
+    option_choice_rates: Optional[list[float]]  # Share of answers choosing each option, for the select questions
+    mean_answer_seconds: Optional[float]
+    median_answer_seconds: Optional[float]
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'question_id': self.question_id,
+            'level': self.level.value,
+            'category': self.category.value,
+            'topic_title': self.topic_title,
+            'answer_type': self.answer_type.value,
+            'answers_count': self.answers_count,
+            'difficulty': self.difficulty,
+            'discrimination': self.discrimination,
+            'option_choice_rates': self.option_choice_rates,
+            'mean_answer_seconds': self.mean_answer_seconds,
+            'median_answer_seconds': self.median_answer_seconds,
+        }
@@ -0,0 +1,120 @@
+"""
+Request validation compiled from marshmallow schemas.
+
+`compile_schema` turns a schema of simple fields into a function, that checks the usual valid payloads with a few
+type checks. Anything else (missing or unknown fields, wrong types, values that need a conversion) goes to the
+schema's own `load`, so the results and the error messages are exactly the ones of marshmallow.
+"""
+from typing import Any, Callable, Optional
+from marshmallow import Schema, fields
+
+
+FieldValidator = Callable[[Any], Any]
+_INVALID = object()  # Returned by the field validators when the value should be checked by marshmallow
+
+
+def _compile_string_field(field: fields.String) -> FieldValidator:
+    def validate(value: Any) -> Any:
+        return value if value.__class__ is str else _INVALID
+    return validate
+
+
+def _compile_integer_field(field: fields.Integer) -> FieldValidator:
+    def validate(value: Any) -> Any:
+        return value if value.__class__ is int else _INVALID  # bool is not int here, marshmallow rejects it
+    return validate
+
+
+def _compile_enum_field(field: fields.Enum) -> Optional[FieldValidator]:
+    if field.by_value:
+        return None
+    members = field.enum.__members__
+
+    def validate(value: Any) -> Any:
+        if value.__class__ is not str:
+            return _INVALID
+        return members.get(value, _INVALID)
+    return validate
+
+
+def _validate_integer_key(value: str) -> Any:
+    # Only the canonical representation, `int()` would also accept e.g. ' 3' or '٣', which marshmallow handles
+    if value.isascii() and value.isdigit() and (value == '0' or value[0] != '0'):
+        return int(value)
+    return _INVALID
+
+
+def _compile_dict_field(field: fields.Dict) -> Optional[FieldValidator]:
+    key_field, value_field = field.key_field, field.value_field
+    if key_field is None or value_field is None:
+        return None
+    if key_field.__class__ is fields.Integer:
+        validate_key: FieldValidator = _validate_integer_key
+    elif key_field.__class__ is fields.String:
+        validate_key = _compile_string_field(key_field)
+    else:
+        return None
+    validate_value = _compile_field(value_field)
+    if validate_value is None:
+        return None
+
+    def validate(value: Any) -> Any:
+        if value.__class__ is not dict:
+            return _INVALID
+        result = {}
+        for item_key, item_value in value.items():
+            key = validate_key(item_key)
+            item = validate_value(item_value)
+            if key is _INVALID or item is _INVALID:
+                return _INVALID
+            result[key] = item
+        return result
+    return validate
+
+
+_FIELD_COMPILERS: dict[type, Callable[[Any], Optional[FieldValidator]]] = {
+    fields.String: _compile_string_field,
+    fields.Integer: _compile_integer_field,
+    fields.Enum: _compile_enum_field,
+    fields.Dict: _compile_dict_field,
+}
+
+
+def _compile_field(field: fields.Field) -> Optional[FieldValidator]:
+    """Returns None for the fields that can't be compiled, e.g. with custom validators or options."""
+    compile_field = _FIELD_COMPILERS.get(field.__class__)
+    if compile_field is None or field.validators or field.allow_none or field.data_key is not None:
+        return None
+    if isinstance(field, fields.Integer) and field.strict:
+        return None
+    return compile_field(field)
+
+
+def compile_schema(schema_class: type[Schema]) -> Callable[[Any], dict[str, Any]]:
+    """
+    Returns a function with the same behavior as `schema_class().load`.
+
+    Raises `marshmallow.ValidationError` with the same messages as the schema.
+    """
+    schema = schema_class()
+    compiled_fields = {name: _compile_field(field) for name, field in schema.load_fields.items()}
+    if any(validator is None for validator in compiled_fields.values()) or any(schema._hooks.values()):
+        return schema.load
+    required_fields = frozenset(name for name, field in schema.load_fields.items() if field.required)
+    field_validators = tuple(compiled_fields.items())
+
+    def load(data: Any) -> dict[str, Any]:
+        if data.__class__ is not dict or not required_fields.issubset(data):
+            return schema.load(data)
+        result = {}
+        for name, validate in field_validators:
+            if name not in data:
+                continue
+            value = validate(data[name])
+            if value is _INVALID:
+                return schema.load(data)
+            result[name] = value
+        if len(result) != len(data):  # Unknown fields
+            return schema.load(data)
+        return result
+    return load
@@ -0,0 +1,112 @@
+"""
+Compares the encoding time of typical API payloads with Flask's default JSON provider and `FastJSONProvider`.
+
+Run from the repository root: `python -m benchmarks.json_provider`.
+"""
+import json
+import timeit
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from backend.json_provider import FastJSONProvider, JSONFragment, orjson
+from backend.serialization import encode_batch_question
+from backend.types import (
+    AllAnalytics,
+    AnswerType,
+    LanguageLevel,
+    PassedStep,
+    QuestionCategory,
+    QuestionItemStats,
+    StagesAnalytics,
+    TopicSuccessData,
+)
+
+
+def make_question_json(index: int) -> dict:
+    return {
+        'question_title': f'Kies het juiste woord ({index}): ik ... naar school',
+        'answer_type': AnswerType.SELECT_ONE.value,
+        'answer_options': json.dumps(['ga', 'gaat', 'gaan', 'gegaan']),
+        'filepath': None,
+        'media_type': 'none',
+    }
+
+
+def make_payloads() -> dict[str, tuple[object, object]]:
+    """Endpoint -> (payload as built for the default provider, payload as built for `FastJSONProvider`)."""
+    question = make_question_json(0)
+    batch_rows = [
+        (step_number, f'Kies het juiste woord ({step_number}): ik ... naar school', QuestionCategory.GRAMMAR,
+         AnswerType.SELECT_ONE, json.dumps(['ga', 'gaat', 'gaan', 'gegaan']), None)
+        for step_number in range(1, 21)
+    ]
+    level_batch_default = {
+        'questions': [{'step_number': row[0], **make_question_json(row[0])} for row in batch_rows],
+        'next_level_step_number': 20,
+    }
+    level_batch_fast = {
+        'questions': [JSONFragment(encode_batch_question(*row)) for row in batch_rows],
+        'next_level_step_number': 20,
+    }
+    passed_steps = [
+        PassedStep(
+            question_title=f'Vraag {index}',
+            language_level=LanguageLevel.A2_1,
+            answer_type=AnswerType.SELECT_MULTIPLE,
+            answer_options=json.dumps(['een', 'twee', 'drie']),
+            filepath='audiofile-1.mp3' if index % 5 == 0 else None,
+            correct_answer='0,2',
+            given_answer='0',
+        ) for index in range(60)
+    ]
+    analytics = AllAnalytics(
+        stages_analytics=StagesAnalytics(100, 60, 40),
+        start_level_selection_distribution=[(level.name, 10) for level in LanguageLevel],
+        topics_success=[
+            TopicSuccessData(QuestionCategory.VOCABULARY, f'Onderwerp {index}', 1000, 700) for index in range(200)
+        ],
+    )
+    item_stats = [
+        QuestionItemStats(
+            index, LanguageLevel.B1_1, QuestionCategory.READING, 'Tekst', AnswerType.SELECT_ONE, 120,
+            0.61, 0.35, [0.61, 0.2, 0.19], 14.2, 12.5,
+        ) for index in range(500)
+    ]
+    return {
+        'status': ({'status': 'IN_PROGRESS', 'question': question},) * 2,
+        'level-batch': (level_batch_default, level_batch_fast),
+        'results/detailed': ([step.to_json() for step in passed_steps],) * 2,
+        'admin/analytics': (analytics.to_json(),) * 2,
+        'admin/item-analytics': ([item.to_json() for item in item_stats],) * 2,
+    }
+
+
+def main() -> None:
+    app = Flask(__name__)
+    providers = {
+        'flask default': DefaultJSONProvider(app),
+        'fast (stdlib)': FastJSONProvider(app, use_orjson=False),
+    }
+    if orjson is not None:
+        providers['fast (orjson)'] = FastJSONProvider(app, use_orjson=True)
+    else:
+        print('orjson is not installed, only the stdlib fallback is measured')
+
+    print(f'{"endpoint":<22}' + ''.join(f'{name:>16}' for name in providers) + f'{"speedup":>10}')
+    with app.app_context():
+        for endpoint, (default_payload, fast_payload) in make_payloads().items():
+            timings = []
+            for name, provider in providers.items():
+                payload = default_payload if name == 'flask default' else fast_payload
+                expected = json.loads(providers['flask default'].dumps(default_payload))
+                assert json.loads(provider.dumps(payload)) == expected
+                number, total_time = timeit.Timer(lambda: provider.dumps(payload)).autorange()
+                timings.append(total_time / number * 1e6)
+            print(
+                f'{endpoint:<22}' + ''.join(f'{timing:>14.1f}us' for timing in timings)
+                + f'{timings[0] / timings[-1]:>9.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
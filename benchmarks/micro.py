@@ -0,0 +1,248 @@
+"""
+Micro-benchmarks of the functions run on every request or exported row, and of the queries of `backend/flow_logic.py`
+and `backend/batch_pool.py` on an in-memory SQLite database, compared with the baselines in
+`benchmarks/micro_baselines.json`.
+
+    python -m benchmarks.micro                   # Fails if a benchmark is slower than its baseline
+    python -m benchmarks.micro --save-baseline   # Saves the timings as the new baselines
+    python -m benchmarks.micro -k stats          # Only the benchmarks with "stats" in their names
+
+Every benchmark is timed in several rounds after a warm-up round, with the garbage collector disabled, and the
+fastest round is kept, since the noise only ever makes a round slower. The timings are divided by the timing of a
+fixed pure-Python calibration loop, measured in between the rounds, so that the baselines stay comparable when the
+machine is a bit busier or faster.
+Still, the baselines should be saved on the kind of machine that runs the comparison. A benchmark more than
+`--threshold` slower than its baseline is timed again, and is a regression if it stays that slow.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable
+
+from backend.types import AnswerType, LanguageLevel, PassedLevelStats, PassedStep, QuestionCategory
+
+
+BASELINES_PATH = Path(__file__).with_name('micro_baselines.json')
+ROUNDS = 5
+ATTEMPTS = 3
+ROUND_SECONDS = 0.1
+DEFAULT_THRESHOLD = 0.25
+
+TOPICS_PER_LEVEL = 10
+QUESTIONS_PER_TOPIC = 5
+FINISHED_USERS_COUNT = 100
+
+
+def calibration_loop() -> int:
+    total = 0
+    for index in range(1000):
+        total += index * index % 7
+    return total
+
+
+def _make_round(function: Callable[[], object]) -> Callable[[], float]:
+    """Returns a function timing a round of about `ROUND_SECONDS`, in nanoseconds per call."""
+    timer = timeit.Timer(function)
+    number, total_time = timer.autorange()  # Also the warm-up round
+    number = max(int(number * ROUND_SECONDS / max(total_time, 1e-9)), 1)
+    return lambda: timer.timeit(number) / number * 1e9
+
+
+def time_function(function: Callable[[], object]) -> tuple[float, float]:
+    """
+    Returns the fastest time of a call in nanoseconds, and the fastest time of `calibration_loop` measured in between
+    the rounds, so that both are measured in the same state of the machine.
+    """
+    timings, calibrations = [], []
+    function_round, calibration_round = _make_round(function), _make_round(calibration_loop)
+    for _ in range(ROUNDS):
+        calibrations.append(calibration_round())
+        timings.append(function_round())
+    calibrations.append(calibration_round())
+    return min(timings), min(calibrations)
+
+
+def make_question(level: LanguageLevel, topic_index: int, question_index: int, answer_type: AnswerType):
+    from backend.models import Question
+
+    return Question(
+        level=level,
+        category=QuestionCategory.GRAMMAR,
+        topic_title=f'Topic {topic_index}',
+        question_title=f'Kies het juiste woord ({question_index}): ik ... naar school',
+        filepath=None,
+        answer_type=answer_type,
+        answer_options=json.dumps(['ga', 'gaat', 'gaan', 'gegaan']),
+        correct_answer='0' if answer_type == AnswerType.SELECT_ONE else json.dumps(['ga', 'gaat']),
+    )
+
+
+def insert_benchmark_data() -> None:
+    """A question bank of two levels, and users who finished the test. Must be called within an app context."""
+    from backend.models import ProgressStep, User, db_session
+
+    levels = (LanguageLevel.A1_1, LanguageLevel.A1_2)
+    questions = [
+        make_question(level, topic_index, question_index, AnswerType.SELECT_ONE)
+        for level in levels
+        for topic_index in range(TOPICS_PER_LEVEL)
+        for question_index in range(QUESTIONS_PER_TOPIC)
+    ]
+    db_session.add_all(questions)
+    db_session.flush()
+    for user_id in range(1, FINISHED_USERS_COUNT + 1):
+        db_session.add(User(
+            id=user_id,
+            uuid=f'user-{user_id}',
+            email=f'user-{user_id}@example.com',
+            full_name='Benchmark User',
+            start_level=levels[0],
+            choosed_dont_know_level=False,
+            detected_level=levels[1],
+        ))
+        for step_number, question in enumerate(questions[::QUESTIONS_PER_TOPIC], start=1):
+            db_session.add(ProgressStep(
+                user_id=user_id,
+                step_number=step_number,
+                question_id=question.id,
+                answer='0' if step_number % 4 else '1',
+                is_correct=step_number % 4 != 0,
+            ))
+    db_session.commit()
+
+
+def make_benchmarks() -> dict[str, Callable[[], object]]:
+    """
+    The benchmarks by name. The query benchmarks need `insert_benchmark_data` to have been run, and must be called
+    within a request context.
+    """
+    from backend.batch_pool import BatchPool
+    from backend.flow_logic import (
+        add_level_batch,
+        compute_detailed_stats,
+        compute_summarized_stats,
+        get_passed_levels_stats,
+        get_passed_levels_stats_for_users,
+        process_stats,
+    )
+    from backend.models import db_session
+
+    select_question = make_question(LanguageLevel.A1_1, 0, 0, AnswerType.SELECT_ONE)
+    fill_blank_question = make_question(LanguageLevel.A1_1, 0, 0, AnswerType.FILL_THE_BLANK)
+    passed_step = PassedStep(
+        question_title='Kies het juiste woord: ik ... naar school',
+        language_level=LanguageLevel.A1_1,
+        answer_type=AnswerType.SELECT_ONE,
+        answer_options=json.dumps(['ga', 'gaat', 'gaan', 'gegaan']),
+        filepath='listening/a1_1/1.mp3',
+        correct_answer='0',
+        given_answer='2',
+    )
+    passed_then_failed_stats = [
+        PassedLevelStats(LanguageLevel.A1_1, 90),
+        PassedLevelStats(LanguageLevel.A1_2, 80),
+        PassedLevelStats(LanguageLevel.A2_1, 20),
+    ]
+    passed_stats = [PassedLevelStats(LanguageLevel.A1_1, 90)]
+    user_ids = list(range(1, FINISHED_USERS_COUNT + 1))
+    # Without a background thread, a batch is sampled when it's taken, as with the default `BATCH_POOL_DEPTH=0`
+    on_demand_pool = BatchPool(depth=0)
+    level_batch = on_demand_pool.take_batch(LanguageLevel.A1_1)
+    next_user_ids = iter(range(FINISHED_USERS_COUNT + 1, sys.maxsize))
+
+    def add_batch() -> None:
+        add_level_batch(level_batch, user_id=next(next_user_ids), current_step_number=0)
+
+    def run_query(query: Callable[[], object]) -> Callable[[], object]:
+        def run() -> object:
+            result = query()
+            db_session.expunge_all()  # So that the identity map does not grow between the calls
+            return result
+        return run
+
+    return {
+        'language_level/compare': lambda: LanguageLevel.A1_1 < LanguageLevel.B1_2,
+        'language_level/add': lambda: LanguageLevel.A1_1 + 1,
+        'language_level/str': lambda: str(LanguageLevel.A2_1),
+        'process_stats/finished': lambda: process_stats(passed_then_failed_stats),
+        'process_stats/next_level': lambda: process_stats(passed_stats),
+        'question/is_answer_correct/select_one': lambda: select_question.is_answer_correct('0'),
+        'question/is_answer_correct/fill_blank': lambda: fill_blank_question.is_answer_correct('Gaat'),
+        'question/to_json': select_question.to_json,
+        'passed_step/to_json': passed_step.to_json,
+        'batch_pool/take_batch': run_query(lambda: on_demand_pool.take_batch(LanguageLevel.A1_1)),
+        'flow_logic/get_passed_levels_stats': run_query(lambda: get_passed_levels_stats(1)),
+        'flow_logic/get_passed_levels_stats_for_users': run_query(lambda: get_passed_levels_stats_for_users(user_ids)),
+        'flow_logic/compute_summarized_stats': run_query(lambda: compute_summarized_stats(1)),
+        'flow_logic/compute_detailed_stats': run_query(lambda: compute_detailed_stats(1)),
+        'flow_logic/add_level_batch': run_query(add_batch),
+    }
+
+
+def run_benchmarks(name_filter: str, baselines: dict[str, float], threshold: float) -> dict[str, tuple[float, float]]:
+    """Returns the timings and calibrations (in nanoseconds) on a fresh in-memory database."""
+    os.environ['DATABASE_URI'] = 'sqlite://'
+    os.environ['DATABASE_SHARD_URIS'] = ''
+    from backend import create_basic_app
+    from backend.models import db
+
+    app = create_basic_app()
+    app.secret_key = 'benchmark'  # For the session of the request context
+    results: dict[str, tuple[float, float]] = {}
+    with app.app_context():
+        db.create_all()
+        insert_benchmark_data()
+        with app.test_request_context():
+            for name, function in make_benchmarks().items():
+                if name_filter not in name:
+                    continue
+                # A regression is timed again, and only reported if the next attempts confirm it
+                for _ in range(ATTEMPTS):
+                    timing, calibration = time_function(function)
+                    if name not in results or timing / calibration < results[name][0] / results[name][1]:
+                        results[name] = (timing, calibration)
+                    best_timing, best_calibration = results[name]
+                    if name not in baselines or best_timing / best_calibration <= baselines[name] * (1 + threshold):
+                        break
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-k', dest='name_filter', default='', help='only the benchmarks with this in their names')
+    parser.add_argument('--save-baseline', action='store_true', help='save the timings as the new baselines')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='0.25 fails at 25%% slower')
+    args = parser.parse_args()
+
+    baselines = json.loads(BASELINES_PATH.read_text()) if BASELINES_PATH.exists() else {}
+    results = run_benchmarks(args.name_filter, {} if args.save_baseline else baselines, args.threshold)
+    # Relative to the calibration loop, as compared with the baselines
+    relative_timings = {name: timing / calibration for name, (timing, calibration) in results.items()}
+    if args.save_baseline:
+        # Merged, so that saving with `-k` keeps the other baselines
+        baselines = dict(sorted({**baselines, **relative_timings}.items()))
+        baselines = {name: float(f'{timing:.4g}') for name, timing in baselines.items()}
+        BASELINES_PATH.write_text(json.dumps(baselines, indent=2) + '\n')
+
+    regressions = []
+    print(f'{"benchmark":<48}{"time":>12}{"baseline":>12}{"change":>9}')
+    for name, (timing, calibration) in results.items():
+        if name not in baselines:
+            print(f'{name:<48}{timing:>10.0f}ns{"-":>12}')
+            continue
+        change = relative_timings[name] / baselines[name] - 1
+        flag = ''
+        if change > args.threshold:
+            regressions.append(name)
+            flag = ' !'
+        # The baseline in the current state of the machine
+        print(f'{name:<48}{timing:>10.0f}ns{baselines[name] * calibration:>10.0f}ns{change:>+9.0%}{flag}')
+    if regressions:
+        print(f'{len(regressions)} regressions above {args.threshold:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
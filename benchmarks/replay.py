@@ -0,0 +1,263 @@
+"""
+Replays the captured traffic (see `backend/traffic_capture.py`) against a build, and compares the runs of two builds.
+
+    python -m benchmarks.replay run capture.log --sqlite-snapshot snapshot.db --speed 4 --output new.json
+    python -m benchmarks.replay run capture.log --base-url http://127.0.0.1:5000 --output new.json
+    python -m benchmarks.replay compare base.json new.json
+
+Every captured session is replayed in order by its own client with its own cookies, keeping the pauses between its
+requests (divided by `--speed`), so that the pace, abandonment and level paths of the real users are kept. Without
+`--base-url`, the build of the current checkout is run in-process on a copy of `--sqlite-snapshot` (or on the
+`DATABASE_URI` database), so every run starts from the same data. To compare two builds, run the same capture in a
+checkout of each one (e.g. with `git worktree`) and compare the two outputs. A build served with `--base-url` should
+be started on a freshly restored snapshot.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional, Protocol
+
+from backend.traffic_capture import ANONYMIZED_UUID_PATTERN, STRING_LENGTH_KEY, CapturedRequest
+
+
+RULE_ARGUMENT_PATTERN = re.compile(r'<(?:[^:<>]+:)?([^<>]+)>')
+REGRESSION_THRESHOLD = 0.1  # Latency changes above 10% are flagged
+
+
+class Client(Protocol):
+    def request(self, method: str, path: str, payload: Any) -> tuple[int, Any]:
+        """Returns the status and the JSON body (None if the body is not JSON)."""
+
+
+class HttpClient:
+    def __init__(self, base_url: str):
+        import requests  # Only needed for replaying over the network
+
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method: str, path: str, payload: Any) -> tuple[int, Any]:
+        response = self.session.request(method, self.base_url + path, json=payload)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+class AppClient:
+    """Sends the requests to an app in the same process, without the network."""
+
+    def __init__(self, app: Any):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, payload: Any) -> tuple[int, Any]:
+        response = self.client.open(path, method=method, json=payload)
+        return response.status_code, response.get_json(silent=True)
+
+
+class ReplayedRequest(NamedTuple):
+    endpoint: str  # Method and URL rule
+    status: int  # 0 if the request failed without a response
+    captured_status: int
+    latency_ms: float
+
+
+def load_capture(path: Path) -> list[CapturedRequest]:
+    with open(path, encoding='utf-8') as file:
+        records = [CapturedRequest.from_json(json.loads(line)) for line in file if line.endswith('\n')]
+    return sorted(records, key=lambda record: record.time)
+
+
+def make_payload(shape: Any) -> Any:
+    if isinstance(shape, dict):
+        if set(shape) == {STRING_LENGTH_KEY}:
+            return 'x' * shape[STRING_LENGTH_KEY]
+        return {key: make_payload(value) for key, value in shape.items()}
+    if isinstance(shape, list):
+        return [make_payload(item) for item in shape]
+    return shape
+
+
+def make_path(record: CapturedRequest, uuids: dict[str, str]) -> str:
+    def replace(match: re.Match) -> str:
+        value = str(record.view_args.get(match.group(1), ''))
+        if match.group(1) == 'user_uuid':
+            return uuids.get(value, value)
+        # The uuids in the paths of the pages
+        return ANONYMIZED_UUID_PATTERN.sub(lambda uuid_match: uuids.get(uuid_match.group(), uuid_match.group()), value)
+    return RULE_ARGUMENT_PATTERN.sub(replace, record.rule)
+
+
+def group_sessions(records: list[CapturedRequest]) -> list[list[CapturedRequest]]:
+    """Requests of every session, in order. Requests without a session are sessions of their own."""
+    sessions: dict[str, list[CapturedRequest]] = {}
+    groups = []
+    for record in records:
+        if record.session is None:
+            groups.append([record])
+        elif record.session in sessions:
+            sessions[record.session].append(record)
+        else:
+            groups.append(sessions.setdefault(record.session, [record]))
+    return groups
+
+
+def replay(
+    records: list[CapturedRequest],
+    make_client: Callable[[], Client],
+    speed: float = 1.0,
+    concurrency: int = 64,
+) -> list[ReplayedRequest]:
+    if not records:
+        return []
+    results: list[ReplayedRequest] = []
+    results_lock = threading.Lock()
+    uuids: dict[str, str] = {}  # Anonymized uuid -> uuid of the replayed user, learned from the responses
+    capture_start = records[0].time
+    replay_start = time.monotonic()
+
+    def replay_session(session_records: list[CapturedRequest]) -> None:
+        client = make_client()
+        for record in session_records:
+            delay = replay_start + (record.time - capture_start) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            start_time = time.perf_counter()
+            try:
+                status, body = client.request(record.method, make_path(record, uuids), make_payload(record.payload))
+            except Exception:
+                status, body = 0, None
+            latency_ms = (time.perf_counter() - start_time) * 1000
+            if record.session is not None and isinstance(body, dict) and 'user_uuid' in body:
+                uuids[record.session] = body['user_uuid']
+            with results_lock:
+                results.append(ReplayedRequest(
+                    endpoint=f'{record.method} {record.rule}',
+                    status=status,
+                    captured_status=record.status,
+                    latency_ms=latency_ms,
+                ))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(replay_session, session) for session in group_sessions(records)]:
+            future.result()
+    return results
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def summarize(results: list[ReplayedRequest]) -> dict[str, dict[str, Any]]:
+    """Latency percentiles (ms), errors and status codes per endpoint."""
+    endpoint_results: dict[str, list[ReplayedRequest]] = {}
+    for result in results:
+        endpoint_results.setdefault(result.endpoint, []).append(result)
+    summary = {}
+    for endpoint, endpoint_requests in sorted(endpoint_results.items()):
+        latencies = sorted(result.latency_ms for result in endpoint_requests)
+        statuses: dict[str, int] = {}
+        for result in endpoint_requests:
+            statuses[str(result.status)] = statuses.get(str(result.status), 0) + 1
+        summary[endpoint] = {
+            'count': len(endpoint_requests),
+            'errors': sum(result.status == 0 or result.status >= 500 for result in endpoint_requests),
+            'status_changes': sum(result.status != result.captured_status for result in endpoint_requests),
+            'p50': round(_percentile(latencies, 0.5), 3),
+            'p90': round(_percentile(latencies, 0.9), 3),
+            'p99': round(_percentile(latencies, 0.99), 3),
+            'statuses': statuses,
+        }
+    return summary
+
+
+def _format_change(base: float, new: float) -> str:
+    change = (new - base) / base if base else 0.0
+    flag = ' !' if change > REGRESSION_THRESHOLD else ''
+    return f'{base:.1f} -> {new:.1f} ({change:+.0%}){flag}'
+
+
+def compare(base: dict[str, dict[str, Any]], new: dict[str, dict[str, Any]]) -> list[str]:
+    """Lines of the comparison table of two summaries. Latency regressions are flagged with '!'."""
+    lines = [f'{"endpoint":<45}{"count":>7}  {"p50 ms":<24}{"p99 ms":<24}errors']
+    for endpoint in sorted(set(base) | set(new)):
+        if endpoint not in base or endpoint not in new:
+            lines.append(f'{endpoint:<45}only in {"base" if endpoint in base else "new"}')
+            continue
+        base_stats, new_stats = base[endpoint], new[endpoint]
+        errors = f'{base_stats["errors"]} -> {new_stats["errors"]}'
+        if new_stats['errors'] > base_stats['errors']:
+            errors += ' !'
+        lines.append(
+            f'{endpoint:<45}{new_stats["count"]:>7}  {_format_change(base_stats["p50"], new_stats["p50"]):<24}'
+            f'{_format_change(base_stats["p99"], new_stats["p99"]):<24}{errors}'
+        )
+    return lines
+
+
+def _make_app_client_factory(sqlite_snapshot: Optional[Path]) -> Callable[[], Client]:
+    os.environ.pop('TRAFFIC_CAPTURE_PATH', None)  # Not capturing the replay
+    if sqlite_snapshot is not None:
+        database_path = Path(tempfile.mkdtemp()) / sqlite_snapshot.name
+        shutil.copyfile(sqlite_snapshot, database_path)
+        os.environ['DATABASE_URI'] = f'sqlite:///{database_path}'
+    from backend import create_app
+
+    app = create_app()
+    return lambda: AppClient(app)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='replay a capture and summarize the latencies and errors')
+    run_parser.add_argument('capture', type=Path)
+    run_parser.add_argument('--base-url', help='replay against a running build instead of the current checkout')
+    run_parser.add_argument('--sqlite-snapshot', type=Path, help='run the current checkout on a copy of this DB')
+    run_parser.add_argument('--speed', type=float, default=1.0, help='N times faster than captured')
+    run_parser.add_argument('--concurrency', type=int, default=64, help='sessions replayed at the same time')
+    run_parser.add_argument('--output', type=Path, help='save the summary, for comparing it later')
+    compare_parser = commands.add_parser('compare', help='compare the summaries of two runs')
+    compare_parser.add_argument('base', type=Path)
+    compare_parser.add_argument('new', type=Path)
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        base, new = (json.loads(path.read_text())['endpoints'] for path in (args.base, args.new))
+        print('\n'.join(compare(base, new)))
+        return
+
+    records = load_capture(args.capture)
+    if args.base_url is not None:
+        def make_client() -> Client:
+            return HttpClient(args.base_url)
+    else:
+        make_client = _make_app_client_factory(args.sqlite_snapshot)
+    start_time = time.perf_counter()
+    results = replay(records, make_client, speed=args.speed, concurrency=args.concurrency)
+    summary = {
+        'speed': args.speed,
+        'duration_seconds': round(time.perf_counter() - start_time, 3),
+        'endpoints': summarize(results),
+    }
+    print(f'Replayed {len(results)} requests of {len(group_sessions(records))} sessions '
+          f'in {summary["duration_seconds"]} s')
+    for endpoint, stats in summary['endpoints'].items():
+        print(f'{endpoint:<45}{stats["count"]:>7}  p50 {stats["p50"]:.1f} ms  p99 {stats["p99"]:.1f} ms  '
+              f'errors {stats["errors"]}  status changes {stats["status_changes"]}')
+    if args.output is not None:
+        args.output.write_text(json.dumps(summary, indent=2))
+    if any(stats['errors'] for stats in summary['endpoints'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Deletes the data that is past its retention: abandoned tests, old page openings and expired sessions (see
+`backend/retention.py`). With `--every-hours N`, keeps running and cleans up every N hours, e.g. as a separate
+process next to the web workers. Safe to run several times.
+"""
+import sys
+import time
+
+from backend import create_app
+from backend.retention import run_retention
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    every_hours = float(args[args.index('--every-hours') + 1]) if '--every-hours' in args else None
+    app = create_app()
+    while True:
+        with app.app_context():
+            report = run_retention()
+        print(
+            f'Deleted {report.abandoned_tests} abandoned tests ({report.progress_steps} progress steps), '
+            f'{report.page_openings} page openings and {report.sessions} expired sessions'
+        )
+        if every_hours is None:
+            break
+        time.sleep(every_hours * 3600)
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
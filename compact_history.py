@@ -0,0 +1,29 @@
+"""
+Packs the progress steps of the finished tests into the compact `finished_test` rows (see `backend/archive.py`).
+
+Archives the tests finished before the archive was introduced. With `--delete-steps`, also deletes the progress
+steps of the archived tests that the analytics have already folded (the analytics are refreshed first). Safe to run
+several times. Goes through every shard.
+"""
+import sys
+
+from backend import create_app
+from backend.archive import archive_finished_tests, compact_archived_steps
+from backend.admin import refresh_analytics_aggregates
+from backend.sharding import iter_shards
+
+
+def main() -> None:
+    delete_steps = '--delete-steps' in sys.argv[1:]
+    app = create_app()
+    with app.app_context():
+        for shard_index in iter_shards():
+            print(f'Shard {shard_index}: archived {archive_finished_tests()} finished tests')
+            if delete_steps:
+                refresh_analytics_aggregates()
+                print(f'Shard {shard_index}: deleted the progress steps of {compact_archived_steps()} archived tests')
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
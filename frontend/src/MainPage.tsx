@@ -1,41 +1,95 @@
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import { useNavigate } from "react-router-dom";
 import QuestionComponent from "./QuestionComponent";
 import { Backdrop, Box, CircularProgress } from "@mui/material";
 import StartPage from "./StartPage";
-import { LanguageLevel, QuestionProps } from "./types";
-import { apiFetchStatus, apiNextStep, apiStartTheTest } from "./api";
+import { LanguageLevel, LevelBatch, PostAnswerResponse, QuestionProps } from "./types";
+import { apiFetchLevelBatch, apiFetchStatus, apiNextStep, apiStartTheTest, apiSubmitAnswers } from "./api";
+
+interface LoadedLevelBatch {
+  batch: LevelBatch;
+  index: number;  // Of the question on the screen
+  answers: Record<number, string>;  // Step number -> answer, sent together once the level is answered
+  answerSeconds: Record<number, number>;  // Step number -> seconds spent on the question
+}
 
 export default function MainPage() {
   const navigate = useNavigate();
   const [currentQuestion, setCurrentQuestion] = useState<QuestionProps | null>(null);
   const [isLoading, setIsLoading] = useState<boolean>(true);
+  // The remaining questions of the level are answered without waiting for the server
+  const levelBatch = useRef<LoadedLevelBatch | null>(null);
+  const levelBatchRequest = useRef<number>(0);  // Only the batch of the latest request is used
+  const levelBatchAvailable = useRef<boolean>(true);  // Not for the adaptive test
+  const questionShownAt = useRef<number>(Date.now());
   useEffect(() => {
     console.log('REQUEST')
     apiFetchStatus(nextStepCallback).then((data) => {
       if (data.status == 'FINISHED') navigate('/results/' + data.userUUID, { replace: true });
-      else if (data.status == 'IN_PROGRESS') setCurrentQuestion(data.question)
+      else if (data.status == 'IN_PROGRESS') showQuestion(data.question!!)
       else if (data.status == 'NOT_STARTED') setCurrentQuestion(null)
       setIsLoading(false);
     })
   }, []);
 
+  const loadLevelBatch = () => {
+    levelBatch.current = null;
+    const request = ++levelBatchRequest.current;
+    if (!levelBatchAvailable.current) return;
+    apiFetchLevelBatch(nextStepCallback).then((batch) => {
+      if (batch === null) levelBatchAvailable.current = false;
+      else if (request === levelBatchRequest.current) levelBatch.current = { batch: batch, index: 0, answers: {}, answerSeconds: {} };
+    })
+  }
+
+  const showQuestion = (question: QuestionProps) => {
+    setCurrentQuestion(question)
+    questionShownAt.current = Date.now();
+    loadLevelBatch();
+  }
+
+  const showResponse = (data: PostAnswerResponse) => {
+    if (data.finished) navigate('/results/' + data.userUUID, { replace: true });
+    else showQuestion(data.question!!)
+    setIsLoading(false);
+  }
+
   const nextStepCallback = (answer: string) => {
+    const loaded = levelBatch.current;
+    if (loaded !== null) {
+      const stepNumber = loaded.batch.questions[loaded.index].stepNumber;
+      loaded.answers[stepNumber] = answer;
+      loaded.answerSeconds[stepNumber] = (Date.now() - questionShownAt.current) / 1000;
+      loaded.index += 1;
+      if (loaded.index < loaded.batch.questions.length) {
+        setCurrentQuestion(loaded.batch.questions[loaded.index].question)
+        questionShownAt.current = Date.now();
+        return;
+      }
+      setIsLoading(true);
+      apiSubmitAnswers(loaded.answers, loaded.answerSeconds, nextStepCallback).then((data) => {
+        if (data !== null) {
+          showResponse(data);
+          return;
+        }
+        // The server expected other steps, continue from where it is
+        apiFetchStatus(nextStepCallback).then((status) => {
+          if (status.status == 'FINISHED') navigate('/results/' + status.userUUID, { replace: true });
+          else if (status.status == 'IN_PROGRESS') showQuestion(status.question!!)
+          setIsLoading(false);
+        })
+      })
+      return;
+    }
+    levelBatchRequest.current += 1;  // A batch loaded after this answer would start with the answered question
     setIsLoading(true);
-    apiNextStep(answer, nextStepCallback).then((data) => {
-      if (data.finished) navigate('/results/' + data.userUUID, { replace: true });
-      else setCurrentQuestion(data.question)
-      setIsLoading(false);
-    })
+    apiNextStep(answer, nextStepCallback).then(showResponse)
   }
 
   const doStart = (name: string, email: string, startLevelName: string) => {
     setIsLoading(true);
     console.log(name, email, startLevelName);
-    apiStartTheTest(name, email, startLevelName, nextStepCallback).then(question => {
-      setCurrentQuestion(question)
-      setIsLoading(false);
-    })
+    apiStartTheTest(name, email, startLevelName, nextStepCallback).then(showResponse)
   }
   let questionComponent: JSX.Element | null = null;
   if (currentQuestion !== null) {
@@ -1,10 +1,29 @@
-import { AllAnalytics, AnswerType, DetailedResultsData, LanguageLevel, MediaType, PostAnswerResponse, QuestionCategory, QuestionProps, SERVER_ADDRESS, StatusResponse, SummarizedResultsData } from "./types";
+import { AllAnalytics, AnswerType, DetailedResultsData, LanguageLevel, LevelBatch, MediaType, PostAnswerResponse, QuestionCategory, QuestionProps, SERVER_ADDRESS, StatusResponse, SummarizedResultsData } from "./types";
 
 
 class BadServerResponse extends Error {}
 
 
+function readBootstrapStatus(): any | null {
+    // Inlined into index.html by the server (null when the server doesn't know it)
+    const element = document.getElementById('bootstrap');
+    if (element === null) {
+        return null;
+    }
+    element.remove();
+    try {
+        return JSON.parse(element.textContent || '').status;
+    } catch (e) {
+        return null;
+    }
+}
+
+// The status at the page load. Outdated by any request to the server, so it's only used before the first one.
+let bootstrapStatus: any | null = readBootstrapStatus();
+
+
 async function basicRequest(path: string, options: RequestInit | undefined = undefined, returnType: 'JSON' | 'TEXT' = 'JSON', failNonOk: boolean = false): Promise<any> {
+    bootstrapStatus = null;
     const fullUrl = SERVER_ADDRESS + path;
     const response = await fetch(fullUrl, options);
     if (failNonOk && !response.ok) {
@@ -38,7 +57,8 @@ export async function apiFetchDetailedResults(userUUID: string): Promise<Detaile
 }
 
 export async function apiFetchStatus(nextStepCallback: (answer: string) => void): Promise<StatusResponse> {
-    const data = await basicRequest('/status', { credentials: 'include' });
+    const data = bootstrapStatus ?? await basicRequest('/status', { credentials: 'include' });
+    bootstrapStatus = null;  // The page may be opened again later
     let userUUID: string | null = null;
     let question: QuestionProps | null = null;
     if (data.status === 'FINISHED') {
@@ -61,6 +81,25 @@ export async function apiFetchStatus(nextStepCallback: (answer: string) => void)
     return { status: data.status, userUUID: userUUID, question: question };
 }
 
+function questionFromData(data: any, nextStepCallback: (answer: string) => void): QuestionProps {
+    return {
+        title: data.question_title,
+        answerType: data.answer_type as AnswerType,
+        serializedAnswerOptions: data.answer_options,
+        filepath: data.filepath,
+        mediaType: data.media_type as MediaType,
+        inProgressProps: { nextStepCallback: nextStepCallback },
+        resultProps: null,
+    }
+}
+
+function postAnswerResponseFromData(data: any, nextStepCallback: (answer: string) => void): PostAnswerResponse {
+    if (data.finished) {
+        return { finished: true, userUUID: data.user_uuid, question: null };
+    }
+    return { finished: false, userUUID: null, question: questionFromData(data, nextStepCallback) };
+}
+
 export async function apiNextStep(answer: string, nextStepCallback: (answer: string) => void): Promise<PostAnswerResponse> {
     const data = await basicRequest('/next-step', {
         method: 'POST',
@@ -70,25 +109,50 @@ export async function apiNextStep(answer: string, nextStepCallback: (answer: str
         credentials: 'include',
         body: JSON.stringify({ answer: answer })
     })
-    let userUUID: string | null = null;
-    let question: QuestionProps | null = null;
-    if (data.finished) {
-        userUUID = data.user_uuid;
-    } else {
-        question = {
-            title: data.question_title,
-            answerType: data.answer_type as AnswerType,
-            serializedAnswerOptions: data.answer_options,
-            filepath: data.filepath,
-            mediaType: data.media_type as MediaType,
-            inProgressProps: { nextStepCallback: nextStepCallback },
-            resultProps: null,
+    return postAnswerResponseFromData(data, nextStepCallback);
+}
+
+export async function apiFetchLevelBatch(nextStepCallback: (answer: string) => void): Promise<LevelBatch | null> {
+    // All the remaining questions of the current level. Null for the adaptive test, whose questions are chosen one by one
+    let data: any;
+    try {
+        data = await basicRequest('/level-batch', { credentials: 'include' }, 'JSON', true);
+    } catch (e) {
+        if (e instanceof BadServerResponse) {
+            return null;
+        }
+        throw e;
+    }
+    return {
+        questions: data.questions.map((questionData: any) => {
+            return { stepNumber: questionData.step_number, question: questionFromData(questionData, nextStepCallback) };
+        }),
+        nextLevelStepNumber: data.next_level_step_number,
+    }
+}
+
+export async function apiSubmitAnswers(answers: Record<number, string>, answerSeconds: Record<number, number>, nextStepCallback: (answer: string) => void): Promise<PostAnswerResponse | null> {
+    // Null when the server expected the answers of other steps, e.g. after the test was continued in another tab
+    let data: any;
+    try {
+        data = await basicRequest('/answers', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            credentials: 'include',
+            body: JSON.stringify({ answers: answers, answer_seconds: answerSeconds })
+        }, 'JSON', true);
+    } catch (e) {
+        if (e instanceof BadServerResponse) {
+            return null;
         }
+        throw e;
     }
-    return { finished: data.finished, userUUID: userUUID, question: question };
+    return postAnswerResponseFromData(data, nextStepCallback);
 }
 
-export async function apiStartTheTest(name: string, email: string, startLevelName: string, nextStepCallback: (answer: string) => void): Promise<QuestionProps> {
+export async function apiStartTheTest(name: string, email: string, startLevelName: string, nextStepCallback: (answer: string) => void): Promise<PostAnswerResponse> {
     // Should always be successful
     const data = await basicRequest('/start', {
         method: 'POST',
@@ -102,15 +166,8 @@ export async function apiStartTheTest(name: string, email: string, startLevelNam
             start_level: startLevelName,
         })
     })
-    return {
-        title: data.question_title,
-        answerType: data.answer_type as AnswerType,
-        serializedAnswerOptions: data.answer_options,
-        filepath: data.filepath,
-        mediaType: data.media_type as MediaType,
-        inProgressProps: { nextStepCallback: nextStepCallback },
-        resultProps: null,
-    }
+    // The adaptive test finishes right away when there are no questions to ask
+    return postAnswerResponseFromData(data, nextStepCallback);
 }
 
 export async function apiFetchText(filepath: string): Promise<string> {
@@ -111,6 +111,16 @@ export interface PostAnswerResponse {
     question: QuestionProps | null;
 }
 
+export interface BatchQuestion {
+    stepNumber: number;
+    question: QuestionProps;
+}
+
+export interface LevelBatch {
+    questions: BatchQuestion[];
+    nextLevelStepNumber: number;
+}
+
 export interface StagesAnalytics {
     openedThePagePercentage: number;
     startedTheTestPercentage: number;
@@ -0,0 +1,140 @@
+"""
+Converts the level columns from the enum names ('A1_1') to the SMALLINT values (2) of `LanguageLevel`, after adding
+the columns that are missing in databases created by an older version (`db.create_all()` only creates tables).
+
+Safe to run several times: the columns that already exist or are already integers are skipped. The analytics
+aggregates are dropped and recomputed from scratch on the next analytics request.
+"""
+from sqlalchemy import Integer, case, column, inspect, table, text
+
+from backend import create_app
+from backend.models import (
+    AnalyticsWatermark,
+    FinishedUserAnalyticsAggregate,
+    StartLevelAnalyticsAggregate,
+    TopicAnalyticsAggregate,
+    db,
+)
+from backend.types import LanguageLevel
+
+
+ANALYTICS_AGGREGATE_MODELS = [
+    AnalyticsWatermark,
+    TopicAnalyticsAggregate,
+    StartLevelAnalyticsAggregate,
+    FinishedUserAnalyticsAggregate,
+]
+ANALYTICS_FOLDED_TABLES = ['user_analytics', 'user', 'progress_step']
+QUESTION_LEVEL_INDEX = 'ix_question_level'
+# Table, column, its type for ADD COLUMN and whether it is indexed
+MISSING_COLUMNS = [
+    ('user', 'detected_level', 'SMALLINT NULL', False),
+    *[(table_name, 'analytics_folded', 'BOOLEAN NOT NULL DEFAULT 0', True) for table_name in ANALYTICS_FOLDED_TABLES],
+]
+LEVEL_COLUMNS = [
+    ('question', 'level', False),
+    ('user', 'start_level', False),
+    ('user', 'detected_level', True),
+]
+
+
+def add_missing_column(table_name: str, column_name: str, column_type: str, is_indexed: bool) -> None:
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table_name):
+        return  # It will be created by `db.create_all()`
+    column_names = {column_info['name'] for column_info in inspector.get_columns(table_name)}
+    index_name = f'ix_{table_name}_{column_name}'  # The name that `index=True` gives to the index
+    needs_index = is_indexed and index_name not in {index['name'] for index in inspector.get_indexes(table_name)}
+    preparer = db.engine.dialect.identifier_preparer
+    quoted_table = preparer.quote(table_name)
+    quoted_column = preparer.quote(column_name)
+    with db.engine.begin() as connection:
+        if column_name not in column_names:
+            print(f'Adding {table_name}.{column_name}')
+            connection.execute(text(f'ALTER TABLE {quoted_table} ADD COLUMN {quoted_column} {column_type}'))
+        if needs_index:
+            print(f'Creating index {index_name}')
+            connection.execute(text(f'CREATE INDEX {index_name} ON {quoted_table} ({quoted_column})'))
+
+
+def convert_level_column(table_name: str, column_name: str, nullable: bool) -> None:
+    """
+    Also resumes a conversion that has failed halfway: MySQL commits every ALTER TABLE, so the temporary column may
+    be left, with or without the original column.
+    """
+    columns = {column_info['name']: column_info for column_info in inspect(db.engine).get_columns(table_name)}
+    temporary_column_name = f'{column_name}_value'
+    has_column, has_temporary_column = column_name in columns, temporary_column_name in columns
+    is_converted = has_column and isinstance(columns[column_name]['type'], Integer)
+    # The last step of the conversion on MySQL
+    needs_not_null = not nullable and db.engine.dialect.name == 'mysql' and (
+        not has_column or columns[column_name]['nullable']
+    )
+    if not has_column and not has_temporary_column:
+        print(f'{table_name}.{column_name} does not exist, skipping it')
+        return
+    if is_converted and not has_temporary_column and not needs_not_null:
+        print(f'{table_name}.{column_name} is already converted')
+        return
+
+    print(f'Converting {table_name}.{column_name}')
+    preparer = db.engine.dialect.identifier_preparer
+    quoted_table = preparer.quote(table_name)
+    quoted_column = preparer.quote(column_name)
+    quoted_temporary_column = preparer.quote(temporary_column_name)
+    with db.engine.begin() as connection:
+        if is_converted and has_temporary_column:
+            connection.execute(text(f'ALTER TABLE {quoted_table} DROP COLUMN {quoted_temporary_column}'))
+        if has_column and not is_converted:
+            if has_temporary_column:
+                print(f'Reusing {table_name}.{temporary_column_name} left by a failed conversion')
+            else:
+                connection.execute(text(f'ALTER TABLE {quoted_table} ADD COLUMN {quoted_temporary_column} SMALLINT'))
+            level_table = table(table_name, column(column_name), column(temporary_column_name))
+            connection.execute(level_table.update().values({
+                temporary_column_name: case(
+                    {level.name: level.value for level in LanguageLevel},
+                    value=level_table.c[column_name],
+                ),
+            }))
+            connection.execute(text(f'ALTER TABLE {quoted_table} DROP COLUMN {quoted_column}'))
+        if not is_converted:  # The values are in the temporary column
+            connection.execute(text(
+                f'ALTER TABLE {quoted_table} RENAME COLUMN {quoted_temporary_column} TO {quoted_column}'
+            ))
+        if needs_not_null:
+            connection.execute(text(f'ALTER TABLE {quoted_table} MODIFY {quoted_column} SMALLINT NOT NULL'))
+
+
+def reset_analytics_folded(table_name: str) -> None:
+    folded_table = table(table_name, column('analytics_folded'))
+    with db.engine.begin() as connection:
+        # A plain table, so the `onupdate` of the progress step timestamp is not applied
+        connection.execute(folded_table.update().values(analytics_folded=False))
+
+
+def main() -> None:
+    app = create_app()
+    with app.app_context():
+        for table_name, column_name, column_type, is_indexed in MISSING_COLUMNS:
+            add_missing_column(table_name, column_name, column_type, is_indexed)
+        for table_name, column_name, nullable in LEVEL_COLUMNS:
+            convert_level_column(table_name, column_name, nullable)
+
+        # The aggregates are rebuilt rather than converted, which requires to drop all of them and unflag the rows
+        for model in ANALYTICS_AGGREGATE_MODELS:
+            model.__table__.drop(db.engine, checkfirst=True)
+        for table_name in ANALYTICS_FOLDED_TABLES:
+            reset_analytics_folded(table_name)
+        db.create_all()
+
+        existing_indexes = {index['name'] for index in inspect(db.engine).get_indexes('question')}
+        if QUESTION_LEVEL_INDEX not in existing_indexes:
+            print(f'Creating index {QUESTION_LEVEL_INDEX}')
+            with db.engine.begin() as connection:
+                connection.execute(text(f'CREATE INDEX {QUESTION_LEVEL_INDEX} ON question (level)'))
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
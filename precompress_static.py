@@ -0,0 +1,37 @@
+"""
+Writes `.gz` (and `.br`, if the `brotli` package is installed) versions of the compressible files of the frontend
+build, which are then served instead of the original files to the clients accepting these encodings.
+
+Run after `npm run build`.
+"""
+import gzip
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+BUILD_DIR_PATH = Path(__file__).resolve().parent / 'frontend' / 'build'
+COMPRESSIBLE_SUFFIXES = {'.js', '.css', '.html', '.json', '.svg', '.txt', '.map'}
+MIN_SIZE = 500
+
+
+def main() -> None:
+    if brotli is None:
+        print('brotli is not installed, only .gz files will be written')
+    for path in sorted(BUILD_DIR_PATH.rglob('*')):
+        if not path.is_file() or path.suffix not in COMPRESSIBLE_SUFFIXES:
+            continue
+        data = path.read_bytes()
+        if len(data) < MIN_SIZE:
+            continue
+        path.with_name(path.name + '.gz').write_bytes(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            path.with_name(path.name + '.br').write_bytes(brotli.compress(data, quality=11))
+        print(f'Compressed {path.relative_to(BUILD_DIR_PATH)}')
+
+
+if __name__ == '__main__':
+    main()